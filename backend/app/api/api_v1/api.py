@@ -1,5 +1,5 @@
 from fastapi import APIRouter
-from app.api.api_v1.endpoints import auth, users, recitations, comments, markers, communities, donations, feedback
+from app.api.api_v1.endpoints import auth, users, recitations, comments, markers, communities, donations, feedback, sync, events, annotations, admin
 
 api_router = APIRouter()
 api_router.include_router(auth.router, prefix="/auth", tags=["authentication"])
@@ -15,3 +15,8 @@ api_router.include_router(
     donations.router, prefix="/donations", tags=["donations"])
 api_router.include_router(
     feedback.router, prefix="/feedback", tags=["feedback"])
+api_router.include_router(sync.router, prefix="/sync", tags=["sync"])
+api_router.include_router(events.router, prefix="/events", tags=["events"])
+api_router.include_router(
+    annotations.router, prefix="/annotations", tags=["annotations"])
+api_router.include_router(admin.router, prefix="/admin", tags=["admin"])
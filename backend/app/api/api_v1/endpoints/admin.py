@@ -0,0 +1,77 @@
+from typing import List, Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.orm import Session
+from app.db.database import get_db
+from app.core import profiling, slow_queries
+from app.core.deps import get_current_admin
+from app.models.user import User
+from app.schemas.assignment import AssignmentOverview
+from app.schemas.profile import StoredProfile
+from app.schemas.recitation import RecitationCounterDrift
+from app.schemas.slow_query import SlowQuery
+from app.services import assignments, counters
+
+router = APIRouter()
+
+
+@router.get("/recitation-counters", response_model=List[RecitationCounterDrift])
+def check_recitation_counters(
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin)
+):
+    """Recitations whose summary counters disagree with their child rows"""
+    return counters.check(db, limit=limit)
+
+
+@router.post("/recitation-counters/reconcile", response_model=List[RecitationCounterDrift])
+def reconcile_recitation_counters(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin)
+):
+    """Recount every recitation's summary counters and fix the ones that drifted"""
+    drift = counters.check(db, fix=True)
+    db.commit()
+    return drift
+
+
+@router.get("/assignments", response_model=AssignmentOverview)
+def read_assignment_overview(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_admin)
+):
+    """How many recitations wait for a scholar, and each scholar's open assignments"""
+    return assignments.overview(db)
+
+
+@router.get("/slow-queries", response_model=List[SlowQuery])
+def read_slow_queries(
+    limit: int = Query(20, ge=1, le=500),
+    order: Literal["total", "max", "calls"] = "total",
+    current_user: User = Depends(get_current_admin)
+):
+    """Statements slower than the slow query threshold in this worker, worst first"""
+    return slow_queries.top(limit, order)
+
+
+@router.get("/profiles", response_model=List[StoredProfile])
+def list_profiles(
+    kind: Optional[Literal["requests", "continuous"]] = None,
+    current_user: User = Depends(get_current_admin)
+):
+    """Stored request and continuous profiles, newest first"""
+    return profiling.stored(kind)
+
+
+@router.get("/profiles/{kind}/{profile_id}", response_class=PlainTextResponse)
+def read_profile(
+    kind: Literal["requests", "continuous"],
+    profile_id: str,
+    current_user: User = Depends(get_current_admin)
+):
+    """A stored profile as folded stacks, ready for flamegraph.pl or speedscope"""
+    folded = profiling.read(kind, profile_id)
+    if folded is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(folded)
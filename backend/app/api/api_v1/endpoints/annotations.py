@@ -0,0 +1,45 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from app.db.database import get_db
+from app.core.deps import get_current_active_user
+from app.core.encoding import msgpack_negotiable
+from app.core.serialization import FastJSONResponse, fast_responses_enabled
+from app.models.recitation import Recitation
+from app.models.user import User
+from app.schemas.annotation import AnnotationWindow
+from app.services.annotations import annotation_window
+
+router = APIRouter()
+
+
+@router.get("/recitation/{recitation_id}", response_model=AnnotationWindow)
+@msgpack_negotiable
+def read_annotation_window(
+    recitation_id: int,
+    start: float = Query(..., ge=0),
+    end: float = Query(..., gt=0),
+    buckets: Optional[int] = Query(None, ge=1, le=1000),
+    include_items: bool = True,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Markers and comments with a timestamp in [start, end] and loop regions
+    overlapping it. With ``buckets``, also per-bucket annotation counts for
+    the overview; pass ``include_items=false`` to get only the counts.
+    """
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be less than end")
+
+    # Verify recitation exists and user has access
+    recitation = db.query(Recitation.user_id).filter(Recitation.id == recitation_id).first()
+    if recitation is None:
+        raise HTTPException(status_code=404, detail="Recitation not found")
+    if recitation.user_id != current_user.id and current_user.role.value not in ["scholar", "admin"]:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+
+    window = annotation_window(db, recitation_id, start, end, include_items, buckets)
+    if fast_responses_enabled():
+        return FastJSONResponse(window)
+    return window
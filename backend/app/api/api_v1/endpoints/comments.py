@@ -1,8 +1,17 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Response
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from app.db.database import get_db
+from app.core.concurrency import (
+    conditional_transition, conditional_update, expected_version, set_etag
+)
 from app.core.deps import get_current_active_user, get_current_scholar
+from app.core.encoding import msgpack_negotiable
+from app.core.query_budget import query_budget
+from app.core.serialization import (
+    FastJSONResponse, fast_responses_enabled, row_dicts, schema_columns
+)
 from app.models.user import User
 from app.models.comment import Comment
 from app.models.recitation import Recitation
@@ -12,10 +21,49 @@ from app.schemas.comment import (
     CommentUpdate,
     CommentWithDetails
 )
+from app.services import counters, events, progress
+from app.services.sync import UPSERT, record_changes
 
 router = APIRouter()
 
+
+def _comment_details(db: Session, *criterion, skip: int = 0, limit: Optional[int] = None):
+    """
+    Rows for CommentWithDetails, with compact scholar and recitation
+    summaries joined in rather than lazy-loaded per comment.
+    """
+    query = db.query(
+        *schema_columns(Comment, CommentSchema),
+        User.username.label("scholar_username"),
+        User.full_name.label("scholar_full_name"),
+        Recitation.surah_name,
+        Recitation.ayah_start,
+        Recitation.ayah_end,
+    ).join(User, User.id == Comment.scholar_id).join(
+        Recitation, Recitation.id == Comment.recitation_id
+    ).filter(*criterion)
+    if skip:
+        query = query.offset(skip)
+    if limit is not None:
+        query = query.limit(limit)
+    rows = row_dicts(query.all())
+    for row in rows:
+        row["scholar"] = {
+            "id": row["scholar_id"],
+            "username": row.pop("scholar_username"),
+            "full_name": row.pop("scholar_full_name"),
+        }
+        row["recitation"] = {
+            "id": row["recitation_id"],
+            "surah_name": row.pop("surah_name"),
+            "ayah_start": row.pop("ayah_start"),
+            "ayah_end": row.pop("ayah_end"),
+        }
+    return rows
+
+
 @router.post("/", response_model=CommentSchema)
+@query_budget(12)
 def create_comment(
     comment: CommentCreate,
     db: Session = Depends(get_db),
@@ -36,9 +84,13 @@ def create_comment(
     db.add(db_comment)
     db.commit()
     db.refresh(db_comment)
+    events.publish(recitation.user_id, "comment.created",
+                   CommentSchema.model_validate(db_comment).model_dump(mode="json"))
     return db_comment
 
 @router.get("/recitation/{recitation_id}", response_model=List[CommentWithDetails])
+@query_budget(4)
+@msgpack_negotiable
 def read_comments_for_recitation(
     recitation_id: int,
     db: Session = Depends(get_db),
@@ -52,40 +104,59 @@ def read_comments_for_recitation(
     if recitation.user_id != current_user.id and current_user.role.value not in ["scholar", "admin"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
-    comments = db.query(Comment).filter(Comment.recitation_id == recitation_id).all()
+    comments = _comment_details(db, Comment.recitation_id == recitation_id)
+    if fast_responses_enabled():
+        return FastJSONResponse(comments)
     return comments
 
 @router.get("/my-comments", response_model=List[CommentWithDetails])
+@msgpack_negotiable
 def read_my_comments(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    comments = db.query(Comment).filter(
-        Comment.user_id == current_user.id
-    ).offset(skip).limit(limit).all()
+    comments = _comment_details(
+        db, Comment.user_id == current_user.id, skip=skip, limit=limit)
+    if fast_responses_enabled():
+        return FastJSONResponse(comments)
     return comments
 
 @router.put("/{comment_id}", response_model=CommentSchema)
+@query_budget(8)
 def update_comment(
     comment_id: int,
     comment_update: CommentUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
-    comment = db.query(Comment).filter(Comment.id == comment_id).first()
-    if comment is None:
-        raise HTTPException(status_code=404, detail="Comment not found")
-    
-    # Only the comment owner (user) can mark as resolved, or scholar can edit their comment
-    if comment.user_id != current_user.id and comment.scholar_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-    
     update_data = comment_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(comment, field, value)
-    
+    expected = expected_version(if_match, update_data.pop("version", None))
+
+    # Only the comment owner (user) can mark as resolved, or scholar can edit their comment
+    is_party = or_(Comment.user_id == current_user.id, Comment.scholar_id == current_user.id)
+    guards = [(is_party, 403, "Not enough permissions")]
+    resolved = update_data.get("is_resolved")
+    if resolved is None:
+        comment = conditional_update(
+            db, Comment, CommentSchema, comment_id, update_data, expected,
+            guards=guards, not_found="Comment not found")
+    else:
+        # Only the request that actually flips the flag moves the student's
+        # unresolved count
+        comment, flipped = conditional_transition(
+            db, Comment, CommentSchema, comment_id, update_data, expected,
+            Comment.is_resolved.isnot(resolved), guards=guards,
+            not_found="Comment not found")
+        if flipped:
+            counters.comment_resolved(db, comment["recitation_id"], resolved)
+            progress.comment_resolved(db, comment["recitation_id"], resolved)
+    record_changes(db, [
+        ("comment", comment_id, comment["user_id"], comment["recitation_id"], UPSERT)])
     db.commit()
-    db.refresh(comment)
+
+    set_etag(response, comment["version"])
     return comment
@@ -1,6 +1,6 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.orm import Session, joinedload, selectinload
 from sqlalchemy import and_, or_, func
 from app.db.database import get_db
 from app.core.deps import get_current_user, get_current_admin_or_scholar
@@ -9,13 +9,19 @@ from app.models.community import Community, CommunityMembership
 from app.schemas.community import (
     Community as CommunitySchema,
     CommunityCreate,
+    CommunityNearby,
     CommunityUpdate,
     CommunityWithMembers,
     CommunityMembershipCreate,
     CommunityMembershipUpdate,
     CommunityJoinRequest,
-    CommunityStats
+    CommunityStats,
+    CommunityInvitationBulkCreate,
+    CommunityInvitationBulkResult
 )
+from app.core.config import settings
+from app.core.query_budget import query_budget
+from app.services import assignments, community_stats, geo, invitations
 
 router = APIRouter()
 
@@ -48,6 +54,7 @@ def create_community(
 
 
 @router.get("/", response_model=List[CommunitySchema])
+@query_budget(5)
 def list_communities(
     skip: int = 0,
     limit: int = 100,
@@ -56,7 +63,10 @@ def list_communities(
     current_user: User = Depends(get_current_user)
 ):
     """List all active communities"""
-    query = db.query(Community).filter(Community.is_active == True)
+    query = db.query(Community).options(
+        selectinload(Community.creator),
+        selectinload(Community.memberships).selectinload(CommunityMembership.user),
+    ).filter(Community.is_active == True)
 
     if search:
         query = query.filter(
@@ -71,41 +81,68 @@ def list_communities(
     return communities
 
 
+@router.get("/nearby", response_model=List[CommunityNearby])
+def list_nearby_communities(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_km: float = Query(10, gt=0, le=500),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Active communities within ``radius_km`` of a point, nearest first"""
+    communities = []
+    for community, distance in geo.nearby(db, lat, lng, radius_km, limit):
+        community_dict = community.__dict__.copy()
+        community_dict['distance_km'] = round(distance, 3)
+        communities.append(community_dict)
+
+    return communities
+
+
 @router.get("/my-communities", response_model=List[CommunityWithMembers])
+@query_budget(5)
 def get_my_communities(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
     """Get communities where current user is a member"""
-    memberships = db.query(CommunityMembership).filter(
+    memberships = db.query(CommunityMembership).options(
+        joinedload(CommunityMembership.community)
+    ).filter(
         and_(
             CommunityMembership.user_id == current_user.id,
             CommunityMembership.is_active == True
         )
     ).all()
+    community_ids = [membership.community_id for membership in memberships]
+
+    # Member counts for all the communities at once
+    member_counts = dict(db.query(
+        CommunityMembership.community_id, func.count(CommunityMembership.id)
+    ).filter(
+        and_(
+            CommunityMembership.community_id.in_(community_ids),
+            CommunityMembership.is_active == True
+        )
+    ).group_by(CommunityMembership.community_id).all())
+
+    scholar_counts = dict(db.query(
+        CommunityMembership.community_id, func.count(CommunityMembership.id)
+    ).join(User).filter(
+        and_(
+            CommunityMembership.community_id.in_(community_ids),
+            CommunityMembership.is_active == True,
+            or_(User.role == UserRole.SCHOLAR, User.role == UserRole.ADMIN)
+        )
+    ).group_by(CommunityMembership.community_id).all())
 
     communities = []
     for membership in memberships:
         community = membership.community
-        # Add member counts
-        member_count = db.query(CommunityMembership).filter(
-            and_(
-                CommunityMembership.community_id == community.id,
-                CommunityMembership.is_active == True
-            )
-        ).count()
-
-        scholar_count = db.query(CommunityMembership).join(User).filter(
-            and_(
-                CommunityMembership.community_id == community.id,
-                CommunityMembership.is_active == True,
-                or_(User.role == UserRole.SCHOLAR, User.role == UserRole.ADMIN)
-            )
-        ).count()
-
         community_dict = community.__dict__.copy()
-        community_dict['member_count'] = member_count
-        community_dict['scholar_count'] = scholar_count
+        community_dict['member_count'] = member_counts.get(community.id, 0)
+        community_dict['scholar_count'] = scholar_counts.get(community.id, 0)
         communities.append(community_dict)
 
     return communities
@@ -201,6 +238,62 @@ def update_community(
     return community
 
 
+@router.post("/{community_id}/invitations", response_model=CommunityInvitationBulkResult)
+def create_invitations(
+    community_id: int,
+    invitation: CommunityInvitationBulkCreate,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Invite a list of email addresses at once (Admin or community admin only)"""
+    community = db.query(Community).filter(
+        Community.id == community_id).first()
+    if not community:
+        raise HTTPException(status_code=404, detail="Community not found")
+
+    if current_user.role != UserRole.ADMIN:
+        membership = db.query(CommunityMembership).filter(
+            and_(
+                CommunityMembership.community_id == community_id,
+                CommunityMembership.user_id == current_user.id,
+                CommunityMembership.role == "admin",
+                CommunityMembership.is_active == True
+            )
+        ).first()
+        if not membership:
+            raise HTTPException(
+                status_code=403, detail="Not authorized to invite to this community")
+
+    if len(invitation.emails) > settings.invitation_max_batch:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {settings.invitation_max_batch} invitations per request")
+
+    issued = invitations.issue(
+        db, community_id, current_user.id, invitation.emails,
+        role=invitation.role, expires_in_days=invitation.expires_in_days)
+    db.commit()
+    return {"invitations": issued}
+
+
+@router.post("/invitations/{token}/accept", response_model=dict)
+def accept_invitation(
+    token: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """Join the community an invitation sent to the current user's email is for"""
+    try:
+        membership = invitations.redeem(db, token, current_user)
+    except invitations.InvitationError as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+    if membership.role == "scholar":
+        assignments.scholar_changed(db, current_user.id)
+
+    return {"message": "Successfully joined the community",
+            "community_id": membership.community_id, "role": membership.role}
+
+
 @router.post("/{community_id}/join", response_model=dict)
 def join_community(
     community_id: int,
@@ -231,16 +324,20 @@ def join_community(
             existing_membership.is_active = True
             existing_membership.left_at = None
             db.commit()
+            if existing_membership.role == "scholar":
+                assignments.scholar_changed(db, current_user.id)
             return {"message": "Successfully rejoined the community"}
 
-    # Create new membership
+    # Create new membership; scholars review for the communities they join
     membership = CommunityMembership(
         community_id=community_id,
         user_id=current_user.id,
-        role="member"
+        role="scholar" if current_user.role == UserRole.SCHOLAR else "member"
     )
     db.add(membership)
     db.commit()
+    if membership.role == "scholar":
+        assignments.scholar_changed(db, current_user.id)
 
     return {"message": "Successfully joined the community"}
 
@@ -268,6 +365,8 @@ def leave_community(
     membership.is_active = False
     membership.left_at = func.now()
     db.commit()
+    if membership.role == "scholar":
+        assignments.scholar_changed(db, current_user.id)
 
     return {"message": "Successfully left the community"}
 
@@ -313,12 +412,8 @@ def get_community_stats(
         )
     ).count()
 
-    # TODO: Add recitation and review stats when recitation model is updated
-
     return CommunityStats(
         total_members=total_members,
         total_scholars=total_scholars,
-        total_recitations=0,  # Placeholder
-        pending_reviews=0,    # Placeholder
-        active_members=total_members
+        **community_stats.stats_for(db, community_id)
     )
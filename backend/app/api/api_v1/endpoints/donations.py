@@ -3,6 +3,10 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func, desc
 from app.db.database import get_db
+from app.core.encoding import msgpack_negotiable
+from app.core.serialization import (
+    FastJSONResponse, fast_responses_enabled, row_dicts, schema_columns
+)
 from app.core.deps import get_current_user, get_current_admin
 from app.models.user import User
 from app.models.donation import Donation, DonationCampaign, UserFeedback, DonationStatus
@@ -61,6 +65,7 @@ def initiate_donation(
 
 
 @router.get("/", response_model=List[DonationSchema])
+@msgpack_negotiable
 def list_donations(
     skip: int = 0,
     limit: int = 100,
@@ -69,29 +74,44 @@ def list_donations(
     current_user: User = Depends(get_current_user)
 ):
     """List user's donations"""
-    query = db.query(Donation).filter(Donation.user_id == current_user.id)
+    fast = fast_responses_enabled()
+    if fast:
+        query = db.query(*schema_columns(Donation, DonationSchema))
+    else:
+        query = db.query(Donation)
+    query = query.filter(Donation.user_id == current_user.id)
 
     if status:
         query = query.filter(Donation.status == status)
 
     donations = query.order_by(desc(Donation.created_at)).offset(
         skip).limit(limit).all()
+    if fast:
+        return FastJSONResponse(row_dicts(donations))
     return donations
 
 
 @router.get("/public", response_model=List[DonationSchema])
+@msgpack_negotiable
 def list_public_donations(
     skip: int = 0,
     limit: int = 20,
     db: Session = Depends(get_db)
 ):
     """List recent public donations (non-anonymous)"""
-    donations = db.query(Donation).filter(
+    fast = fast_responses_enabled()
+    if fast:
+        query = db.query(*schema_columns(Donation, DonationSchema))
+    else:
+        query = db.query(Donation)
+    donations = query.filter(
         and_(
             Donation.status == DonationStatus.COMPLETED,
             Donation.is_anonymous == False
         )
     ).order_by(desc(Donation.completed_at)).offset(skip).limit(limit).all()
+    if fast:
+        return FastJSONResponse(row_dicts(donations))
     return donations
 
 
@@ -199,6 +219,7 @@ def create_campaign(
 
 
 @router.get("/campaigns/", response_model=List[DonationCampaignSchema])
+@msgpack_negotiable
 def list_campaigns(
     skip: int = 0,
     limit: int = 100,
@@ -0,0 +1,62 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.core.deps import get_current_user
+from app.db.database import app_session, get_db
+from app.models.user import User
+from app.services import stream_tickets
+from app.services.events import broker
+
+router = APIRouter()
+
+
+def _stream_user_id(app, ticket: Optional[str]) -> Optional[int]:
+    # A short-lived session: the stream itself holds no database connection
+    with app_session(app) as db:
+        return stream_tickets.redeem(db, ticket)
+
+
+@router.post("/ticket", response_model=dict)
+def create_stream_ticket(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    A single-use ticket for opening the event stream or a co-review room
+    socket, valid for ``expires_in`` seconds, so the bearer token never
+    goes in a URL
+    """
+    ticket = stream_tickets.issue(db, current_user.id)
+    db.commit()
+    return {"ticket": ticket, "expires_in": settings.events_ticket_seconds}
+
+
+@router.get("/stream")
+async def stream_events(
+    request: Request,
+    ticket: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    Server-Sent Events for the current user's recitations: comment.created,
+    marker.created, loop_region.created and recitation.status. Browsers'
+    EventSource can't set headers, so the stream is opened with
+    ``?ticket=`` from ``POST /events/ticket``, fetched again for every
+    reconnect. Reconnects resume after the ``Last-Event-ID`` header.
+    """
+    user_id = await run_in_threadpool(_stream_user_id, request.app, ticket)
+    if user_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired stream ticket",
+        )
+
+    subscription = broker.subscribe(user_id, last_event_id or None)
+    return StreamingResponse(
+        subscription.stream(settings.events_heartbeat_seconds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
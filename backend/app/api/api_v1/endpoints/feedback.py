@@ -1,9 +1,10 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
 from sqlalchemy.orm import Session
 from sqlalchemy import and_, or_, func
 
 from app.core import deps
+from app.core.concurrency import conditional_update, expected_version, set_etag
 from app.models.user import User
 from app.models.donation import UserFeedback
 from app.schemas.donation import (
@@ -116,45 +117,41 @@ def update_feedback(
     db: Session = Depends(get_db),
     feedback_id: int,
     feedback_in: UserFeedbackUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: User = Depends(deps.get_current_active_user)
 ) -> UserFeedback:
     """
     Update feedback. Only admins can update feedback status and admin response.
     Users can only update their own feedback if it's still open.
+    Send the version being edited as If-Match or ``version``; a stale
+    version gets 409 with the current feedback.
     """
-    feedback = db.query(UserFeedback).filter(
-        UserFeedback.id == feedback_id).first()
-    if not feedback:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Feedback not found"
-        )
+    expected = expected_version(if_match, feedback_in.version)
 
     # Check permissions
+    guards = []
     if current_user.role == "admin":
         # Admins can update any feedback
-        update_data = feedback_in.dict(exclude_unset=True)
+        update_data = feedback_in.dict(exclude_unset=True, exclude={"version"})
     else:
         # Users can only update their own feedback and only certain fields
-        if feedback.user_id != current_user.id:
-            raise HTTPException(
-                status_code=status.HTTP_403_FORBIDDEN,
-                detail="Not enough permissions"
-            )
-        if feedback.status != "open":
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Cannot update closed feedback"
-            )
+        guards = [
+            (UserFeedback.user_id == current_user.id,
+             status.HTTP_403_FORBIDDEN, "Not enough permissions"),
+            (UserFeedback.status == "open",
+             status.HTTP_400_BAD_REQUEST, "Cannot update closed feedback"),
+        ]
         # Users can only update title and description
         update_data = feedback_in.dict(exclude_unset=True, include={
                                        "title", "description"})
 
-    for field, value in update_data.items():
-        setattr(feedback, field, value)
-
+    feedback = conditional_update(
+        db, UserFeedback, UserFeedbackResponse, feedback_id, update_data, expected,
+        guards=guards, not_found="Feedback not found")
     db.commit()
-    db.refresh(feedback)
+
+    set_etag(response, feedback["version"])
     return feedback
 
 
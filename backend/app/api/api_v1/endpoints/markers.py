@@ -1,5 +1,6 @@
-from typing import List
-from fastapi import APIRouter, Depends, HTTPException, status
+from typing import List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, WebSocket, status
+from sqlalchemy import literal
 from sqlalchemy.orm import Session
 from app.db.database import get_db
 from app.models.marker import Marker, LoopRegion
@@ -10,11 +11,20 @@ from app.schemas.marker import (
     LoopRegionCreate, LoopRegionUpdate, LoopRegion as LoopRegionSchema
 )
 from app.core import deps
+from app.core.concurrency import conditional_update, expected_version, set_etag
+from app.core.encoding import msgpack_negotiable
+from app.core.query_budget import query_budget
+from app.core.serialization import (
+    FastJSONResponse, fast_responses_enabled, row_dicts, schema_columns
+)
+from app.services import annotations, events, progress, review_rooms
+from app.services.sync import record_recitation_change
 
 router = APIRouter()
 
 
 @router.post("/", response_model=MarkerSchema)
+@query_budget(15)
 def create_marker(
     *,
     db: Session = Depends(get_db),
@@ -36,10 +46,16 @@ def create_marker(
     db.add(marker)
     db.commit()
     db.refresh(marker)
+    data = MarkerSchema.model_validate(marker).model_dump(mode="json")
+    events.publish(recitation.user_id, "marker.created", data)
+    review_rooms.broadcast_change(
+        marker.recitation_id, "marker", review_rooms.CREATE, marker.id, data, current_user.id)
     return marker
 
 
 @router.get("/recitation/{recitation_id}", response_model=List[MarkerSchema])
+@query_budget(4)
+@msgpack_negotiable
 def get_markers_by_recitation(
     *,
     db: Session = Depends(get_db),
@@ -59,34 +75,48 @@ def get_markers_by_recitation(
     if current_user.role not in ["scholar", "admin"] and recitation.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
 
+    if fast_responses_enabled():
+        rows = db.query(*schema_columns(Marker, MarkerSchema)).filter(
+            Marker.recitation_id == recitation_id).all()
+        return FastJSONResponse(row_dicts(rows))
+
     markers = db.query(Marker).filter(
         Marker.recitation_id == recitation_id).all()
     return markers
 
 
 @router.put("/{marker_id}", response_model=MarkerSchema)
+@query_budget(12)
 def update_marker(
     marker_id: int,
     marker_update: MarkerUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     db: Session = Depends(get_db),
-    current_user: User = Depends(deps.get_current_active_user)
+    current_user: User = Depends(deps.get_current_scholar)
 ):
-    marker = db.query(Marker).filter(Marker.id == marker_id).first()
-    if marker is None:
-        raise HTTPException(status_code=404, detail="Marker not found")
-
-    # Verify user owns the recitation
-    recitation = db.query(Recitation).filter(
-        Recitation.id == marker.recitation_id).first()
-    if recitation.user_id != current_user.id:
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-
+    """
+    Update a marker. Only the scholar who created it can update. Send the
+    version being edited as If-Match or ``version``; a stale version gets
+    409 with the current marker.
+    """
     update_data = marker_update.dict(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(marker, field, value)
-
+    expected = expected_version(if_match, update_data.pop("version", None))
+
+    marker = conditional_update(
+        db, Marker, MarkerSchema, marker_id, update_data, expected,
+        guards=annotations.edit_guards(Marker, current_user.id, current_user.role),
+        not_found="Marker not found")
+    record_recitation_change(db, "marker", marker_id, marker["recitation_id"])
+    if "category" in update_data:
+        # The previous category isn't known here
+        progress.refresh_recitation(db, marker["recitation_id"])
     db.commit()
-    db.refresh(marker)
+
+    set_etag(response, marker["version"])
+    review_rooms.broadcast_change(
+        marker["recitation_id"], "marker", review_rooms.UPDATE, marker_id, marker,
+        current_user.id)
     return marker
 
 
@@ -105,11 +135,13 @@ def delete_marker(
         raise HTTPException(status_code=404, detail="Marker not found")
 
     # Only the scholar who created the marker or admin can delete
-    if marker.scholar_id != current_user.id and current_user.role != "admin":
+    if not annotations.can_edit(current_user.id, current_user.role, marker.scholar_id):
         raise HTTPException(status_code=403, detail="Not enough permissions")
 
     db.delete(marker)
     db.commit()
+    review_rooms.broadcast_change(
+        marker.recitation_id, "marker", review_rooms.DELETE, marker_id, None, current_user.id)
     return {"message": "Marker deleted successfully"}
 
 
@@ -141,10 +173,16 @@ def create_loop_region(
     db.add(loop_region)
     db.commit()
     db.refresh(loop_region)
+    data = LoopRegionSchema.model_validate(loop_region).model_dump(mode="json")
+    events.publish(recitation.user_id, "loop_region.created", data)
+    review_rooms.broadcast_change(
+        loop_region.recitation_id, "loop_region", review_rooms.CREATE, loop_region.id,
+        data, current_user.id)
     return loop_region
 
 
 @router.get("/loops/recitation/{recitation_id}", response_model=List[LoopRegionSchema])
+@msgpack_negotiable
 def get_loop_regions_by_recitation(
     *,
     db: Session = Depends(get_db),
@@ -164,6 +202,11 @@ def get_loop_regions_by_recitation(
     if current_user.role not in ["scholar", "admin"] and recitation.user_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
 
+    if fast_responses_enabled():
+        rows = db.query(*schema_columns(LoopRegion, LoopRegionSchema)).filter(
+            LoopRegion.recitation_id == recitation_id).all()
+        return FastJSONResponse(row_dicts(rows))
+
     loop_regions = db.query(LoopRegion).filter(
         LoopRegion.recitation_id == recitation_id).all()
     return loop_regions
@@ -175,34 +218,39 @@ def update_loop_region(
     db: Session = Depends(get_db),
     loop_id: int,
     loop_in: LoopRegionUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None),
     current_user: User = Depends(deps.get_current_scholar)
 ) -> LoopRegion:
     """
     Update a loop region. Only the scholar who created it can update.
+    Send the version being edited as If-Match or ``version``; a stale
+    version gets 409 with the current loop region.
     """
-    loop_region = db.query(LoopRegion).filter(LoopRegion.id == loop_id).first()
-    if not loop_region:
-        raise HTTPException(status_code=404, detail="Loop region not found")
+    update_data = loop_in.dict(exclude_unset=True)
+    expected = expected_version(if_match, update_data.pop("version", None))
 
     # Only the scholar who created the loop region or admin can update
-    if loop_region.scholar_id != current_user.id and current_user.role != "admin":
-        raise HTTPException(status_code=403, detail="Not enough permissions")
-
-    update_data = loop_in.dict(exclude_unset=True)
+    guards = annotations.edit_guards(LoopRegion, current_user.id, current_user.role)
 
-    # Validate time range if both times are being updated
+    # Validate time range against the stored times in the same statement
     if "start_time" in update_data or "end_time" in update_data:
-        start_time = update_data.get("start_time", loop_region.start_time)
-        end_time = update_data.get("end_time", loop_region.end_time)
-        if start_time >= end_time:
-            raise HTTPException(
-                status_code=400, detail="Start time must be less than end time")
-
-    for field, value in update_data.items():
-        setattr(loop_region, field, value)
-
+        start_time = literal(update_data["start_time"]) \
+            if "start_time" in update_data else LoopRegion.start_time
+        end_time = literal(update_data["end_time"]) \
+            if "end_time" in update_data else LoopRegion.end_time
+        guards.append((start_time < end_time, 400, "Start time must be less than end time"))
+
+    loop_region = conditional_update(
+        db, LoopRegion, LoopRegionSchema, loop_id, update_data, expected,
+        guards=guards, not_found="Loop region not found")
+    record_recitation_change(db, "loop_region", loop_id, loop_region["recitation_id"])
     db.commit()
-    db.refresh(loop_region)
+
+    set_etag(response, loop_region["version"])
+    review_rooms.broadcast_change(
+        loop_region["recitation_id"], "loop_region", review_rooms.UPDATE, loop_id,
+        loop_region, current_user.id)
     return loop_region
 
 
@@ -221,9 +269,23 @@ def delete_loop_region(
         raise HTTPException(status_code=404, detail="Loop region not found")
 
     # Only the scholar who created the loop region or admin can delete
-    if loop_region.scholar_id != current_user.id and current_user.role != "admin":
+    if not annotations.can_edit(current_user.id, current_user.role, loop_region.scholar_id):
         raise HTTPException(status_code=403, detail="Not enough permissions")
 
     db.delete(loop_region)
     db.commit()
+    review_rooms.broadcast_change(
+        loop_region.recitation_id, "loop_region", review_rooms.DELETE, loop_id, None,
+        current_user.id)
     return {"message": "Loop region deleted successfully"}
+
+
+@router.websocket("/ws/{recitation_id}")
+async def review_room(websocket: WebSocket, recitation_id: int, ticket: Optional[str] = None):
+    """
+    Co-review room for a recitation. Scholars and admins create, update and
+    delete markers and loop regions here and see each other's edits live;
+    the recitation's owner may watch. Connect with ``?ticket=`` from
+    ``POST /api/v1/events/ticket``.
+    """
+    await review_rooms.serve(websocket, recitation_id, ticket)
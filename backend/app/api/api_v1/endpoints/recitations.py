@@ -1,16 +1,34 @@
+import json
 from typing import List
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
 from app.db.database import get_db
+from app.core import quran
 from app.core.deps import get_current_active_user, get_current_scholar
+from app.core.encoding import msgpack_negotiable
+from app.core.query_budget import query_budget
+from app.core.serialization import (
+    FastJSONResponse, fast_responses_enabled, group_rows, row_dicts, schema_columns
+)
 from app.models.user import User
-from app.models.recitation import Recitation
+from app.models.recitation import Recitation, RecitationStatus, RecitationSubmission
+from app.models.comment import Comment
+from app.models.marker import Marker
+from app.schemas.comment import Comment as CommentSchema
+from app.schemas.marker import Marker as MarkerSchema
+from app.schemas.user import User as UserSchema
 from app.schemas.recitation import (
     RecitationCreate,
     Recitation as RecitationSchema,
     RecitationUpdate,
-    RecitationWithDetails
+    RecitationWithDetails,
+    RecitationBatchItem,
+    RecitationBatchResult
 )
+from app.services import assignments, community_stats, coverage, events
+from app.services.storage import delete_audio, save_audio
 
 router = APIRouter()
 
@@ -21,27 +39,160 @@ def create_recitation(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
+    try:
+        community_id = community_stats.community_for(
+            db, current_user.id, recitation.community_id)
+    except PermissionError as exc:
+        raise HTTPException(status_code=403, detail=str(exc))
     db_recitation = Recitation(
         user_id=current_user.id,
+        community_id=community_id,
         surah_name=recitation.surah_name,
         ayah_start=recitation.ayah_start,
         ayah_end=recitation.ayah_end,
         audio_data=recitation.audio_data,
-        duration=recitation.duration
+        duration=recitation.duration,
+        **coverage.reference_columns(
+            recitation.surah_number, recitation.ayah_start, recitation.ayah_end)
     )
     db.add(db_recitation)
     db.commit()
     db.refresh(db_recitation)
+    assignments.submit(db, db_recitation)
     return db_recitation
 
 
+@router.post("/batch", response_model=RecitationBatchResult)
+def create_recitations_batch(
+    manifest: str = Form(...),
+    audio: List[UploadFile] = File(default=[]),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Submit many queued offline recordings in one multipart request.
+
+    ``manifest`` is a JSON list of recitations, each with a client-generated
+    ``idempotency_key`` and optionally the ``file`` name of its audio part.
+    Keys that were already submitted are answered from their idempotency
+    record without storing the audio again, so replays are safe.
+    """
+    try:
+        entries = json.loads(manifest)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="Manifest must be valid JSON")
+    if not isinstance(entries, list):
+        raise HTTPException(status_code=422, detail="Manifest must be a JSON list")
+
+    # Validate every entry before any key reaches the database
+    validated = []
+    for entry in entries:
+        try:
+            validated.append((RecitationBatchItem.model_validate(entry), None))
+        except ValidationError as exc:
+            key = entry.get("idempotency_key") if isinstance(entry, dict) else None
+            validated.append((None, {"idempotency_key": key if isinstance(key, str) else None,
+                                     "status": "error",
+                                     "detail": str(exc.errors()[0]["msg"])}))
+
+    files = {upload.filename: upload for upload in audio}
+    keys = [item.idempotency_key for item, _ in validated if item is not None]
+    submitted = dict(db.query(
+        RecitationSubmission.idempotency_key, RecitationSubmission.recitation_id
+    ).filter(
+        RecitationSubmission.user_id == current_user.id,
+        RecitationSubmission.idempotency_key.in_(keys)
+    ).all()) if keys else {}
+
+    results = []
+    created = []
+    for item, error in validated:
+        if error is not None:
+            results.append(error)
+            continue
+
+        key = item.idempotency_key
+        if key in submitted:
+            results.append({"idempotency_key": key, "status": "duplicate",
+                            "recitation_id": submitted[key]})
+            continue
+
+        upload = files.get(item.file) if item.file else None
+        if item.file and upload is None:
+            results.append({"idempotency_key": key, "status": "error",
+                            "detail": f"Missing audio part '{item.file}'"})
+            continue
+
+        try:
+            community_id = community_stats.community_for(db, current_user.id, item.community_id)
+        except PermissionError as exc:
+            results.append({"idempotency_key": key, "status": "error", "detail": str(exc)})
+            continue
+
+        audio_path = None
+        try:
+            with db.begin_nested():
+                recitation = Recitation(
+                    user_id=current_user.id,
+                    community_id=community_id,
+                    surah_name=item.surah_name,
+                    ayah_start=item.ayah_start,
+                    ayah_end=item.ayah_end,
+                    audio_data=item.audio_data,
+                    duration=item.duration,
+                    **coverage.reference_columns(
+                        item.surah_number, item.ayah_start, item.ayah_end)
+                )
+                db.add(recitation)
+                db.flush()
+                # Claims the key; a concurrent replay fails here before
+                # its audio is stored
+                db.add(RecitationSubmission(
+                    user_id=current_user.id,
+                    idempotency_key=key,
+                    recitation_id=recitation.id
+                ))
+                db.flush()
+                if upload is not None:
+                    audio_path = save_audio(
+                        upload.file, f"recitations/{current_user.id}", upload.filename)
+                    recitation.audio_file_path = audio_path
+        except IntegrityError:
+            if audio_path:
+                delete_audio(audio_path)
+            existing = db.query(RecitationSubmission.recitation_id).filter(
+                RecitationSubmission.user_id == current_user.id,
+                RecitationSubmission.idempotency_key == key
+            ).scalar()
+            results.append({"idempotency_key": key, "status": "duplicate",
+                            "recitation_id": existing})
+            continue
+
+        submitted[key] = recitation.id
+        created.append(recitation)
+        results.append({"idempotency_key": key, "status": "created",
+                        "recitation_id": recitation.id})
+
+    db.commit()
+    for recitation in created:
+        assignments.submit(db, recitation)
+    return {"results": results}
+
+
 @router.get("/", response_model=List[RecitationSchema])
+@msgpack_negotiable
 def read_recitations(
     skip: int = 0,
     limit: int = 100,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_active_user)
 ):
+    if fast_responses_enabled():
+        rows = db.query(*schema_columns(Recitation, RecitationSchema)).filter(
+            Recitation.user_id == current_user.id
+        ).offset(skip).limit(limit).all()
+        return FastJSONResponse(row_dicts(rows))
+
     recitations = db.query(Recitation).filter(
         Recitation.user_id == current_user.id
     ).offset(skip).limit(limit).all()
@@ -49,14 +200,36 @@ def read_recitations(
 
 
 @router.get("/pending", response_model=List[RecitationWithDetails])
+@query_budget(6)
+@msgpack_negotiable
 def read_pending_recitations(
     skip: int = 0,
     limit: int = 100,
+    include_details: bool = True,
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_scholar)
 ):
+    """
+    The review queue. With ``include_details=false`` only the recitation
+    rows are returned, with their comment and marker counts, which is all
+    a queue listing needs.
+    """
     from app.models.recitation import RecitationStatus
-    recitations = db.query(Recitation).filter(
+    if not include_details:
+        rows = row_dicts(db.query(*schema_columns(Recitation, RecitationSchema)).filter(
+            Recitation.status == RecitationStatus.PENDING
+        ).offset(skip).limit(limit).all())
+        if fast_responses_enabled():
+            return FastJSONResponse(rows)
+        return rows
+    if fast_responses_enabled():
+        return FastJSONResponse(_pending_recitation_rows(db, skip, limit))
+
+    recitations = db.query(Recitation).options(
+        selectinload(Recitation.user),
+        selectinload(Recitation.comments),
+        selectinload(Recitation.markers),
+    ).filter(
         Recitation.status == RecitationStatus.PENDING
     ).offset(skip).limit(limit).all()
 
@@ -66,12 +239,19 @@ def read_pending_recitations(
         recitation_dict = {
             "id": recitation.id,
             "user_id": recitation.user_id,
+            "community_id": recitation.community_id,
             "surah_name": recitation.surah_name,
+            "surah_number": recitation.surah_number,
             "ayah_start": recitation.ayah_start,
             "ayah_end": recitation.ayah_end,
             "audio_file_path": recitation.audio_file_path,
             "duration": recitation.duration,
             "status": recitation.status,
+            "comment_count": recitation.comment_count,
+            "unresolved_comment_count": recitation.unresolved_comment_count,
+            "marker_count": recitation.marker_count,
+            "loop_region_count": recitation.loop_region_count,
+            "last_feedback_at": recitation.last_feedback_at,
             "created_at": recitation.created_at,
             "updated_at": recitation.updated_at,
             "user": {
@@ -95,6 +275,7 @@ def read_pending_recitations(
                     "text_comment": comment.text_comment,
                     "audio_comment_path": comment.audio_comment_path,
                     "is_resolved": comment.is_resolved,
+                    "version": comment.version,
                     "created_at": comment.created_at,
                     "updated_at": comment.updated_at
                 } for comment in recitation.comments
@@ -109,6 +290,7 @@ def read_pending_recitations(
                     "description": marker.description,
                     "category": marker.category,
                     "color": marker.color,
+                    "version": marker.version,
                     "created_at": marker.created_at,
                     "updated_at": marker.updated_at
                 } for marker in recitation.markers
@@ -119,7 +301,98 @@ def read_pending_recitations(
     return result
 
 
+def _pending_recitation_rows(db: Session, skip: int, limit: int) -> List[dict]:
+    """
+    Pending recitations with their user, comments and markers, fetched as
+    column tuples in four queries regardless of page size.
+    """
+    from app.models.recitation import RecitationStatus
+    recitations = row_dicts(
+        db.query(*schema_columns(Recitation, RecitationSchema)).filter(
+            Recitation.status == RecitationStatus.PENDING
+        ).offset(skip).limit(limit).all()
+    )
+    if not recitations:
+        return recitations
+
+    recitation_ids = [r["id"] for r in recitations]
+    user_ids = {r["user_id"] for r in recitations}
+    users = {
+        row["id"]: row for row in row_dicts(
+            db.query(*schema_columns(User, UserSchema)).filter(
+                User.id.in_(user_ids)).all()
+        )
+    }
+    comments = group_rows(row_dicts(
+        db.query(*schema_columns(Comment, CommentSchema)).filter(
+            Comment.recitation_id.in_(recitation_ids)).all()
+    ), "recitation_id")
+    markers = group_rows(row_dicts(
+        db.query(*schema_columns(Marker, MarkerSchema)).filter(
+            Marker.recitation_id.in_(recitation_ids)).all()
+    ), "recitation_id")
+
+    for recitation in recitations:
+        recitation["user"] = users.get(recitation["user_id"])
+        recitation["comments"] = comments.get(recitation["id"], [])
+        recitation["markers"] = markers.get(recitation["id"], [])
+    return recitations
+
+
+@router.get("/coverage", response_model=List[RecitationSchema])
+@msgpack_negotiable
+def read_recitations_covering(
+    surah: str = Query(..., description="Surah number or name"),
+    ayah_start: int = Query(..., ge=1),
+    ayah_end: int = Query(None, ge=1),
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Recitations that include any ayah of ``surah:ayah_start-ayah_end``
+    (a single ayah when ``ayah_end`` is omitted). Users see their own;
+    scholars and admins see everyone's.
+    """
+    try:
+        number = quran.validate_range(surah, ayah_start, ayah_end or ayah_start)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+    query = db.query(*schema_columns(Recitation, RecitationSchema))
+    if current_user.role.value not in ["scholar", "admin"]:
+        query = query.filter(Recitation.user_id == current_user.id)
+    rows = coverage.covering(db, query, number, ayah_start, ayah_end).order_by(
+        Recitation.id).offset(skip).limit(limit).all()
+    if fast_responses_enabled():
+        return FastJSONResponse(row_dicts(rows))
+    return row_dicts(rows)
+
+
+@router.get("/assigned", response_model=List[RecitationSchema])
+def read_assigned_recitations(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_scholar)
+):
+    """
+    The scholar's own review queue: recitations assigned to them, oldest
+    assignment first. Opening it pulls waiting recitations up to the
+    scholar's capacity.
+    """
+    recitation_ids = assignments.open_assignments(db, current_user)
+    rows = {row["id"]: row for row in row_dicts(
+        db.query(*schema_columns(Recitation, RecitationSchema)).filter(
+            Recitation.id.in_(recitation_ids)).all()
+    )}
+    ordered = [rows[recitation_id] for recitation_id in recitation_ids if recitation_id in rows]
+    if fast_responses_enabled():
+        return FastJSONResponse(ordered)
+    return ordered
+
+
 @router.get("/{recitation_id}", response_model=RecitationWithDetails)
+@msgpack_negotiable
 def read_recitation(
     recitation_id: int,
     db: Session = Depends(get_db),
@@ -150,9 +423,21 @@ def update_recitation(
         raise HTTPException(status_code=404, detail="Recitation not found")
 
     update_data = recitation_update.dict(exclude_unset=True)
+    status_changed = (
+        "status" in update_data and update_data["status"] != recitation.status)
+    was_pending = recitation.status == RecitationStatus.PENDING
     for field, value in update_data.items():
         setattr(recitation, field, value)
 
     db.commit()
     db.refresh(recitation)
+    if status_changed:
+        if was_pending:
+            assignments.complete(db, recitation.id)
+        elif recitation.status == RecitationStatus.PENDING:
+            assignments.submit(db, recitation)
+        events.publish(recitation.user_id, "recitation.status", {
+            "recitation_id": recitation.id,
+            "status": recitation.status,
+        })
     return recitation
@@ -0,0 +1,30 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.orm import Session
+from app.db.database import get_db
+from app.core.deps import get_current_active_user
+from app.core.encoding import msgpack_negotiable
+from app.models.user import User
+from app.schemas.sync import SyncChanges
+from app.services.sync import InvalidSyncToken, changes_since
+
+router = APIRouter()
+
+
+@router.get("/changes", response_model=SyncChanges)
+@msgpack_negotiable
+def read_changes(
+    since: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    Recitations, comments, markers and loop regions created, updated or
+    deleted since the given sync token. Omit ``since`` for a full sync and
+    keep calling with ``next_token`` while ``has_more`` is true.
+    """
+    try:
+        return changes_since(db, current_user, since, limit)
+    except InvalidSyncToken:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
@@ -2,9 +2,14 @@ from typing import List
 from fastapi import APIRouter, Depends, HTTPException
 from sqlalchemy.orm import Session
 from app.db.database import get_db
+from app.core import quran
 from app.core.deps import get_current_active_user, get_current_admin
+from app.core.security import TOKEN_CACHE_NAMESPACE
 from app.models.user import User
+from app.schemas.progress import SurahProgress
 from app.schemas.user import User as UserSchema, UserUpdate
+from app.services import progress
+from app.services.backplane import backplane
 
 router = APIRouter()
 
@@ -12,6 +17,26 @@ router = APIRouter()
 def read_users_me(current_user: User = Depends(get_current_active_user)):
     return current_user
 
+@router.get("/me/progress", response_model=List[SurahProgress])
+def read_my_progress(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Progress on every surah the current user has recited"""
+    return progress.progress_for(db, current_user.id)
+
+@router.get("/me/progress/{surah}", response_model=SurahProgress)
+def read_my_surah_progress(
+    surah: str,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    number = quran.surah_number(surah)
+    if number is None:
+        raise HTTPException(status_code=404, detail="Surah not found")
+    rows = progress.progress_for(db, current_user.id, number)
+    return rows[0] if rows else progress.empty_progress(number)
+
 @router.get("/", response_model=List[UserSchema])
 def read_users(
     skip: int = 0, 
@@ -45,9 +70,13 @@ def update_user(
         raise HTTPException(status_code=404, detail="User not found")
     
     update_data = user_update.dict(exclude_unset=True)
+    username = user.username
     for field, value in update_data.items():
         setattr(user, field, value)
     
     db.commit()
     db.refresh(user)
+    if update_data.keys() & {"username", "role", "is_active"}:
+        # No worker answers for this account from verifications made before
+        backplane.invalidate(TOKEN_CACHE_NAMESPACE, username)
     return user
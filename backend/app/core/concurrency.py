@@ -0,0 +1,137 @@
+"""
+Optimistic concurrency for single-row updates.
+
+Versioned models carry a ``version`` column that every update increments.
+``conditional_update`` applies a change as one ``UPDATE ... WHERE id = :id
+AND version = :expected AND <guards> RETURNING ...`` statement, so the
+common path needs no prior SELECT and no refresh. Only when no row matched
+does a single follow-up SELECT work out why: the row is missing (404), a
+guard failed (its own status, e.g. 403), or the version moved on (409 with
+the current state so the client can merge and retry).
+
+Clients send the version they edited as an ``If-Match`` header (the ETag of
+a previous response) or a ``version`` field in the body. Without either the
+update is applied unconditionally and still bumps the version.
+"""
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from fastapi import HTTPException, Response, status
+from pydantic import BaseModel
+from sqlalchemy import case, select, update
+from sqlalchemy.orm import Session
+
+from app.core.serialization import schema_columns
+
+CONFLICT = "The item was changed by someone else"
+
+# (criterion, status code, detail) checked inside the UPDATE's WHERE clause
+Guard = Tuple[Any, int, str]
+
+
+def etag(version: int) -> str:
+    return f'"{version}"'
+
+
+def expected_version(if_match: Optional[str], body_version: Optional[int]) -> Optional[int]:
+    """The version the client edited, from If-Match (preferred) or the body"""
+    if if_match is None or if_match.strip() == "*":
+        return body_version
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid If-Match header")
+
+
+def _criteria(model: type, row_id: int, expected: Optional[int], guards: List[Guard]) -> list:
+    criteria = [model.id == row_id, *(guard[0] for guard in guards)]
+    if expected is not None:
+        criteria.append(model.version == expected)
+    return criteria
+
+
+def _update_returning(db: Session, model: type, columns: list, criteria: list,
+                      values: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    statement = (
+        update(model)
+        .where(*criteria)
+        .values(**values, version=model.version + 1)
+        .returning(*columns)
+        .execution_options(synchronize_session=False)
+    )
+    row = db.execute(statement).first()
+    return dict(row._mapping) if row is not None else None
+
+
+def conditional_update(
+    db: Session,
+    model: type,
+    schema: Type[BaseModel],
+    row_id: int,
+    values: Dict[str, Any],
+    expected: Optional[int],
+    guards: List[Guard] = (),
+    not_found: str = "Not found",
+) -> Dict[str, Any]:
+    """
+    Apply ``values`` to row ``row_id`` if it is still at version ``expected``
+    and every guard holds. Returns the updated row as a dict of ``schema``'s
+    fields; the caller commits.
+    """
+    columns = schema_columns(model, schema)
+    row = _update_returning(db, model, columns, _criteria(model, row_id, expected, guards), values)
+    if row is not None:
+        return row
+
+    # Nothing matched: one SELECT to tell the caller why
+    checks = [case((guard[0], 1), else_=0) for guard in guards]
+    current = db.execute(
+        select(*columns, *checks).where(model.id == row_id)
+    ).first()
+    db.rollback()
+    if current is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=not_found)
+    for (_, status_code, detail), passed in zip(guards, current[len(columns):]):
+        if not passed:
+            raise HTTPException(status_code=status_code, detail=detail)
+    state = {column.key: value for column, value in zip(columns, current)}
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail={
+            "message": CONFLICT,
+            "current": schema.model_validate(state).model_dump(mode="json"),
+        },
+    )
+
+
+def conditional_transition(
+    db: Session,
+    model: type,
+    schema: Type[BaseModel],
+    row_id: int,
+    values: Dict[str, Any],
+    expected: Optional[int],
+    transition: Any,
+    guards: List[Guard] = (),
+    not_found: str = "Not found",
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    ``conditional_update`` that also tells whether ``transition``, a
+    criterion on the row before the update (say, a flag not yet at its new
+    value), held. The first UPDATE carries the criterion, so a real
+    transition still costs one statement and two concurrent requests can't
+    both claim it; only when it matches nothing is the plain update tried.
+    """
+    columns = schema_columns(model, schema)
+    row = _update_returning(
+        db, model, columns, [*_criteria(model, row_id, expected, guards), transition], values)
+    if row is not None:
+        return row, True
+    return conditional_update(db, model, schema, row_id, values, expected, guards,
+                              not_found), False
+
+
+def set_etag(response: Response, version: int) -> None:
+    response.headers["ETag"] = etag(version)
@@ -1,21 +1,146 @@
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, List, Optional
 
 class Settings(BaseSettings):
+    # "production" (set by docker-compose.prod.yml) relaxes development checks
+    environment: str = "development"
+
     # Database
     database_url: str
-    
+
     # Security
     secret_key: str
     algorithm: str = "HS256"
     access_token_expire_minutes: int = 30
-    
+
+    # JWT backend: "auto" prefers PyJWT when installed, "jose" or "pyjwt" force one
+    jwt_backend: str = "auto"
+    # Key rotation: map of kid -> secret. Tokens are signed with jwt_active_kid
+    # and verified with the key named by their "kid" header; tokens without a
+    # kid fall back to secret_key.
+    jwt_signing_keys: Dict[str, str] = {}
+    jwt_active_kid: Optional[str] = None
+    # Number of verified tokens kept in memory (0 disables the cache)
+    token_cache_size: int = 4096
+
+    # Local directory for uploaded audio files
+    upload_dir: str = "uploads"
+
+    # Serve list endpoints from column tuples through app.core.serialization
+    fast_list_responses: bool = False
+
+    # Idempotency-Key handling (app.core.idempotency)
+    idempotency_ttl_seconds: int = 86400
+    # How long a request's claim on its key holds if it never completes
+    idempotency_claim_seconds: int = 300
+    idempotency_sweep_interval: int = 600
+    # Rows removed per statement by the background sweepers
+    sweep_batch_size: int = 1000
+
+    # Community invitations (app.services.invitations)
+    invitation_expire_days: int = 7
+    invitation_max_batch: int = 1000  # addresses per bulk invitation request
+    invitation_sweep_interval: int = 3600
+
+    # Open review assignments a scholar is given before work waits (app.services.assignments)
+    review_max_open_assignments: int = 10
+
+    # Seconds between reconciliations of recitation summary counters (app.services.counters)
+    counter_check_interval: int = 3600
+
+    # Serve Prometheus metrics at /metrics (app.core.metrics)
+    metrics_enabled: bool = True
+
+    # Directory where workers share metrics and slow query totals
+    # (app.core.multiprocess); app.server uses a temporary one when unset
+    multiprocess_dir: Optional[str] = None
+    multiprocess_flush_interval: float = 5.0
+
+    # Per-request SQL budgets (app.core.query_budget): "raise" fails the
+    # request, "warn" logs a sampled warning, "off". Defaults to "warn" in
+    # production and "raise" everywhere else.
+    query_budget_mode: Optional[str] = None
+    query_budget_default: Optional[int] = None  # for routes without @query_budget
+    query_repeat_threshold: int = 10  # one SELECT this often in a request is an N+1
+    query_budget_warn_sample_rate: float = 0.1
+
+    # Request tracing (app.core.tracing): exporter "none", "jsonl" or "otlp"
+    tracing_exporter: str = "none"
+    tracing_sample_rate: float = 0.01  # requests without a trusted sampled traceparent
+    # Peers (addresses or networks, e.g. the nginx container's subnet) whose
+    # traceparent sampled flag is honored; others are sampled at the rate above
+    tracing_trusted_proxies: List[str] = []
+    tracing_jsonl_path: str = "traces.jsonl"
+    tracing_otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    tracing_service_name: str = "saut-al-quran-api"
+    tracing_queue_size: int = 2048  # finished traces awaiting export; more are dropped
+    tracing_export_interval: float = 5.0
+
+    # Slow query log (app.core.slow_queries)
+    slow_query_ms: float = 200
+    slow_query_explain_limit: int = 3  # plans captured per statement fingerprint (Postgres)
+    slow_query_max_fingerprints: int = 500
+
+    # Sampling profiler (app.core.profiling): admins profile a request with
+    # X-Profile: 1; a percentage of all requests can be profiled continuously
+    profile_dir: str = "profiles"
+    profiling_interval_ms: int = 5
+    profiling_sample_percent: float = 0.0
+    profiling_flush_interval: int = 60  # seconds between continuous profile files
+    profiling_retention_hours: int = 72
+    profiling_max_files: int = 500  # per kind, newest kept
+    profiling_max_stacks: int = 10000  # distinct stacks per profile
+
+    # Response compression (app.core.encoding)
+    compression_min_size: int = 1024
+    gzip_level: int = 6
+    brotli_quality: int = 4
+
+    # Live event stream (app.services.events)
+    events_replay_size: int = 100  # events kept per user for Last-Event-ID resume
+    events_buffered_users: int = 10000  # users whose replay buffer is kept
+    events_queue_size: int = 64  # undelivered events per connection before it is dropped
+    events_heartbeat_seconds: int = 15
+    events_ticket_seconds: int = 30  # lifetime of a stream ticket (app.services.stream_tickets)
+    events_ticket_sweep_interval: int = 600
+
+    # Co-review rooms (app.services.review_rooms)
+    review_batch_window_ms: int = 50  # edits collected into one transaction
+    review_queue_size: int = 256  # unsent messages per socket before it is dropped
+
+    # Cross-worker pub/sub (app.services.backplane): "auto" uses Postgres
+    # LISTEN/NOTIFY when database_url is Postgres, "postgres" or "local" force one
+    backplane: str = "auto"
+    backplane_channel: str = "saut_backplane"
+    backplane_coalesce_ms: int = 10  # outgoing messages are batched for this long
+
+    # Production server (see app/server.py)
+    server_host: str = "0.0.0.0"
+    server_port: int = 8000
+    web_concurrency: Optional[int] = None  # defaults to 2 * CPUs + 1
+    server_max_requests: int = 10000  # recycle a worker after this many requests
+    server_max_requests_jitter: int = 1000
+    server_graceful_timeout: int = 30  # seconds to drain in-flight requests
+    server_timeout: int = 60
+    server_keepalive: int = 5
+    server_backlog: int = 2048
+    # Create tables and seed data from the app's startup event. The production
+    # server turns this off and runs the step once in the master process.
+    init_db_on_startup: bool = True
+
     # Optional AWS/S3 settings for future use
     aws_access_key_id: Optional[str] = None
     aws_secret_access_key: Optional[str] = None
     aws_bucket_name: Optional[str] = None
     aws_region: Optional[str] = None
-    
+
+    @model_validator(mode="after")
+    def _environment_defaults(self) -> "Settings":
+        if self.query_budget_mode is None:
+            self.query_budget_mode = "warn" if self.environment == "production" else "raise"
+        return self
+
     class Config:
         env_file = ".env"
 
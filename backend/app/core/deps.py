@@ -1,9 +1,11 @@
+import time
 from typing import Generator, Optional
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Response, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
 from app.db.database import get_db
 from app.core.security import verify_token
+from app.core.tracing import span
 from app.models.user import User, UserRole
 from app.schemas.user import TokenData
 
@@ -11,6 +13,7 @@ security = HTTPBearer()
 
 
 def get_current_user(
+    response: Response,
     db: Session = Depends(get_db),
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ) -> User:
@@ -20,14 +23,23 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
 
+    start = time.perf_counter()
     username = verify_token(credentials.credentials)
+    verified = time.perf_counter()
     if username is None:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == username).first()
+    with span("auth.user_lookup"):
+        user = db.query(User).filter(User.username == username).first()
     if user is None:
         raise credentials_exception
 
+    # Expose per-request auth overhead to clients and browser devtools
+    response.headers.append(
+        "Server-Timing",
+        f"jwt;dur={(verified - start) * 1000:.3f}, "
+        f"auth-user;dur={(time.perf_counter() - verified) * 1000:.3f}"
+    )
     return user
 
 
@@ -85,3 +97,19 @@ def get_current_user_optional(
         return user
     except Exception:
         return None
+
+
+def authenticate_token(db: Session, token: Optional[str]) -> Optional[User]:
+    """
+    Active user for a bearer token, for handlers that can't hold a
+    Depends(get_db) session open (long-lived streams, WebSockets).
+    """
+    if not token:
+        return None
+    username = verify_token(token)
+    if username is None:
+        return None
+    user = db.query(User).filter(User.username == username).first()
+    if user is None or not user.is_active:
+        return None
+    return user
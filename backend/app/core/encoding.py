@@ -0,0 +1,241 @@
+"""
+Response encoding negotiation.
+
+ResponseEncodingMiddleware compresses buffered responses with brotli or gzip
+when the client accepts it and the body is at least ``minimum_size`` bytes,
+and re-encodes JSON bodies as MessagePack for routes marked with
+``@msgpack_negotiable`` when the client sends ``Accept: application/msgpack``.
+Streaming responses, already-encoded bodies, media types that are already
+compressed (audio, video, images, archives) and routes marked with
+``@no_compression`` are passed through untouched.
+"""
+import gzip
+import json
+import threading
+from typing import Callable, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.tracing import span
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover - optional dependency
+    _json_loads = json.loads
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+INCOMPRESSIBLE_PREFIXES = ("audio/", "video/", "image/")
+INCOMPRESSIBLE_TYPES = {
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/octet-stream",
+    "text/event-stream",
+}
+
+
+def msgpack_negotiable(endpoint: Callable) -> Callable:
+    """Allow the route's JSON response to be served as MessagePack"""
+    endpoint.__msgpack_negotiable__ = True
+    return endpoint
+
+
+def no_compression(endpoint: Callable) -> Callable:
+    """Never compress the route's response (e.g. already-compressed audio)"""
+    endpoint.__no_compression__ = True
+    return endpoint
+
+
+class EncodingStats:
+    """Byte counts before and after encoding, per content encoding."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.responses = {}
+        self.bytes_in = {}
+        self.bytes_out = {}
+
+    def record(self, encoding: str, bytes_in: int, bytes_out: int) -> None:
+        with self._lock:
+            self.responses[encoding] = self.responses.get(encoding, 0) + 1
+            self.bytes_in[encoding] = self.bytes_in.get(encoding, 0) + bytes_in
+            self.bytes_out[encoding] = self.bytes_out.get(encoding, 0) + bytes_out
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                encoding: {
+                    "responses": self.responses[encoding],
+                    "bytes_in": self.bytes_in[encoding],
+                    "bytes_out": self.bytes_out[encoding],
+                    "bytes_saved": self.bytes_in[encoding] - self.bytes_out[encoding],
+                }
+                for encoding in self.responses
+            }
+
+
+encoding_stats = EncodingStats()
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """Pick br or gzip from an Accept-Encoding header, honouring q-values"""
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[coding.strip()] = q
+
+    wildcard = weights.get("*", 0.0)
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_q = None, 0.0
+    for coding in candidates:
+        q = weights.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def _is_compressible(content_type: str) -> bool:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    if not media_type:
+        return True
+    if media_type in INCOMPRESSIBLE_TYPES:
+        return False
+    return not media_type.startswith(INCOMPRESSIBLE_PREFIXES)
+
+
+class ResponseEncodingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 1024,
+        gzip_level: int = 6,
+        brotli_quality: int = 4,
+    ) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""))
+        wants_msgpack = (
+            msgpack is not None
+            and MSGPACK_MEDIA_TYPE in headers.get("accept", "").lower()
+        )
+        if encoding is None and not wants_msgpack:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _EncodingResponder(self, scope, send, encoding, wants_msgpack)
+        await self.app(scope, receive, responder.send)
+
+    def compress(self, encoding: str, body: bytes) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+
+class _EncodingResponder:
+    def __init__(self, middleware: ResponseEncodingMiddleware, scope: Scope,
+                 send: Send, encoding: Optional[str], wants_msgpack: bool):
+        self.middleware = middleware
+        self.scope = scope
+        self._send = send
+        self.encoding = encoding
+        self.wants_msgpack = wants_msgpack
+        self.start_message: Optional[Message] = None
+        self.passthrough = False
+
+    async def send(self, message: Message) -> None:
+        if self.passthrough:
+            await self._send(message)
+            return
+
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+
+        if message.get("more_body", False):
+            # Streaming response: never buffer it
+            self.passthrough = True
+            await self._send(self.start_message)
+            await self._send(message)
+            return
+
+        await self._send_encoded(message.get("body", b""))
+
+    async def _send_encoded(self, body: bytes) -> None:
+        start = self.start_message
+        headers = MutableHeaders(raw=start["headers"])
+        endpoint = self.scope.get("endpoint")
+        content_type = headers.get("content-type", "")
+        vary = []
+
+        with span("response.encode"):
+            if (
+                self.wants_msgpack
+                and getattr(endpoint, "__msgpack_negotiable__", False)
+                and content_type.startswith("application/json")
+                and "content-encoding" not in headers
+            ):
+                original_size = len(body)
+                body = msgpack.packb(_json_loads(body), use_bin_type=True)
+                encoding_stats.record("msgpack", original_size, len(body))
+                headers["content-type"] = MSGPACK_MEDIA_TYPE
+                content_type = MSGPACK_MEDIA_TYPE
+                vary.append("Accept")
+
+            if (
+                self.encoding is not None
+                and len(body) >= self.middleware.minimum_size
+                and "content-encoding" not in headers
+                and not getattr(endpoint, "__no_compression__", False)
+                and _is_compressible(content_type)
+            ):
+                compressed = self.middleware.compress(self.encoding, body)
+                encoding_stats.record(self.encoding, len(body), len(compressed))
+                body = compressed
+                headers["content-encoding"] = self.encoding
+                vary.append("Accept-Encoding")
+
+            if vary:
+                headers["content-length"] = str(len(body))
+                for value in vary:
+                    headers.add_vary_header(value)
+
+        await self._send(start)
+        await self._send({"type": "http.response.body", "body": body})
@@ -0,0 +1,83 @@
+"""
+Geohashes and the bounding boxes used by nearby-community search.
+
+A geohash interleaves longitude and latitude bits and writes them in
+base 32, so points that share a prefix lie in the same cell and a cell's
+points are a contiguous range of an ordinary string index. ``cover``
+returns the few prefixes whose cells cover a search box; the database
+answers each as a range scan.
+"""
+import math
+from typing import List, Tuple
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+PRECISION = 9  # ~4.8 m x 4.8 m cells
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def encode(latitude: float, longitude: float, precision: int = PRECISION) -> str:
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = bit_count = 0
+    even = True  # Bits alternate, starting with longitude
+    while len(chars) < precision:
+        value, interval = (longitude, lon_range) if even else (latitude, lat_range)
+        middle = (interval[0] + interval[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(BASE32[bits])
+            bits = bit_count = 0
+    return "".join(chars)
+
+
+def cell_size(precision: int) -> Tuple[float, float]:
+    """(height, width) of a cell in degrees"""
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def bounding_box(latitude: float, longitude: float,
+                 radius_km: float) -> Tuple[float, float, float, float]:
+    """(south, west, north, east) around a circle; longitudes may pass ±180"""
+    delta_lat = radius_km / KM_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-6)
+    delta_lon = min(radius_km / (KM_PER_DEGREE * cos_lat), 180.0)
+    return (max(latitude - delta_lat, -90.0), longitude - delta_lon,
+            min(latitude + delta_lat, 90.0), longitude + delta_lon)
+
+
+def _wrap(longitude: float) -> float:
+    return (longitude + 180.0) % 360.0 - 180.0
+
+
+def cover(south: float, west: float, north: float, east: float) -> List[str]:
+    """
+    Geohash prefixes whose cells together contain the box: the longest
+    precision at which the box spans at most two cells on each axis, so at
+    most four prefixes. Empty when the box is too large to narrow down.
+    """
+    precision = 0
+    while precision < PRECISION:
+        height, width = cell_size(precision + 1)
+        if height < north - south or width < east - west:
+            break
+        precision += 1
+    if precision == 0:
+        return []
+    corners = {encode(min(lat, 90.0 - 1e-9), _wrap(lon), precision)
+               for lat in (south, north) for lon in (west, east)}
+    return sorted(corners)
+
+
+def prefix_upper_bound(prefix: str) -> str:
+    """The smallest string greater than every geohash starting with ``prefix``"""
+    return prefix + "~"  # "~" sorts after every base-32 character
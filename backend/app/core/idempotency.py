@@ -0,0 +1,249 @@
+"""
+Idempotency-Key support for POST and PUT requests.
+
+A client that may retry a mutating request sends an ``Idempotency-Key``
+header. The first request with a given key (scoped to the authenticated
+user) runs normally and its response is stored for
+``settings.idempotency_ttl_seconds``. A retry with the same key and the
+same request gets the stored response back with ``Idempotent-Replayed:
+true``; reusing a key for a different request is rejected with 422.
+
+Before running, a request claims its key by inserting the record without a
+response, in its own short transaction; the unique key makes exactly one
+duplicate win, in any process. Duplicates in the same process wait on a
+per-key lock; one arriving from another process while the first is still
+running gets 409 with ``Retry-After``. A claim whose request failed is
+removed, and one left by a crashed worker expires after
+``settings.idempotency_claim_seconds``.
+
+Unauthenticated and multipart requests are passed through untouched; the
+batch upload endpoint carries its own per-item keys.
+"""
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import deps, tasks
+from app.core.config import settings
+from app.db.database import SessionLocal, app_session
+from app.models.idempotency import IdempotencyRecord
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+METHODS = {"POST", "PUT"}
+MAX_KEY_LENGTH = 255
+RETRY_AFTER_SECONDS = 1
+
+
+def _digest(*parts: bytes) -> str:
+    return hashlib.sha256(b"\0".join(parts)).hexdigest()
+
+
+def _request_session(scope: Scope):
+    return app_session(scope["app"])
+
+
+def _caller_id(scope: Scope) -> Optional[int]:
+    scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer":
+        return None
+    with _request_session(scope) as db:
+        user = deps.authenticate_token(db, token)
+        return user.id if user else None
+
+
+class _KeyLocks:
+    """Per-key locks that only exist while someone holds or waits on them"""
+
+    def __init__(self):
+        self._locks: Dict[str, list] = {}
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+
+def _claim(scope: Scope, key: str, fingerprint: str) -> Optional[dict]:
+    """
+    Insert this request's record for ``key``; if another request holds the
+    key, return its record instead (``status_code`` None while it runs).
+    """
+    with _request_session(scope) as db:
+        while True:
+            db.add(IdempotencyRecord(
+                key=key,
+                method=scope["method"],
+                path=scope["path"],
+                fingerprint=fingerprint,
+                expires_at=tasks.utcnow() + timedelta(seconds=settings.idempotency_claim_seconds),
+            ))
+            try:
+                db.commit()
+                return None
+            except IntegrityError:
+                db.rollback()
+            record = db.query(IdempotencyRecord).filter(
+                IdempotencyRecord.key == key,
+                IdempotencyRecord.expires_at > tasks.utcnow()
+            ).first()
+            if record is not None:
+                return {
+                    "fingerprint": record.fingerprint,
+                    "status_code": record.status_code,
+                    "content_type": record.content_type,
+                    "body": record.body,
+                }
+            # An expired record (or stale claim) the sweeper hasn't removed yet
+            db.execute(delete(IdempotencyRecord).where(
+                IdempotencyRecord.key == key, IdempotencyRecord.expires_at <= tasks.utcnow()))
+            db.commit()
+
+
+def _store_record(scope: Scope, key: str, status_code: int,
+                  content_type: Optional[str], body: bytes) -> None:
+    with _request_session(scope) as db:
+        db.execute(update(IdempotencyRecord).where(IdempotencyRecord.key == key).values(
+            status_code=status_code,
+            content_type=content_type,
+            body=body,
+            expires_at=tasks.utcnow() + timedelta(seconds=settings.idempotency_ttl_seconds),
+        ))
+        db.commit()
+
+
+def _release_claim(scope: Scope, key: str) -> None:
+    with _request_session(scope) as db:
+        db.execute(delete(IdempotencyRecord).where(
+            IdempotencyRecord.key == key, IdempotencyRecord.status_code.is_(None)))
+        db.commit()
+
+
+def purge_expired_records(batch_size: Optional[int] = None) -> int:
+    """Delete expired records in bounded batches; returns the number removed"""
+    with SessionLocal() as db:
+        return tasks.delete_in_batches(
+            db, IdempotencyRecord, IdempotencyRecord.expires_at <= tasks.utcnow(),
+            batch_size=batch_size)
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self.locks = _KeyLocks()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] not in METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        client_key = headers.get(IDEMPOTENCY_HEADER)
+        if not client_key or headers.get("content-type", "").startswith("multipart/"):
+            await self.app(scope, receive, send)
+            return
+        if len(client_key) > MAX_KEY_LENGTH:
+            response = JSONResponse(
+                {"detail": "Idempotency-Key is too long"}, status_code=400)
+            await response(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        user_id = await run_in_threadpool(_caller_id, scope)
+        if user_id is None:
+            await self._call_and_capture(scope, receive, send, body)
+            return
+        key = _digest(str(user_id).encode(), client_key.encode())
+        fingerprint = _digest(
+            scope["method"].encode(), scope["path"].encode(),
+            scope.get("query_string", b""), body)
+
+        async with self.locks.hold(key):
+            record = await run_in_threadpool(_claim, scope, key, fingerprint)
+            if record is not None:
+                if record["fingerprint"] != fingerprint:
+                    response = JSONResponse(
+                        {"detail": "Idempotency-Key was already used for a different request"},
+                        status_code=422)
+                elif record["status_code"] is None:
+                    response = JSONResponse(
+                        {"detail": "A request with this Idempotency-Key is in progress"},
+                        status_code=409,
+                        headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
+                else:
+                    response = Response(
+                        content=record["body"],
+                        status_code=record["status_code"],
+                        media_type=record["content_type"],
+                        headers={REPLAYED_HEADER: "true"},
+                    )
+                await response(scope, receive, send)
+                return
+
+            captured = None
+            try:
+                captured = await self._call_and_capture(scope, receive, send, body)
+            finally:
+                if captured is not None and captured["status_code"] < 500:
+                    await run_in_threadpool(
+                        _store_record, scope, key, captured["status_code"],
+                        captured["content_type"], captured["body"])
+                else:
+                    await run_in_threadpool(_release_claim, scope, key)
+
+    async def _call_and_capture(self, scope: Scope, receive: Receive, send: Send,
+                                body: bytes) -> Optional[dict]:
+        body_sent = False
+
+        async def replay_receive() -> Message:
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        captured = {"status_code": 500, "content_type": None}
+        chunks: Optional[List[bytes]] = []
+
+        async def capture_send(message: Message) -> None:
+            nonlocal chunks
+            if message["type"] == "http.response.start":
+                captured["status_code"] = message["status"]
+                captured["content_type"] = Headers(raw=message["headers"]).get("content-type")
+            elif message["type"] == "http.response.body" and chunks is not None:
+                if message.get("more_body", False):
+                    chunks = None  # Streaming responses aren't replayable
+                else:
+                    chunks.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, replay_receive, capture_send)
+        if chunks is None:
+            return None
+        captured["body"] = b"".join(chunks)
+        return captured
+
+
+async def _read_body(receive: Receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
@@ -0,0 +1,341 @@
+"""
+Request and database metrics in the Prometheus text format.
+
+``MetricsMiddleware`` wraps the whole app and records, per request:
+
+- ``http_request_duration_seconds{method,route,status}``: a histogram whose
+  ``_count`` is also the request counter
+- ``http_requests_in_progress{method}``
+- ``http_request_size_bytes`` and ``http_response_size_bytes{method,route}``,
+  the bytes actually received and sent
+- ``http_request_sql_queries`` and ``http_request_sql_seconds{method,route}``:
+  statements run for the request and the time spent in them
+
+``route`` is the path template FastAPI matched (``/api/v1/markers/{marker_id}``),
+so ids don't multiply the series; unmatched paths share one label.
+SQL statements are timed by app.core.sql_timing and added to the request
+found in a context variable, which also reaches sync endpoints running in the
+threadpool. Statements outside a request, such as background jobs, only
+count towards ``db_query_duration_seconds``.
+
+Token verification and response encoding totals are exported as counters
+too. Recording is a few dict lookups and bisects under a lock per metric,
+so it stays negligible next to a request's database round trips. Each
+worker process keeps its own registry; with ``settings.multiprocess_dir``
+set, a scrape adds up the samples every other worker, live or retired,
+shared through app.core.multiprocess (gauges only count live workers).
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import multiprocess, sql_timing
+from app.core.encoding import encoding_stats
+from app.core.security import verification_stats
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+UNMATCHED_ROUTE = "unmatched"
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"'
+                          for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Labels, object] = {}
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def samples(self) -> Iterable[Tuple[str, Labels, Sequence[str], float]]:
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, self.labelnames, labels, value
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for name, names, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(names, labels)} {_format_value(value)}")
+        return lines
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, labels: Labels = (), amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels: Labels = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+    def set(self, labels: Labels, value: float) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DURATION_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, (list(state[0]), state[1], state[2]))
+                     for labels, state in self._values.items()]
+        bucket_names = (*self.labelnames, "le")
+        bounds = [*(_format_value(float(bound)) for bound in self.buckets), "+Inf"]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", bucket_names, (*labels, bound), cumulative
+            yield f"{self.name}_sum", self.labelnames, labels, total
+            yield f"{self.name}_count", self.labelnames, labels, count
+
+
+class Collected(Metric):
+    """A metric read from elsewhere when scraped; ``collect`` returns {labels: value}"""
+
+    def __init__(self, name: str, documentation: str, kind: str, labelnames: Sequence[str],
+                 collect: Callable[[], Dict[Labels, float]]):
+        super().__init__(name, documentation, labelnames)
+        self.type = kind
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name, self.labelnames, labels, value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name: str) -> Optional[Metric]:
+        return self._metrics.get(name)
+
+    def snapshot(self) -> Dict[str, list]:
+        """Every metric's samples as JSON-friendly [name, labelnames, labels, value]"""
+        return {
+            metric.name: [[name, list(names), list(labels), value]
+                          for name, names, labels, value in metric.samples()]
+            for metric in self._metrics.values()
+        }
+
+    def fold(self, archive: Optional[Dict[str, list]], snapshot: Dict[str, list]) -> Dict[str, list]:
+        """Add a retired worker's samples to ``archive``, leaving out its gauges"""
+        live = {name: samples for name, samples in snapshot.items()
+                if name in self._metrics and self._metrics[name].type != "gauge"}
+        return _sum_snapshots([archive or {}, live])
+
+    def render(self, others: Iterable[Dict[str, list]] = ()) -> str:
+        """The text exposition, with other workers' snapshots added in"""
+        totals = _sum_snapshots([self.snapshot(), *others])
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            for name, names, labels, value in totals.get(metric.name, ()):
+                lines.append(f"{name}{_format_labels(names, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+def _sum_snapshots(snapshots: Iterable[Dict[str, list]]) -> Dict[str, list]:
+    totals: Dict[str, Dict[tuple, list]] = {}
+    for snapshot in snapshots:
+        for metric, samples in snapshot.items():
+            merged = totals.setdefault(metric, {})
+            for name, names, labels, value in samples:
+                key = (name, tuple(labels))
+                if key in merged:
+                    merged[key][3] += value
+                else:
+                    merged[key] = [name, tuple(names), tuple(labels), value]
+    return {metric: list(merged.values()) for metric, merged in totals.items()}
+
+
+registry = Registry()
+multiprocess.share("metrics", registry.snapshot, registry.fold)
+
+request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Time to serve a request",
+    ("method", "route", "status")))
+requests_in_progress = registry.register(Gauge(
+    "http_requests_in_progress", "Requests being served", ("method",)))
+request_size = registry.register(Histogram(
+    "http_request_size_bytes", "Request body size", ("method", "route"), SIZE_BUCKETS))
+response_size = registry.register(Histogram(
+    "http_response_size_bytes", "Response body size as sent", ("method", "route"),
+    SIZE_BUCKETS))
+request_sql_queries = registry.register(Histogram(
+    "http_request_sql_queries", "SQL statements run by a request", ("method", "route"),
+    QUERY_COUNT_BUCKETS))
+request_sql_seconds = registry.register(Histogram(
+    "http_request_sql_seconds", "Time a request spent in SQL statements", ("method", "route")))
+query_duration = registry.register(Histogram(
+    "db_query_duration_seconds", "Time to run a SQL statement"))
+
+
+# Totals kept by other modules, read when scraped
+
+def _stat(stats, key: str, by_encoding: bool = False) -> Callable[[], Dict[Labels, float]]:
+    if by_encoding:
+        return lambda: {(encoding,): values[key] for encoding, values in stats.snapshot().items()}
+    return lambda: {(): stats.snapshot()[key]}
+
+
+for _name, _documentation, _key in (
+        ("token_verifications_total", "Access tokens verified", "verifications"),
+        ("token_cache_hits_total", "Verifications answered from the token cache", "cache_hits"),
+        ("token_verification_failures_total", "Tokens that failed verification", "failures"),
+        ("token_verification_seconds_total", "Time spent verifying tokens", "total_seconds")):
+    registry.register(Collected(_name, _documentation, "counter", (),
+                                _stat(verification_stats, _key)))
+for _name, _documentation, _key in (
+        ("response_encoding_responses_total", "Responses re-encoded", "responses"),
+        ("response_encoding_bytes_in_total", "Bytes before encoding", "bytes_in"),
+        ("response_encoding_bytes_out_total", "Bytes after encoding", "bytes_out")):
+    registry.register(Collected(_name, _documentation, "counter", ("encoding",),
+                                _stat(encoding_stats, _key, by_encoding=True)))
+
+
+class RequestSQL:
+    __slots__ = ("scope", "queries", "seconds", "statements")
+
+    def __init__(self, scope: Optional[Scope] = None):
+        self.scope = scope  # the request's, to name the route its statements ran for
+        self.queries = 0
+        self.seconds = 0.0
+        # Executions per statement text; bound parameters aren't part of it,
+        # so repeats of one shape with different values share an entry
+        self.statements: Dict[str, int] = {}
+
+
+# Set by the middleware; the object is shared with threadpool copies of the context
+request_sql: ContextVar[Optional[RequestSQL]] = ContextVar("request_sql", default=None)
+
+
+@sql_timing.on_statement
+def _record_statement(timed: sql_timing.Statement) -> None:
+    query_duration.observe(timed.elapsed)
+    stats = request_sql.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.seconds += timed.elapsed
+        stats.statements[timed.statement] = stats.statements.get(timed.statement, 0) + 1
+
+
+def route_template(scope: Scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        sizes = [0, 0]  # request, response
+        status = [500]  # if the app fails before responding
+
+        async def counting_receive() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes[0] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes[1] += len(message.get("body", b""))
+            await send(message)
+
+        sql = RequestSQL(scope)
+        token = request_sql.set(sql)
+        requests_in_progress.inc((method,))
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            requests_in_progress.dec((method,))
+            request_sql.reset(token)
+            route = route_template(scope)
+            request_duration.observe(elapsed, (method, route, str(status[0])))
+            request_size.observe(sizes[0], (method, route))
+            response_size.observe(sizes[1], (method, route))
+            request_sql_queries.observe(sql.queries, (method, route))
+            request_sql_seconds.observe(sql.seconds, (method, route))
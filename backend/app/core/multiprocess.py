@@ -0,0 +1,153 @@
+"""
+Per-worker statistics shared with the other workers through files.
+
+Metrics and the slow query log are kept in memory by each worker process,
+so a scrape that lands on one worker would only see that worker's share,
+and whatever a worker counted is lost when it is recycled. With
+``settings.multiprocess_dir`` set (``app.server`` picks a fresh temporary
+directory when it isn't), every worker writes a snapshot of each shared
+kind of state to ``<dir>/<kind>/<pid>.json`` every
+``settings.multiprocess_flush_interval`` seconds, and a worker answering a
+scrape adds the snapshots of all the others to its own live state.
+
+When a worker exits its last snapshot is folded into ``archive.json``, so
+totals survive recycling; a worker that died without exiting cleanly is
+folded in by the next reader that notices its pid is gone. Each kind
+decides how to fold (gauges, for instance, are dropped). Snapshots of
+other live workers are at most one flush interval old.
+"""
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE = "archive"
+SUFFIX = ".json"
+
+# kind -> (snapshot of this process, fold(archive or None, retired snapshot))
+_kinds: Dict[str, Tuple[Callable[[], Any], Callable[[Optional[Any], Any], Any]]] = {}
+
+
+def enabled() -> bool:
+    return bool(settings.multiprocess_dir)
+
+
+def share(kind: str, snapshot: Callable[[], Any],
+          fold: Callable[[Optional[Any], Any], Any]) -> None:
+    """Write ``snapshot()`` for other workers to read; ``fold`` merges a retired one"""
+    _kinds[kind] = (snapshot, fold)
+
+
+def _directory(kind: str) -> str:
+    return os.path.join(settings.multiprocess_dir, kind)
+
+
+def _path(kind: str, name: str) -> str:
+    return os.path.join(_directory(kind), name + SUFFIX)
+
+
+@contextmanager
+def _locked(kind: str):
+    os.makedirs(_directory(kind), exist_ok=True)
+    with open(os.path.join(_directory(kind), ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _load(path: str) -> Optional[Any]:
+    try:
+        with open(path, encoding="utf-8") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning("Ignoring unreadable snapshot %s", path)
+        return None
+
+
+def _write(path: str, data: Any) -> None:
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def flush() -> None:
+    """Write this process's snapshot of every shared kind"""
+    if not enabled():
+        return
+    for kind, (snapshot, _) in _kinds.items():
+        os.makedirs(_directory(kind), exist_ok=True)
+        _write(_path(kind, str(os.getpid())), snapshot())
+
+
+def others(kind: str) -> List[Any]:
+    """Snapshots of every other worker, the retired ones folded into one"""
+    if not enabled():
+        return []
+    _, fold = _kinds[kind]
+    own = str(os.getpid())
+    snapshots = []
+    with _locked(kind):
+        archive = _load(_path(kind, ARCHIVE))
+        retired = False
+        for entry in os.scandir(_directory(kind)):
+            name = entry.name[:-len(SUFFIX)]
+            if not entry.name.endswith(SUFFIX) or name in (own, ARCHIVE) or not name.isdigit():
+                continue
+            data = _load(entry.path)
+            if data is None:
+                continue
+            if _alive(int(name)):
+                snapshots.append(data)
+            else:
+                archive, retired = fold(archive, data), True
+                os.remove(entry.path)
+        if retired:
+            _write(_path(kind, ARCHIVE), archive)
+    if archive is not None:
+        snapshots.append(archive)
+    return snapshots
+
+
+def retire() -> None:
+    """Fold this process's final snapshots into the archive (worker shutdown)"""
+    if not enabled():
+        return
+    for kind, (snapshot, fold) in _kinds.items():
+        with _locked(kind):
+            archive = fold(_load(_path(kind, ARCHIVE)), snapshot())
+            _write(_path(kind, ARCHIVE), archive)
+            try:
+                os.remove(_path(kind, str(os.getpid())))
+            except FileNotFoundError:
+                pass
+
+
+def clear() -> None:
+    """Remove every snapshot (server start, before workers fork)"""
+    if not enabled():
+        return
+    for kind in _kinds:
+        if os.path.isdir(_directory(kind)):
+            for entry in os.scandir(_directory(kind)):
+                if entry.name.endswith(SUFFIX):
+                    os.remove(entry.path)
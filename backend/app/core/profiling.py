@@ -0,0 +1,315 @@
+"""
+Sampling profiler for finding where a slow request spends its time.
+
+An admin profiles one request by sending it with ``X-Profile: 1`` (or
+``?_profile=1``). The token is checked with ``deps.get_current_admin``;
+anyone else gets the usual 401/403. The request then runs while a sampler
+thread records every ``settings.profiling_interval_ms`` the Python stack of
+each busy thread of the process, and the profile is stored under
+``settings.profile_dir`` before the last byte of the response is sent. The
+response carries ``X-Profile-Id``; fetch the profile with
+``GET /api/v1/admin/profiles/requests/{id}``.
+
+With ``settings.profiling_sample_percent`` set, that share of all requests
+is profiled continuously: their samples are added to one aggregate that is
+written to ``profile_dir/continuous`` every ``profiling_flush_interval``
+seconds. Old files are pruned by age and count.
+
+Profiles are in the folded format (``thread;module:caller;module:callee
+samples`` per line) that flamegraph.pl, speedscope and inferno read. The
+sampler sees threads, not requests, so requests served at the same time
+appear in each other's profiles as separate towers. It only runs while a
+profiled request is in flight, and a sample costs tens of microseconds per
+busy thread, so the overhead is bounded by the interval and the sampled
+share of requests. Each profile keeps at most ``profiling_max_stacks``
+distinct stacks.
+"""
+import logging
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from types import CodeType
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from fastapi import HTTPException, status
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import deps
+from app.core.config import settings
+from app.db.database import app_session
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+PROFILE_QUERY = "_profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+KINDS = ("requests", "continuous")
+SUFFIX = ".folded"
+MAX_DEPTH = 128
+TRUNCATED = "[other stacks]"
+_NAME = re.compile(r"^[0-9A-Za-z-]+$")
+# Leaf frames of threads waiting for work rather than doing any
+_IDLE = {("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get")}
+
+
+class Profile:
+    """Samples per folded stack, collected while registered with the sampler"""
+
+    def __init__(self, max_stacks: Optional[int] = None):
+        self.max_stacks = max_stacks or settings.profiling_max_stacks
+        self.samples = 0
+        self.stacks: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stacks: List[str]) -> None:
+        with self._lock:
+            self.samples += 1
+            for stack in stacks:
+                if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                    stack = TRUNCATED
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def drain(self) -> str:
+        """The folded profile so far; starts over empty"""
+        with self._lock:
+            stacks, self.stacks, self.samples = self.stacks, {}, 0
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+_labels: Dict[CodeType, Tuple[str, bool]] = {}
+
+
+def _label(frame) -> Tuple[str, bool]:
+    code = frame.f_code
+    label = _labels.get(code)
+    if label is None:
+        module = frame.f_globals.get("__name__", "?")
+        idle = (os.path.basename(code.co_filename), code.co_name) in _IDLE
+        label = _labels[code] = (f"{module}:{code.co_qualname}".replace(";", ","), idle)
+    return label
+
+
+def sample(exclude: Optional[int] = None) -> List[str]:
+    """The folded stack of every busy thread but ``exclude``, rooted at its name"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        if ident == exclude:
+            continue
+        name, idle = _label(frame)
+        if idle:
+            continue
+        frames = [name]
+        frame = frame.f_back
+        while frame is not None and len(frames) < MAX_DEPTH:
+            frames.append(_label(frame)[0])
+            frame = frame.f_back
+        frames.append(names.get(ident, "thread").replace(";", ","))
+        stacks.append(";".join(reversed(frames)))
+    return stacks
+
+
+class Sampler:
+    """One thread sampling the process for every registered profile"""
+
+    def __init__(self):
+        self._profiles: Dict[Profile, int] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, profile: Profile) -> None:
+        with self._lock:
+            self._profiles[profile] = self._profiles.get(profile, 0) + 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="profile-sampler", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, profile: Profile) -> None:
+        with self._lock:
+            references = self._profiles.pop(profile, 0) - 1
+            if references > 0:
+                self._profiles[profile] = references
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                profiles = list(self._profiles)
+            if not profiles:
+                self._wakeup.wait()
+                continue
+            stacks = sample(exclude=own)
+            for profile in profiles:
+                profile.add(stacks)
+            time.sleep(settings.profiling_interval_ms / 1000)
+
+
+sampler = Sampler()
+continuous = Profile()
+
+
+def _directory(kind: str) -> str:
+    return os.path.join(settings.profile_dir, kind)
+
+
+def _write(kind: str, name: str, folded: str) -> None:
+    directory = _directory(kind)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + SUFFIX)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        file.write(folded)
+    os.replace(path + ".tmp", path)
+
+
+def new_profile_id() -> str:
+    return f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{secrets.token_hex(4)}"
+
+
+def stored(kind: Optional[str] = None) -> List[dict]:
+    """Stored profiles, newest first"""
+    profiles = []
+    for folder in ([kind] if kind else KINDS):
+        try:
+            entries = list(os.scandir(_directory(folder)))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.endswith(SUFFIX):
+                info = entry.stat()
+                profiles.append({
+                    "kind": folder,
+                    "id": entry.name[:-len(SUFFIX)],
+                    "size": info.st_size,
+                    "created_at": datetime.fromtimestamp(info.st_mtime, timezone.utc),
+                })
+    profiles.sort(key=lambda profile: profile["created_at"], reverse=True)
+    return profiles
+
+
+def read(kind: str, profile_id: str) -> Optional[str]:
+    if kind not in KINDS or not _NAME.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(_directory(kind), profile_id + SUFFIX), encoding="utf-8") as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+
+
+def prune() -> int:
+    """Delete profiles past ``profiling_retention_hours`` or beyond ``profiling_max_files``"""
+    cutoff = time.time() - settings.profiling_retention_hours * 3600
+    removed = 0
+    for kind in KINDS:
+        for index, profile in enumerate(stored(kind)):
+            if index >= settings.profiling_max_files or profile["created_at"].timestamp() < cutoff:
+                try:
+                    os.remove(os.path.join(_directory(kind), profile["id"] + SUFFIX))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
+
+
+def flush() -> Optional[str]:
+    """Write the continuous aggregate collected since the last flush, then prune"""
+    folded = continuous.drain()
+    name = None
+    if folded:
+        name = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{os.getpid()}"
+        _write("continuous", name, folded)
+    prune()
+    return name
+
+
+def _requested(scope: Scope) -> bool:
+    if Headers(scope=scope).get(PROFILE_HEADER, "").lower() in ("1", "true"):
+        return True
+    query = scope.get("query_string", b"")
+    if PROFILE_QUERY.encode() not in query:
+        return False
+    values = parse_qs(query.decode("latin-1")).get(PROFILE_QUERY, [])
+    return any(value.lower() in ("1", "true") for value in values)
+
+
+def _authorize(scope: Scope) -> None:
+    """Raise the HTTPException get_current_admin would for this request's token"""
+    scheme, _, token = Headers(scope=scope).get("authorization", "").partition(" ")
+    with app_session(scope["app"]) as db:
+        user = deps.authenticate_token(db, token if scheme.lower() == "bearer" else None)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    deps.get_current_admin(user)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if _requested(scope):
+            try:
+                await run_in_threadpool(_authorize, scope)
+            except HTTPException as exc:
+                response = JSONResponse({"detail": exc.detail}, exc.status_code,
+                                        headers=exc.headers)
+                await response(scope, receive, send)
+                return
+            await self.profile(scope, receive, send)
+        elif settings.profiling_sample_percent and \
+                random.random() * 100 < settings.profiling_sample_percent:
+            sampler.start(continuous)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                sampler.stop(continuous)
+        else:
+            await self.app(scope, receive, send)
+
+    async def profile(self, scope: Scope, receive: Receive, send: Send) -> None:
+        profile = Profile()
+        profile_id = new_profile_id()
+        stored_profile = False
+
+        async def finish() -> None:
+            nonlocal stored_profile
+            if stored_profile:
+                return
+            stored_profile = True
+            sampler.stop(profile)
+            await run_in_threadpool(_write, "requests", profile_id, profile.drain())
+
+        async def profiling_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append(PROFILE_ID_HEADER, profile_id)
+            elif message["type"] == "http.response.body" and not message.get("more_body"):
+                # Stored before the client has the whole response
+                await finish()
+            await send(message)
+
+        sampler.start(profile)
+        try:
+            await self.app(scope, receive, profiling_send)
+        finally:
+            await finish()
+        logger.info("Profiled %s %s as %s", scope["method"], scope["path"], profile_id)
@@ -0,0 +1,115 @@
+"""
+Per-request SQL budgets and N+1 detection.
+
+Routes declare how many statements they may run with ``@query_budget(n)``
+(routes without one use ``settings.query_budget_default``, if set). Every
+request is also checked for N+1 patterns: the same SELECT, differing only
+in its bound parameters, run ``settings.query_repeat_threshold`` times or
+more.
+
+Statements are counted by app.core.metrics as app.core.sql_timing reports them;
+only those run inside this middleware count, so the idempotency lookup and
+claim that wrap a route aren't charged to its budget. The check runs when the response starts, after the body (and any lazy loads
+its serialization caused) is complete. With ``query_budget_mode`` set to
+"raise", as in development and tests, a violation raises
+``QueryBudgetExceeded`` so the request fails loudly; with "warn", a
+sampled fraction of violations is logged with the offending statement.
+Violations are always counted in ``http_request_query_budget_exceeded_total``.
+"""
+import logging
+import random
+from typing import Callable, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import metrics
+from app.core.sql_timing import is_read
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+budget_exceeded = metrics.registry.register(metrics.Counter(
+    "http_request_query_budget_exceeded_total",
+    "Requests over their SQL budget or repeating a statement", ("method", "route")))
+
+
+class QueryBudgetExceeded(RuntimeError):
+    pass
+
+
+def query_budget(limit: int) -> Callable[[Callable], Callable]:
+    """Allow the route at most ``limit`` SQL statements per request"""
+    def decorate(endpoint: Callable) -> Callable:
+        endpoint.__query_budget__ = limit
+        return endpoint
+    return decorate
+
+
+def violations(endpoint: Optional[Callable], sql: metrics.RequestSQL
+               ) -> Tuple[List[str], Optional[str]]:
+    """Problems with a request's statements, and the statement most to blame"""
+    problems = []
+    budget = getattr(endpoint, "__query_budget__", settings.query_budget_default)
+    if budget is not None and sql.queries > budget:
+        problems.append(f"ran {sql.queries} SQL statements, budget is {budget}")
+    repeated, count = max(
+        ((statement, count) for statement, count in sql.statements.items()
+         if is_read(statement)),
+        key=lambda item: item[1], default=(None, 0))
+    if count >= settings.query_repeat_threshold:
+        problems.append(f"ran the same SELECT {count} times (N+1?)")
+    elif problems:
+        # The most frequent statement, the latest one if none repeats
+        repeated = max(reversed(sql.statements), key=sql.statements.get, default=None)
+    return problems, repeated if problems else None
+
+
+class QueryBudgetMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or settings.query_budget_mode == "off":
+            await self.app(scope, receive, send)
+            return
+
+        # MetricsMiddleware usually started counting already, including
+        # statements of the middleware outside this one
+        sql = metrics.request_sql.get()
+        token = None
+        if sql is None:
+            sql = metrics.RequestSQL(scope)
+            token = metrics.request_sql.set(sql)
+        queries_before, statements_before = sql.queries, dict(sql.statements)
+        checked = False
+
+        async def checking_send(message: Message) -> None:
+            nonlocal checked
+            if message["type"] == "http.response.start" and not checked:
+                checked = True
+                own = metrics.RequestSQL(scope)
+                own.queries = sql.queries - queries_before
+                own.statements = {
+                    statement: count - statements_before.get(statement, 0)
+                    for statement, count in sql.statements.items()
+                    if count > statements_before.get(statement, 0)}
+                self.check(scope, own)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, checking_send)
+        finally:
+            if token is not None:
+                metrics.request_sql.reset(token)
+
+    def check(self, scope: Scope, sql: metrics.RequestSQL) -> None:
+        problems, statement = violations(scope.get("endpoint"), sql)
+        if not problems:
+            return
+        route = metrics.route_template(scope)
+        budget_exceeded.inc((scope["method"], route))
+        message = f"{scope['method']} {route} {' and '.join(problems)}: {statement}"
+        if settings.query_budget_mode == "raise":
+            raise QueryBudgetExceeded(message)
+        if random.random() < settings.query_budget_warn_sample_rate:
+            logger.warning("Query budget: %s", message)
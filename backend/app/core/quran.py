@@ -0,0 +1,119 @@
+"""
+Surah and ayah reference data.
+
+The 114 surahs and their ayah counts ship as ``app/data/surahs.csv`` and are
+loaded once at import into flat arrays:
+
+- ``AYAH_COUNTS[s]``: number of ayahs in surah ``s``
+- ``OFFSETS[s]``: global index of the ayah before surah ``s``'s first, so
+  ayah ``a`` of surah ``s`` is ``OFFSETS[s] + a`` (1..6236 over the mushaf)
+- ``SURAH_OF[i]``: the surah containing global ayah ``i``
+
+Every lookup is an array index. Recitations store the global indexes of
+their first and last ayah, so "who recited 2:255" is an integer range
+overlap that an index can answer, even across surah boundaries.
+
+Surah names arrive in many transliterations ("Al-Fatiha", "al-fatihah",
+"Fatiha", "Surah Al-Fatihah"); ``surah_number`` matches them on a
+normalized key built from the canonical name and the listed aliases.
+"""
+import csv
+import re
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+DATA_FILE = Path(__file__).resolve().parent.parent / "data" / "surahs.csv"
+
+SURAH_COUNT = 114
+AYAH_COUNT = 6236
+
+_ARTICLES = ("al", "an", "ar", "as", "at", "ad", "adh", "ash", "az", "aal", "ali")
+
+
+def normalize_name(name: str) -> str:
+    """Lookup key for a surah name: lowercase letters without the article"""
+    words = re.split(r"[\s\-_]+", name.strip().lower().replace("'", "").replace("`", ""))
+    words = [word for word in words if word]
+    if words and words[0] in ("surah", "surat", "sura"):
+        words = words[1:]
+    if len(words) > 1 and words[0] in _ARTICLES:
+        words = words[1:]
+    key = "".join(re.sub(r"[^a-z]", "", word) for word in words)
+    # "Al-Baqara" and "Al-Baqarah" are the same surah
+    if key.endswith("ah"):
+        key = key[:-1]
+    return key
+
+
+def _load() -> Tuple[List[str], "array[int]", "array[int]", "array[int]", Dict[str, int]]:
+    names = [""]
+    counts = array("H", [0])
+    lookup: Dict[str, int] = {}
+    with open(DATA_FILE, newline="", encoding="utf-8") as handle:
+        for row in csv.DictReader(handle):
+            number = int(row["number"])
+            if number != len(names):
+                raise ValueError(f"{DATA_FILE} is not in surah order at {number}")
+            names.append(row["name"])
+            counts.append(int(row["ayahs"]))
+            for spelling in [row["name"], *filter(None, row["aliases"].split("|"))]:
+                key = normalize_name(spelling)
+                if lookup.get(key, number) != number:
+                    raise ValueError(f"Surah name {spelling!r} is ambiguous")
+                lookup[key] = number
+
+    if len(names) - 1 != SURAH_COUNT or sum(counts) != AYAH_COUNT:
+        raise ValueError(f"{DATA_FILE} must list {SURAH_COUNT} surahs and {AYAH_COUNT} ayahs")
+
+    offsets = array("H", [0] * (SURAH_COUNT + 2))
+    surah_of = array("B", [0] * (AYAH_COUNT + 1))
+    for number in range(1, SURAH_COUNT + 1):
+        offsets[number + 1] = offsets[number] + counts[number]
+        for index in range(offsets[number] + 1, offsets[number + 1] + 1):
+            surah_of[index] = number
+    return names, counts, offsets, surah_of, lookup
+
+
+NAMES, AYAH_COUNTS, OFFSETS, SURAH_OF, _LOOKUP = _load()
+
+
+def surah_number(surah: Union[int, str]) -> Optional[int]:
+    """The number of a surah given by number or any known spelling of its name"""
+    if isinstance(surah, int):
+        return surah if 1 <= surah <= SURAH_COUNT else None
+    value = surah.strip()
+    if value.isdigit():
+        return surah_number(int(value))
+    return _LOOKUP.get(normalize_name(value))
+
+
+def surah_name(number: int) -> str:
+    return NAMES[number]
+
+
+def ayah_index(surah: int, ayah: int) -> int:
+    """Global index (1..6236) of ``surah:ayah``; the reference must be valid"""
+    return OFFSETS[surah] + ayah
+
+
+def ayah_ref(index: int) -> Tuple[int, int]:
+    """The (surah, ayah) at global index ``index``"""
+    surah = SURAH_OF[index]
+    return surah, index - OFFSETS[surah]
+
+
+def validate_range(surah: Union[int, str], ayah_start: int, ayah_end: int) -> int:
+    """
+    Check ``ayah_start``..``ayah_end`` lies within the surah and return the
+    surah's number. Raises ``ValueError`` with a user-facing message.
+    """
+    number = surah_number(surah)
+    if number is None:
+        raise ValueError(f"Unknown surah {surah!r}")
+    count = AYAH_COUNTS[number]
+    if not 1 <= ayah_start <= ayah_end:
+        raise ValueError("ayah_start must be at least 1 and not after ayah_end")
+    if ayah_end > count:
+        raise ValueError(f"Surah {NAMES[number]} has {count} ayahs")
+    return number
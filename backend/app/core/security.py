@@ -1,11 +1,131 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from app.core.config import settings
+from app.core.tracing import span
+
+try:
+    import jwt as pyjwt  # PyJWT, a leaner decoder than python-jose
+except ImportError:  # pragma: no cover - optional dependency
+    pyjwt = None
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+
+class TokenCache:
+    """LRU of verified JWT claims keyed by the token's SHA-256 digest.
+
+    Entries are dropped once the token's ``exp`` has passed, or once the key
+    that verified them is no longer configured for their ``kid``, so a cache
+    hit never extends a token's lifetime or outlives a retired key. When an
+    account changes, ``forget`` drops its entries; app.main runs it in every
+    worker for backplane invalidations in ``TOKEN_CACHE_NAMESPACE``.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: bytes) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            claims, expires_at, kid, key = entry
+            if expires_at <= time.time() or _signing_key(kid) != key:
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return claims
+
+    def put(self, digest: bytes, claims: dict, expires_at: float,
+            kid: Optional[str], key: str) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[digest] = (claims, expires_at, kid, key)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def forget(self, subject: str) -> None:
+        """Drop the cached verifications of every token for ``subject``"""
+        with self._lock:
+            for digest in [digest for digest, entry in self._entries.items()
+                           if entry[0].get("sub") == subject]:
+                del self._entries[digest]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class VerificationStats:
+    """Running totals of token verification cost."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.verifications = 0
+        self.cache_hits = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float, cache_hit: bool, ok: bool) -> None:
+        with self._lock:
+            self.verifications += 1
+            self.total_seconds += seconds
+            if seconds > self.max_seconds:
+                self.max_seconds = seconds
+            if cache_hit:
+                self.cache_hits += 1
+            if not ok:
+                self.failures += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            count = self.verifications
+            return {
+                "verifications": count,
+                "cache_hits": self.cache_hits,
+                "failures": self.failures,
+                "total_seconds": self.total_seconds,
+                "max_seconds": self.max_seconds,
+                "mean_seconds": self.total_seconds / count if count else 0.0,
+            }
+
+
+TOKEN_CACHE_NAMESPACE = "token_subject"
+token_cache = TokenCache(settings.token_cache_size)
+verification_stats = VerificationStats()
+
+
+def _use_pyjwt() -> bool:
+    if settings.jwt_backend == "jose":
+        return False
+    if settings.jwt_backend == "pyjwt" and pyjwt is None:
+        raise RuntimeError("jwt_backend is 'pyjwt' but PyJWT is not installed")
+    return pyjwt is not None
+
+
+def _signing_key(kid: Optional[str]) -> Optional[str]:
+    if kid is None:
+        return settings.secret_key
+    return settings.jwt_signing_keys.get(kid)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -13,8 +133,16 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
-    return encoded_jwt
+
+    kid = settings.jwt_active_kid
+    key = _signing_key(kid)
+    if key is None:
+        raise RuntimeError(f"No signing key configured for kid '{kid}'")
+    headers = {"kid": kid} if kid else None
+
+    if _use_pyjwt():
+        return pyjwt.encode(to_encode, key, algorithm=settings.algorithm, headers=headers)
+    return jwt.encode(to_encode, key, algorithm=settings.algorithm, headers=headers)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -22,12 +150,55 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
-def verify_token(token: str) -> Optional[str]:
+
+def _decode(token: str) -> Tuple[Optional[dict], Optional[str], Optional[str]]:
+    """(claims, kid, key) of a valid token; claims are None if it isn't"""
+    if _use_pyjwt():
+        try:
+            kid = pyjwt.get_unverified_header(token).get("kid")
+            key = _signing_key(kid)
+            if key is None:
+                return None, kid, None
+            return pyjwt.decode(token, key, algorithms=[settings.algorithm]), kid, key
+        except pyjwt.PyJWTError:
+            return None, None, None
     try:
-        payload = jwt.decode(token, settings.secret_key, algorithms=[settings.algorithm])
-        username: str = payload.get("sub")
-        if username is None:
-            return None
-        return username
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = _signing_key(kid)
+        if key is None:
+            return None, kid, None
+        return jwt.decode(token, key, algorithms=[settings.algorithm]), kid, key
     except JWTError:
+        return None, None, None
+
+
+def decode_token(token: str) -> Optional[dict]:
+    """
+    Return the verified claims of a token, or None if it is invalid.
+
+    Verified claims are cached until the token expires, so repeated requests
+    with the same bearer token skip the signature check. The returned dict
+    is shared with the cache and must not be mutated.
+    """
+    start = time.perf_counter()
+    digest = hashlib.sha256(token.encode()).digest()
+    claims = token_cache.get(digest)
+    cache_hit = claims is not None
+    if claims is None:
+        claims, kid, key = _decode(token)
+        if claims is not None and isinstance(claims.get("exp"), (int, float)):
+            token_cache.put(digest, claims, float(claims["exp"]), kid, key)
+    verification_stats.record(
+        time.perf_counter() - start, cache_hit, claims is not None)
+    return claims
+
+
+def verify_token(token: str) -> Optional[str]:
+    with span("auth.verify_token"):
+        payload = decode_token(token)
+    if payload is None:
+        return None
+    username: str = payload.get("sub")
+    if username is None:
         return None
+    return username
@@ -0,0 +1,68 @@
+"""
+Fast JSON encoding for list endpoints.
+
+When ``settings.fast_list_responses`` is enabled, list endpoints select plain
+column tuples instead of ORM objects and encode them straight to bytes with
+orjson (or pydantic-core's serializer when orjson is not installed),
+skipping per-item model validation and the stdlib JSON encoder. Both
+encoders produce the same output as the regular response_model path.
+"""
+from decimal import Decimal
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Type
+
+from fastapi import Response
+from pydantic import BaseModel
+from pydantic_core import to_json
+
+from app.core.config import settings
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, Decimal):
+        # Pydantic renders Decimal as a string in JSON mode; match it
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_UTC_Z)
+    return to_json(content)
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def fast_responses_enabled() -> bool:
+    return settings.fast_list_responses
+
+
+@lru_cache(maxsize=None)
+def schema_columns(model: type, schema: Type[BaseModel]) -> tuple:
+    """Mapped columns of ``model`` that back the fields of ``schema``"""
+    column_names = set(model.__table__.columns.keys())
+    return tuple(
+        getattr(model, name) for name in schema.model_fields
+        if name in column_names
+    )
+
+
+def row_dicts(rows: Iterable) -> List[Dict[str, Any]]:
+    return [row._asdict() for row in rows]
+
+
+def group_rows(rows: Iterable[Dict[str, Any]], key: str) -> Dict[Any, List[Dict[str, Any]]]:
+    grouped: Dict[Any, List[Dict[str, Any]]] = {}
+    for row in rows:
+        grouped.setdefault(row[key], []).append(row)
+    return grouped
@@ -0,0 +1,261 @@
+"""
+Slow query log.
+
+app.core.sql_timing times every statement. One that takes longer than
+``settings.slow_query_ms`` is logged with its normalized SQL (literals and
+placeholders become ``?``, IN lists and multi-row VALUES collapse), the
+types of its bound parameters (never their values) and the route of the
+request it ran for, and is added to per-fingerprint totals that
+``GET /api/v1/admin/slow-queries`` lists worst first.
+
+On Postgres, the first ``settings.slow_query_explain_limit`` slow runs of
+each fingerprint also get their plan: ``EXPLAIN (FORMAT JSON)`` of the same
+SELECT with the same parameters, run on a background thread and a
+separate connection so the request doesn't wait for it. EXPLAIN without
+ANALYZE only plans the statement.
+
+Totals are kept per worker process for at most
+``settings.slow_query_max_fingerprints`` fingerprints; when full, the one
+with the least total time makes room. With ``settings.multiprocess_dir``
+set, the listing merges in the totals of every other worker, live or
+retired, shared through app.core.multiprocess.
+"""
+import hashlib
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.engine import Engine
+
+from app.core import metrics, multiprocess, sql_timing
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_ROUTE = "background"
+MAX_ROUTES = 10  # kept per fingerprint
+MAX_SHAPES = 5
+MAX_PENDING_EXPLAINS = 10
+_EXPLAINING = "slow_query_explaining"
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.IGNORECASE)
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|\$\d+|(?<!:):\w+")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_VALUES = re.compile(r"\((\?(?:, \?)*)\)(?:\s*,\s*\(\1\))+")
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(statement: str) -> str:
+    """``statement`` with its values replaced, so runs of one query share a fingerprint"""
+    text = _STRING.sub("?", statement)
+    text = _PLACEHOLDER.sub("?", text)
+    text = _NUMBER.sub("?", text)
+    text = _SPACE.sub(" ", text).strip()
+    text = _IN_LIST.sub("IN (...)", text)
+    return _VALUES.sub(r"(\1), ...", text)
+
+
+def fingerprint(normalized: str) -> str:
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def _types(values) -> str:
+    names: List[List] = []
+    for value in values:
+        name = type(value).__name__
+        if names and names[-1][0] == name:
+            names[-1][1] += 1
+        else:
+            names.append([name, 1])
+    return ", ".join(name if count == 1 else f"{name}*{count}" for name, count in names)
+
+
+def parameter_shape(parameters, executemany: bool = False) -> str:
+    """Bound parameter types, e.g. ``(int, str*3)`` or ``{name: str}``"""
+    if executemany and parameters:
+        return f"{parameter_shape(parameters[0])} x{len(parameters)}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}"
+                               for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return f"({_types(parameters)})"
+    return type(parameters).__name__
+
+
+class _Entry:
+    __slots__ = ("statement", "calls", "total_seconds", "max_seconds", "last_seen",
+                 "routes", "parameter_shapes", "explains", "plans")
+
+    def __init__(self, statement: str):
+        self.statement = statement
+        self.calls = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seen: Optional[datetime] = None
+        self.routes: Dict[str, int] = {}
+        self.parameter_shapes: List[str] = []
+        self.explains = 0  # plans requested, captured or not
+        self.plans: List[Any] = []
+
+
+_entries: Dict[str, _Entry] = {}
+_lock = threading.Lock()
+_pending_explains = 0
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _route() -> str:
+    sql = metrics.request_sql.get()
+    if sql is None or sql.scope is None:
+        return BACKGROUND_ROUTE
+    return f"{sql.scope['method']} {metrics.route_template(sql.scope)}"
+
+
+def _explain(engine: Engine, key: str, statement: str, parameters) -> None:
+    global _pending_explains
+    try:
+        with engine.connect() as connection:
+            connection.info[_EXPLAINING] = True
+            try:
+                plan = connection.exec_driver_sql(
+                    "EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+            finally:
+                connection.info.pop(_EXPLAINING, None)
+                connection.rollback()
+        with _lock:
+            entry = _entries.get(key)
+            if entry is not None:
+                entry.plans.append(plan)
+    except Exception:
+        logger.warning("Could not EXPLAIN slow query %s", key, exc_info=True)
+    finally:
+        with _lock:
+            _pending_explains -= 1
+
+
+def record(conn, statement: str, parameters, executemany: bool, elapsed: float) -> None:
+    global _executor, _pending_explains
+    normalized = normalize(statement)
+    key = fingerprint(normalized)
+    route = _route()
+    shape = parameter_shape(parameters, executemany)
+    explain = False
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            if len(_entries) >= settings.slow_query_max_fingerprints:
+                del _entries[min(_entries, key=lambda k: _entries[k].total_seconds)]
+            entry = _entries[key] = _Entry(normalized)
+        entry.calls += 1
+        entry.total_seconds += elapsed
+        entry.max_seconds = max(entry.max_seconds, elapsed)
+        entry.last_seen = datetime.now(timezone.utc)
+        if route in entry.routes or len(entry.routes) < MAX_ROUTES:
+            entry.routes[route] = entry.routes.get(route, 0) + 1
+        if shape not in entry.parameter_shapes and len(entry.parameter_shapes) < MAX_SHAPES:
+            entry.parameter_shapes.append(shape)
+        if (conn.dialect.name == "postgresql" and sql_timing.is_read(statement)
+                and entry.explains < settings.slow_query_explain_limit
+                and _pending_explains < MAX_PENDING_EXPLAINS):
+            entry.explains += 1
+            _pending_explains += 1
+            explain = True
+            if _executor is None:
+                _executor = ThreadPoolExecutor(1, thread_name_prefix="slow-query-explain")
+
+    logger.warning("Slow query (%.1f ms, %s) %s: %s %s",
+                   elapsed * 1000, route, key, normalized, shape)
+    if explain:
+        _executor.submit(_explain, conn.engine, key, statement, parameters)
+
+
+@sql_timing.on_statement
+def _check_statement(timed: sql_timing.Statement) -> None:
+    if timed.elapsed * 1000 >= settings.slow_query_ms and timed.error is None \
+            and not timed.conn.info.get(_EXPLAINING):
+        record(timed.conn, timed.statement, timed.parameters, timed.executemany, timed.elapsed)
+
+
+ORDERS = {
+    "total": lambda entry: entry["total_seconds"],
+    "max": lambda entry: entry["max_seconds"],
+    "calls": lambda entry: entry["calls"],
+}
+
+
+def snapshot() -> Dict[str, dict]:
+    """This process's totals per fingerprint, JSON-friendly"""
+    with _lock:
+        return {key: {
+            "statement": entry.statement,
+            "calls": entry.calls,
+            "total_seconds": entry.total_seconds,
+            "max_seconds": entry.max_seconds,
+            "last_seen": entry.last_seen.isoformat() if entry.last_seen else None,
+            "routes": dict(entry.routes),
+            "parameter_shapes": list(entry.parameter_shapes),
+            "plans": list(entry.plans),
+        } for key, entry in _entries.items()}
+
+
+def merge(into: Optional[Dict[str, dict]], other: Dict[str, dict]) -> Dict[str, dict]:
+    """Add ``other``'s totals to ``into``, per fingerprint"""
+    into = into or {}
+    for key, entry in other.items():
+        totals = into.get(key)
+        if totals is None:
+            into[key] = {**entry, "routes": dict(entry["routes"]),
+                         "parameter_shapes": list(entry["parameter_shapes"]),
+                         "plans": list(entry["plans"])}
+            continue
+        totals["calls"] += entry["calls"]
+        totals["total_seconds"] += entry["total_seconds"]
+        totals["max_seconds"] = max(totals["max_seconds"], entry["max_seconds"])
+        totals["last_seen"] = max(filter(None, (totals["last_seen"], entry["last_seen"])),
+                                  default=None)
+        for route, calls in entry["routes"].items():
+            if route in totals["routes"] or len(totals["routes"]) < MAX_ROUTES:
+                totals["routes"][route] = totals["routes"].get(route, 0) + calls
+        for shape in entry["parameter_shapes"]:
+            if shape not in totals["parameter_shapes"] and \
+                    len(totals["parameter_shapes"]) < MAX_SHAPES:
+                totals["parameter_shapes"].append(shape)
+        room = settings.slow_query_explain_limit - len(totals["plans"])
+        totals["plans"].extend(entry["plans"][:max(room, 0)])
+    if len(into) > settings.slow_query_max_fingerprints:
+        kept = sorted(into, key=lambda key: into[key]["total_seconds"], reverse=True)
+        into = {key: into[key] for key in kept[:settings.slow_query_max_fingerprints]}
+    return into
+
+
+multiprocess.share("slow_queries", snapshot, merge)
+
+
+def top(limit: int = 20, order: str = "total") -> List[dict]:
+    """The worst fingerprints by total time, slowest run or number of slow runs"""
+    totals = snapshot()
+    for other in multiprocess.others("slow_queries"):
+        totals = merge(totals, other)
+    entries = sorted(totals.items(), key=lambda item: ORDERS[order](item[1]),
+                     reverse=True)[:limit]
+    return [{
+        "fingerprint": key,
+        "statement": entry["statement"],
+        "calls": entry["calls"],
+        "total_ms": entry["total_seconds"] * 1000,
+        "mean_ms": entry["total_seconds"] * 1000 / entry["calls"],
+        "max_ms": entry["max_seconds"] * 1000,
+        "last_seen": entry["last_seen"],
+        "routes": entry["routes"],
+        "parameter_shapes": entry["parameter_shapes"],
+        "plans": entry["plans"],
+    } for key, entry in entries]
+
+
+def reset() -> None:
+    with _lock:
+        _entries.clear()
@@ -0,0 +1,82 @@
+"""
+One timer for every SQL statement.
+
+Engine cursor events note when each statement starts and, once it has run
+or failed (``handle_error``), hand a ``Statement`` with its duration to the
+observers registered with ``on_statement``: request metrics and query
+budgets (app.core.metrics), the slow query log and tracing spans. Start
+times are kept per execution context on the connection, so a failed
+statement doesn't leave one behind for the next statement to pick up.
+"""
+import logging
+import time
+from typing import Callable, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_STARTS = "sql_timing_starts"
+
+
+class Statement:
+    __slots__ = ("conn", "statement", "parameters", "executemany", "start_ns",
+                 "elapsed", "error")
+
+    def __init__(self, conn, statement: str, parameters, executemany: bool,
+                 start_ns: int, elapsed: float, error: Optional[BaseException] = None):
+        self.conn = conn
+        self.statement = statement
+        self.parameters = parameters
+        self.executemany = executemany
+        self.start_ns = start_ns  # wall clock, for spans
+        self.elapsed = elapsed  # seconds
+        self.error = error
+
+
+Observer = Callable[[Statement], None]
+_observers: List[Observer] = []
+
+
+def on_statement(observer: Observer) -> Observer:
+    """Call ``observer(statement)`` after every statement; usable as a decorator"""
+    _observers.append(observer)
+    return observer
+
+
+def is_read(statement: str) -> bool:
+    return statement.lstrip()[:6].upper() in ("SELECT", "WITH")
+
+
+def _finish(conn, context, statement: str, parameters, executemany: bool,
+            error: Optional[BaseException] = None) -> None:
+    started = conn.info.get(_STARTS, {}).pop(context, None)
+    if started is None:
+        return  # Failed before it reached the cursor
+    start, start_ns = started
+    timed = Statement(conn, statement, parameters, executemany, start_ns,
+                      time.perf_counter() - start, error)
+    for observer in _observers:
+        try:
+            observer(timed)
+        except Exception:
+            logger.exception("SQL statement observer %r failed", observer)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start(conn, cursor, statement, parameters, context, executemany) -> None:
+    conn.info.setdefault(_STARTS, {})[context] = (time.perf_counter(), time.time_ns())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end(conn, cursor, statement, parameters, context, executemany) -> None:
+    _finish(conn, context, statement, parameters, executemany)
+
+
+@event.listens_for(Engine, "handle_error")
+def _failed(exception_context) -> None:
+    conn = exception_context.connection
+    if conn is not None and exception_context.statement is not None:
+        _finish(conn, exception_context.execution_context, exception_context.statement,
+                exception_context.parameters, False, exception_context.original_exception)
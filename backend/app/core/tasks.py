@@ -0,0 +1,135 @@
+"""
+Periodic background jobs run inside each API process.
+
+Jobs are plain synchronous functions executed in the threadpool at a fixed
+interval; failures are logged and the job keeps its schedule. Sweepers of
+expired rows delete them with ``delete_in_batches``.
+
+Every worker process starts the same jobs. One that only needs doing once
+across the deployment (a full-table recount, say) is wrapped with
+``exclusive``: on Postgres it runs only in the process holding a session
+advisory lock named after it, which is kept on a dedicated connection, so
+another process takes over when that one exits. Elsewhere there is a
+single process and the job always runs.
+"""
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional
+
+from sqlalchemy import delete, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.db.database import engine
+
+logger = logging.getLogger(__name__)
+
+_tasks: Dict[str, asyncio.Task] = {}
+_leases: Dict[str, Connection] = {}
+
+
+async def _run_periodically(name: str, interval: float, job: Callable[[], object]) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await run_in_threadpool(job)
+        except Exception:
+            logger.exception("Background job %s failed", name)
+
+
+def start_periodic(name: str, interval: float, job: Callable[[], object]) -> None:
+    """Run ``job`` every ``interval`` seconds until stop_all() is called"""
+    if name in _tasks and not _tasks[name].done():
+        return
+    _tasks[name] = asyncio.get_running_loop().create_task(
+        _run_periodically(name, interval, job))
+
+
+def _lock_key(name: str) -> int:
+    return int.from_bytes(hashlib.sha256(name.encode()).digest()[:8], "big", signed=True)
+
+
+def _holds_lease(name: str) -> bool:
+    if engine.dialect.name != "postgresql":
+        return True
+    connection = _leases.get(name)
+    if connection is not None:
+        try:
+            connection.execute(text("SELECT 1")).scalar()
+            connection.commit()
+            return True
+        except Exception:
+            # The connection, and with it the lock, is gone: compete again
+            _leases.pop(name, None)
+            connection.invalidate()
+    connection = engine.connect()
+    try:
+        acquired = connection.execute(
+            text("SELECT pg_try_advisory_lock(:key)"), {"key": _lock_key(name)}).scalar()
+        connection.commit()
+    except Exception:
+        connection.close()
+        raise
+    if not acquired:
+        connection.close()
+        return False
+    _leases[name] = connection
+    return True
+
+
+def exclusive(name: str, job: Callable[[], object]) -> Callable[[], object]:
+    """``job``, run only by the one process holding the lease on ``name``"""
+    def run():
+        if _holds_lease(name):
+            return job()
+        return None
+    return run
+
+
+def _release_leases() -> None:
+    for name, connection in list(_leases.items()):
+        del _leases[name]
+        try:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"),
+                               {"key": _lock_key(name)})
+            connection.commit()
+            connection.close()
+        except Exception:
+            connection.invalidate()
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def delete_in_batches(db: Session, model, *criteria, batch_size: Optional[int] = None) -> int:
+    """
+    Delete the rows of ``model`` matching ``criteria``, ``batch_size`` (by
+    default ``settings.sweep_batch_size``) per statement and transaction, so
+    a large backlog never holds long locks; returns the number removed
+    """
+    batch_size = batch_size or settings.sweep_batch_size
+    removed = 0
+    while True:
+        batch = select(model.id).where(*criteria).limit(batch_size).scalar_subquery()
+        result = db.execute(
+            delete(model).where(model.id.in_(batch)),
+            execution_options={"synchronize_session": False},
+        )
+        db.commit()
+        removed += result.rowcount
+        if result.rowcount < batch_size:
+            return removed
+
+
+async def stop_all() -> None:
+    tasks = list(_tasks.values())
+    _tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await run_in_threadpool(_release_leases)
@@ -0,0 +1,421 @@
+"""
+Request tracing.
+
+A sampled request gets a root span from ``TracingMiddleware`` and child
+spans for its phases:
+
+- ``auth.verify_token`` and ``auth.user_lookup`` (app.core.security, app.core.deps)
+- ``db.query``, one per statement, as app.core.sql_timing reports them
+- ``endpoint``, the route function itself
+- ``response.serialize``, from the endpoint's return to the response start
+  (validation against the response model and JSON rendering)
+- ``response.encode``, compression and MessagePack (app.core.encoding)
+
+Other code adds spans with ``with tracing.span("name"):``; outside a
+sampled request that is a context variable lookup.
+
+A W3C ``traceparent`` header (as forwarded by nginx) continues the caller's
+trace. Its sampling decision is only honored when the request comes from
+one of ``settings.tracing_trusted_proxies``, so clients can't force every
+request to be traced; everything else is sampled at
+``settings.tracing_sample_rate``. Finished traces are queued and a
+background thread hands them in batches to the exporter named by
+``settings.tracing_exporter``: "none" (tracing off), "jsonl" (one span per
+line in ``tracing_jsonl_path``) or "otlp" (OTLP/HTTP JSON to
+``tracing_otlp_endpoint``). When the queue is full, traces are dropped
+rather than slowing requests down.
+
+Route spans are added by ``instrument(app)`` once every route is
+registered.
+"""
+import asyncio
+import functools
+import ipaddress
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional
+
+from fastapi.routing import APIRoute
+from starlette.datastructures import Headers
+from starlette.routing import request_response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core import sql_timing
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# OTLP span kinds
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+MAX_STATEMENT_LENGTH = 2000
+EXPORT_BATCH = 512
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "endpoint_end_ns")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []  # finished ones
+        self.endpoint_end_ns: Optional[int] = None
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str] = None,
+                 kind: int = INTERNAL, attributes: Optional[dict] = None,
+                 start_ns: Optional[int] = None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    def child(self, name: str, kind: int = INTERNAL, attributes: Optional[dict] = None,
+              start_ns: Optional[int] = None) -> "Span":
+        return Span(self.trace, name, self.span_id, kind, attributes, start_ns)
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+            self.trace.spans.append(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+# The innermost open span of a sampled request; None when not tracing
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name: str, kind: int = INTERNAL, **attributes) -> Iterator[Optional[Span]]:
+    """A child of the current span, or nothing when the request isn't sampled"""
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, kind, attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as exc:
+        child.error = f"{type(exc).__name__}: {exc}"
+        raise
+    finally:
+        current_span.reset(token)
+        child.end()
+
+
+# Exporters
+
+class NoopExporter:
+    def export(self, spans: List[Span]) -> None:
+        pass
+
+
+class JsonLinesExporter:
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or settings.tracing_jsonl_path
+
+    def export(self, spans: List[Span]) -> None:
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.writelines(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict) -> List[dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items()]
+
+
+def otlp_payload(spans: List[Span]) -> dict:
+    """``spans`` as an OTLP/HTTP JSON ExportTraceServiceRequest"""
+    encoded = []
+    for span in spans:
+        item = {
+            "traceId": span.trace.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": span.kind,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": _otlp_attributes(span.attributes),
+        }
+        if span.parent_id:
+            item["parentSpanId"] = span.parent_id
+        if span.error:
+            item["status"] = {"code": 2, "message": span.error}
+        encoded.append(item)
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attributes(
+            {"service.name": settings.tracing_service_name})},
+        "scopeSpans": [{"scope": {"name": __name__}, "spans": encoded}],
+    }]}
+
+
+class OtlpHttpExporter:
+    def __init__(self, endpoint: Optional[str] = None, timeout: float = 10.0):
+        self.endpoint = endpoint or settings.tracing_otlp_endpoint
+        self.timeout = timeout
+
+    def export(self, spans: List[Span]) -> None:
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(otlp_payload(spans)).encode(),
+            headers={"Content-Type": "application/json"}, method="POST")
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+EXPORTERS: Dict[str, Callable[[], object]] = {
+    "none": NoopExporter,
+    "jsonl": JsonLinesExporter,
+    "otlp": OtlpHttpExporter,
+}
+
+
+def enabled() -> bool:
+    return settings.tracing_exporter != "none"
+
+
+class BatchProcessor:
+    """Queues finished traces and exports them from a background thread"""
+
+    def __init__(self):
+        self._queue: Optional[queue.Queue] = None
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.dropped = 0
+
+    def submit(self, trace: Trace) -> None:
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue(settings.tracing_queue_size)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="trace-exporter",
+                                                daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(settings.tracing_export_interval)
+            self.flush()
+
+    def flush(self) -> None:
+        """Export everything queued so far"""
+        if self._queue is None:
+            return
+        with self._export_lock:
+            spans: List[Span] = []
+            while True:
+                try:
+                    spans.extend(self._queue.get_nowait().spans)
+                except queue.Empty:
+                    break
+            for start in range(0, len(spans), EXPORT_BATCH):
+                try:
+                    EXPORTERS[settings.tracing_exporter]().export(
+                        spans[start:start + EXPORT_BATCH])
+                except Exception:
+                    logger.warning("Exporting %d spans failed",
+                                   len(spans[start:start + EXPORT_BATCH]), exc_info=True)
+
+
+processor = BatchProcessor()
+
+
+def flush() -> None:
+    processor.flush()
+
+
+def _parse_traceparent(value: str):
+    """(trace id, parent span id, sampled) of a W3C traceparent header, or None"""
+    match = _TRACEPARENT.match(value.strip().lower())
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+def _trusted_peer(scope: Scope) -> bool:
+    """Whether the peer is listed in ``settings.tracing_trusted_proxies``"""
+    host = (scope.get("client") or (None,))[0]
+    if host is None:
+        return False
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return host in settings.tracing_trusted_proxies
+    for entry in settings.tracing_trusted_proxies:
+        try:
+            if address in ipaddress.ip_network(entry, strict=False):
+                return True
+        except ValueError:
+            continue
+    return False
+
+
+class TracingMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not enabled():
+            await self.app(scope, receive, send)
+            return
+
+        parent = _parse_traceparent(Headers(scope=scope).get("traceparent", ""))
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            if not _trusted_peer(scope):
+                sampled = random.random() < settings.tracing_sample_rate
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = random.random() < settings.tracing_sample_rate
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        root = Span(Trace(trace_id), scope["method"], parent_id, SERVER, {
+            "http.method": scope["method"],
+            "http.target": scope["path"],
+        })
+        status = [500]
+
+        async def tracing_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        token = current_span.set(root)
+        try:
+            await self.app(scope, receive, tracing_send)
+        except BaseException as exc:
+            root.error = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            current_span.reset(token)
+            # The matched route's template, as in app.core.metrics
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            root.name = f"{scope['method']} {route}"
+            root.attributes["http.route"] = route
+            root.attributes["http.status_code"] = status[0]
+            if status[0] >= 500 and root.error is None:
+                root.error = f"HTTP {status[0]}"
+            root.end()
+            processor.submit(root.trace)
+
+
+# Database statements
+
+@sql_timing.on_statement
+def _query_span(timed: sql_timing.Statement) -> None:
+    parent = current_span.get()
+    if parent is None:
+        return
+    query = parent.child("db.query", CLIENT, {
+        "db.system": timed.conn.dialect.name,
+        "db.statement": timed.statement[:MAX_STATEMENT_LENGTH],
+    }, start_ns=timed.start_ns)
+    if timed.error is not None:
+        query.error = f"{type(timed.error).__name__}: {timed.error}"
+    query.end(timed.start_ns + int(timed.elapsed * 1e9))
+
+
+# Route functions and response serialization
+
+def _traced_call(call: Callable) -> Callable:
+    attributes = {"code.function": getattr(call, "__qualname__", repr(call))}
+
+    def finished(parent: Span) -> None:
+        parent.trace.endpoint_end_ns = time.time_ns()
+
+    if asyncio.iscoroutinefunction(call):
+        @functools.wraps(call)
+        async def traced(*args, **kwargs):
+            parent = current_span.get()
+            if parent is None:
+                return await call(*args, **kwargs)
+            with span("endpoint", **attributes):
+                result = await call(*args, **kwargs)
+            finished(parent)
+            return result
+    else:
+        @functools.wraps(call)
+        def traced(*args, **kwargs):
+            parent = current_span.get()
+            if parent is None:
+                return call(*args, **kwargs)
+            with span("endpoint", **attributes):
+                result = call(*args, **kwargs)
+            finished(parent)
+            return result
+    traced.__traced__ = True
+    return traced
+
+
+def _traced_route_app(app: ASGIApp) -> ASGIApp:
+    async def traced(scope: Scope, receive: Receive, send: Send) -> None:
+        parent = current_span.get()
+        if parent is None:
+            await app(scope, receive, send)
+            return
+
+        async def serialized_send(message: Message) -> None:
+            ended = parent.trace.endpoint_end_ns
+            if message["type"] == "http.response.start" and ended is not None:
+                parent.trace.endpoint_end_ns = None
+                parent.child("response.serialize", start_ns=ended).end()
+            await send(message)
+
+        await app(scope, receive, serialized_send)
+    return traced
+
+
+def instrument(app) -> None:
+    """Add endpoint and serialization spans to every API route of ``app``"""
+    for route in app.routes:
+        if isinstance(route, APIRoute) and not getattr(route.dependant.call, "__traced__", False):
+            route.dependant.call = _traced_call(route.dependant.call)
+            route.app = _traced_route_app(request_response(route.get_route_handler()))
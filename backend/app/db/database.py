@@ -1,3 +1,4 @@
+from contextlib import contextmanager
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -14,3 +15,19 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+@contextmanager
+def app_session(app):
+    """
+    Session from the app's get_db provider, for code that runs outside
+    dependency injection (middleware, streaming and WebSocket handlers).
+    Honours app.dependency_overrides so tests get their own database.
+    """
+    provider = app.dependency_overrides.get(get_db, get_db)
+    sessions = provider()
+    db = next(sessions)
+    try:
+        yield db
+    finally:
+        sessions.close()
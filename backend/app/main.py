@@ -1,6 +1,14 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from starlette.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
+from app.core.encoding import ResponseEncodingMiddleware
+from app.core.idempotency import IdempotencyMiddleware, purge_expired_records
+from app.core import metrics, profiling, slow_queries  # noqa: F401 - registers engine events
+from app.core.query_budget import QueryBudgetMiddleware
+from app.core import multiprocess, tasks, tracing
+from app.core.security import TOKEN_CACHE_NAMESPACE, token_cache
+from app.services import assignments, backplane, counters, invitations, stream_tickets
 from app.api.api_v1.api import api_router
 from app.db.init_db import create_tables, create_initial_data
 from app.db.database import SessionLocal
@@ -11,6 +19,16 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Cached token verifications of a changed account are dropped in every worker
+backplane.backplane.on_invalidate(TOKEN_CACHE_NAMESPACE, token_cache.forget)
+
+# Fail (or warn about) requests over their SQL budget or repeating a SELECT.
+# Innermost, so the idempotency layer's own statements aren't counted
+app.add_middleware(QueryBudgetMiddleware)
+
+# Replay stored responses for retried POST/PUT requests with an Idempotency-Key
+app.add_middleware(IdempotencyMiddleware)
+
 # Set up CORS
 app.add_middleware(
     CORSMiddleware,
@@ -24,6 +42,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Negotiated gzip/brotli compression and MessagePack bodies
+app.add_middleware(
+    ResponseEncodingMiddleware,
+    minimum_size=settings.compression_min_size,
+    gzip_level=settings.gzip_level,
+    brotli_quality=settings.brotli_quality,
+)
+
+# Times and sizes what the client actually gets
+if settings.metrics_enabled:
+    app.add_middleware(metrics.MetricsMiddleware)
+
+# Root span of sampled requests, propagated from an upstream traceparent
+app.add_middleware(tracing.TracingMiddleware)
+
+# Outermost, so profiles cover every middleware and its admin check isn't
+# counted in the request's metrics
+app.add_middleware(profiling.ProfilingMiddleware)
+
 # Include API router
 app.include_router(api_router, prefix="/api/v1")
 
@@ -31,6 +68,8 @@ app.include_router(api_router, prefix="/api/v1")
 @app.on_event("startup")
 async def startup_event():
     """Initialize database on startup"""
+    if not settings.init_db_on_startup:
+        return
     create_tables()
     db = SessionLocal()
     try:
@@ -39,6 +78,34 @@ async def startup_event():
         db.close()
 
 
+@app.on_event("startup")
+async def start_background_tasks():
+    backplane.start()
+    await run_in_threadpool(assignments.start)
+    tasks.start_periodic(
+        "idempotency-sweeper", settings.idempotency_sweep_interval, purge_expired_records)
+    tasks.start_periodic(
+        "counter-reconciler", settings.counter_check_interval,
+        tasks.exclusive("counter-reconciler", counters.reconcile))
+    tasks.start_periodic(
+        "invitation-sweeper", settings.invitation_sweep_interval, invitations.sweep)
+    tasks.start_periodic(
+        "stream-ticket-sweeper", settings.events_ticket_sweep_interval, stream_tickets.sweep)
+    tasks.start_periodic(
+        "profile-flusher", settings.profiling_flush_interval, profiling.flush)
+    if multiprocess.enabled():
+        tasks.start_periodic(
+            "stats-sharer", settings.multiprocess_flush_interval, multiprocess.flush)
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await tasks.stop_all()
+    await run_in_threadpool(tracing.flush)
+    await run_in_threadpool(multiprocess.retire)
+    backplane.stop()
+
+
 @app.get("/")
 async def root():
     return {"message": "Saut Al-Qur'an API is running"}
@@ -47,3 +114,14 @@ async def root():
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"}
+
+
+if settings.metrics_enabled:
+    @app.get("/metrics", include_in_schema=False)
+    def read_metrics():
+        return Response(metrics.registry.render(multiprocess.others("metrics")),
+                        media_type=metrics.CONTENT_TYPE)
+
+
+# Endpoint and serialization spans, once every route is registered
+tracing.instrument(app)
@@ -2,6 +2,13 @@ from .user import User, UserRole
 from .recitation import Recitation, RecitationStatus
 from .comment import Comment
 from .marker import Marker
+from .sync import ChangeLogEntry
+from .idempotency import IdempotencyRecord
+from .progress import StudentProgress
+from .assignment import ReviewAssignment, AssignmentStatus
+from .stream_ticket import StreamTicket
 
 __all__ = ["User", "UserRole", "Recitation",
-           "RecitationStatus", "Comment", "Marker"]
+           "RecitationStatus", "Comment", "Marker", "ChangeLogEntry",
+           "IdempotencyRecord", "StudentProgress", "ReviewAssignment",
+           "AssignmentStatus", "StreamTicket"]
@@ -0,0 +1,26 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, Enum, Index
+from sqlalchemy.sql import func
+from app.db.database import Base
+import enum
+
+
+class AssignmentStatus(str, enum.Enum):
+    OPEN = "open"
+    COMPLETED = "completed"
+
+
+class ReviewAssignment(Base):
+    """The scholar a pending recitation was assigned to (see app.services.assignments)"""
+    __tablename__ = "review_assignments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # One row per recitation; reopened if the recitation goes back to pending
+    recitation_id = Column(Integer, ForeignKey("recitations.id"), nullable=False, unique=True)
+    scholar_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    status = Column(Enum(AssignmentStatus), nullable=False, default=AssignmentStatus.OPEN)
+    assigned_at = Column(DateTime(timezone=True), server_default=func.now())
+    completed_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index("ix_review_assignments_scholar_id_status", "scholar_id", "status"),
+    )
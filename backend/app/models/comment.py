@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Float, Boolean, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.db.database import Base
@@ -14,6 +14,8 @@ class Comment(Base):
     text_comment = Column(Text)
     audio_comment_path = Column(String)  # Path to audio feedback file
     is_resolved = Column(Boolean, default=False)
+    # Incremented on every update (optimistic concurrency)
+    version = Column(Integer, nullable=False, server_default="1")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -21,3 +23,9 @@ class Comment(Base):
     recitation = relationship("Recitation", back_populates="comments")
     scholar = relationship("User", foreign_keys=[scholar_id], back_populates="comments_given")
     user = relationship("User", foreign_keys=[user_id], back_populates="comments_received")
+
+    __table_args__ = (
+        # Time-window queries: comments of one recitation between two timestamps
+        Index("ix_comments_recitation_id_timestamp", "recitation_id", "timestamp"),
+    )
+    __mapper_args__ = {"version_id_col": version}
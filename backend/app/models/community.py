@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Date, Boolean, Float, ForeignKey, Index, Text, UniqueConstraint
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.db.database import Base
@@ -11,6 +11,9 @@ class Community(Base):
     description = Column(Text)
     address = Column(Text)
     location = Column(String)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    geohash = Column(String, index=True)  # Set from latitude/longitude by app.services.geo
     is_active = Column(Boolean, default=True)
     created_by = Column(Integer, ForeignKey("users.id"), nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -21,6 +24,15 @@ class Community(Base):
     memberships = relationship("CommunityMembership", back_populates="community", cascade="all, delete-orphan")
     members = relationship("User", secondary="community_memberships", back_populates="communities", viewonly=True)
 
+    __table_args__ = (
+        # Nearby search on Postgres filters this expression by bounding box
+        Index(
+            "ix_communities_location",
+            func.point(longitude, latitude),
+            postgresql_using="gist",
+        ).ddl_if(dialect="postgresql"),
+    )
+
 class CommunityMembership(Base):
     __tablename__ = "community_memberships"
 
@@ -52,3 +64,34 @@ class CommunityInvitation(Base):
     # Relationships
     community = relationship("Community")
     inviter = relationship("User")
+
+class CommunityCounters(Base):
+    """Recitation counters of a community, maintained by app.services.community_stats"""
+    __tablename__ = "community_stats"
+
+    community_id = Column(Integer, ForeignKey("communities.id"), primary_key=True)
+    total_recitations = Column(Integer, nullable=False, default=0)
+    pending_reviews = Column(Integer, nullable=False, default=0)
+    reviewed_recitations = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+class CommunityMemberActivity(Base):
+    """The last day each member submitted a recitation to the community"""
+    __tablename__ = "community_member_activity"
+
+    id = Column(Integer, primary_key=True, index=True)
+    community_id = Column(Integer, ForeignKey("communities.id"), nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    last_active_on = Column(Date, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint("community_id", "user_id", name="uq_community_member_activity"),
+    )
+
+class CommunityActivityDay(Base):
+    """How many members were last active on ``day``: one bucket of the active-member window"""
+    __tablename__ = "community_activity_days"
+
+    community_id = Column(Integer, ForeignKey("communities.id"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    members = Column(Integer, nullable=False, default=0)
@@ -99,10 +99,14 @@ class UserFeedback(Base):
     admin_response = Column(Text)
     resolved_by = Column(Integer, ForeignKey("users.id"))
     resolved_at = Column(DateTime(timezone=True))
-    
+
+    # Incremented on every update (optimistic concurrency)
+    version = Column(Integer, nullable=False, server_default="1")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # Relationships
     user = relationship("User", foreign_keys=[user_id])
     resolver = relationship("User", foreign_keys=[resolved_by])
+
+    __mapper_args__ = {"version_id_col": version}
@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary
+from sqlalchemy.sql import func
+from app.db.database import Base
+
+
+class IdempotencyRecord(Base):
+    """Stored response for a request sent with an Idempotency-Key header"""
+    __tablename__ = "idempotency_records"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # SHA-256 of the caller's user id and the client-supplied key
+    key = Column(String, unique=True, nullable=False)
+    method = Column(String, nullable=False)
+    path = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)  # SHA-256 of the request
+    status_code = Column(Integer)  # None while the first request is running
+    content_type = Column(String)
+    body = Column(LargeBinary)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Text, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Text, Boolean, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.db.database import Base
@@ -17,6 +17,8 @@ class Marker(Base):
     # pronunciation, tajweed, rhythm, general
     category = Column(String, default="general")
     color = Column(String, default="#f59e0b")  # Hex color for UI display
+    # Incremented on every update (optimistic concurrency)
+    version = Column(Integer, nullable=False, server_default="1")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -24,6 +26,12 @@ class Marker(Base):
     recitation = relationship("Recitation", back_populates="markers")
     scholar = relationship("User", foreign_keys=[scholar_id])
 
+    __table_args__ = (
+        # Time-window queries: markers of one recitation between two timestamps
+        Index("ix_markers_recitation_id_timestamp", "recitation_id", "timestamp"),
+    )
+    __mapper_args__ = {"version_id_col": version}
+
 
 class LoopRegion(Base):
     __tablename__ = "loop_regions"
@@ -38,9 +46,27 @@ class LoopRegion(Base):
     color = Column(String, default="#10b981")  # Hex color for UI display
     # Whether loop is currently active
     is_active = Column(Boolean, default=False)
+    # Incremented on every update (optimistic concurrency)
+    version = Column(Integer, nullable=False, server_default="1")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
     # Relationships
     recitation = relationship("Recitation", back_populates="loop_regions")
     scholar = relationship("User", foreign_keys=[scholar_id])
+
+    __table_args__ = (
+        Index("ix_loop_regions_recitation_id_start_time",
+              "recitation_id", "start_time", "end_time"),
+        # Range overlap on Postgres: each loop is a degenerate box spanning
+        # start_time..end_time at y = recitation_id, so one GiST index answers
+        # "loops of this recitation overlapping [start, end]" without the
+        # btree_gist extension. See app.services.annotations.loop_overlaps.
+        Index(
+            "ix_loop_regions_span",
+            func.box(func.point(start_time, recitation_id),
+                     func.point(end_time, recitation_id)),
+            postgresql_using="gist",
+        ).ddl_if(dialect="postgresql"),
+    )
+    __mapper_args__ = {"version_id_col": version}
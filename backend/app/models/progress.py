@@ -0,0 +1,25 @@
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, LargeBinary, JSON, UniqueConstraint
+from sqlalchemy.sql import func
+from app.db.database import Base
+
+
+class StudentProgress(Base):
+    """A student's progress on one surah, maintained by app.services.progress"""
+    __tablename__ = "student_progress"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    surah_number = Column(Integer, nullable=False)
+    # Bit (ayah - 1) is set once any recitation included that ayah
+    covered = Column(LargeBinary, nullable=False)
+    ayahs_covered = Column(Integer, nullable=False, default=0)
+    recitation_count = Column(Integer, nullable=False, default=0)
+    reviewed_count = Column(Integer, nullable=False, default=0)
+    unresolved_comments = Column(Integer, nullable=False, default=0)
+    # Marker category -> number of markers on the student's recitations
+    error_counts = Column(JSON, nullable=False, default=dict)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "surah_number", name="uq_student_progress_user_surah"),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Enum, Float
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, Enum, Float, UniqueConstraint, Index, literal_column
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.db.database import Base
@@ -16,13 +16,24 @@ class Recitation(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    community_id = Column(Integer, ForeignKey("communities.id"), index=True)  # Submitted to
     surah_name = Column(String, nullable=False)
+    surah_number = Column(Integer, index=True)  # 1-114, resolved from surah_name
     ayah_start = Column(Integer, nullable=False)
     ayah_end = Column(Integer, nullable=False)
+    # Positions of the first and last ayah in the whole Qur'an (1-6236), see app.core.quran
+    ayah_index_start = Column(Integer)
+    ayah_index_end = Column(Integer)
     audio_file_path = Column(String)  # Path to stored audio file
     audio_data = Column(Text)  # Base64 encoded audio data (for smaller files)
     duration = Column(Float)  # Duration in seconds
     status = Column(Enum(RecitationStatus), default=RecitationStatus.PENDING)
+    # Summary counters maintained by app.services.counters
+    comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    unresolved_comment_count = Column(Integer, nullable=False, default=0, server_default="0")
+    marker_count = Column(Integer, nullable=False, default=0, server_default="0")
+    loop_region_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_feedback_at = Column(DateTime(timezone=True))  # Newest comment, marker or loop
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -31,3 +42,29 @@ class Recitation(Base):
     comments = relationship("Comment", back_populates="recitation")
     markers = relationship("Marker", back_populates="recitation")
     loop_regions = relationship("LoopRegion", back_populates="recitation")
+
+    __table_args__ = (
+        Index("ix_recitations_ayah_index_range", ayah_index_start, ayah_index_end),
+        # Coverage queries on Postgres overlap this range expression
+        Index(
+            "ix_recitations_ayah_range",
+            func.int4range(ayah_index_start, ayah_index_end, literal_column("'[]'")),
+            postgresql_using="gist",
+        ).ddl_if(dialect="postgresql"),
+    )
+
+
+class RecitationSubmission(Base):
+    """Idempotency record for a client-queued recitation upload"""
+    __tablename__ = "recitation_submissions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    idempotency_key = Column(String, nullable=False)  # Generated by the client
+    recitation_id = Column(Integer, ForeignKey("recitations.id"), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint("user_id", "idempotency_key",
+                         name="uq_recitation_submissions_user_key"),
+    )
@@ -0,0 +1,31 @@
+from sqlalchemy import BigInteger, Column, DDL, Integer, String, DateTime, Index, event
+from sqlalchemy.sql import func
+from app.db.database import Base
+
+
+class ChangeLogEntry(Base):
+    """One row per create, update or delete of a synced entity"""
+    __tablename__ = "change_log"
+
+    id = Column(Integer, primary_key=True, index=True)
+    # recitation, comment, marker, loop_region
+    entity_type = Column(String, nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    recitation_id = Column(Integer)
+    owner_id = Column(Integer, nullable=False)  # Owner of the recitation
+    operation = Column(String, nullable=False)  # upsert, delete
+    changed_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Postgres: id of the writing transaction, the sync cursor's commit order
+    txid = Column(BigInteger)
+
+    __table_args__ = (
+        Index("ix_change_log_owner_id_id", "owner_id", "id"),
+        Index("ix_change_log_txid_id", "txid", "id").ddl_if(dialect="postgresql"),
+        Index("ix_change_log_owner_id_txid_id", "owner_id", "txid", "id").ddl_if(
+            dialect="postgresql"),
+    )
+
+
+event.listen(ChangeLogEntry.__table__, "after_create", DDL(
+    "ALTER TABLE change_log ALTER COLUMN txid SET DEFAULT txid_current()"
+).execute_if(dialect="postgresql"))
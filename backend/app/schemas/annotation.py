@@ -0,0 +1,22 @@
+from pydantic import BaseModel
+from typing import Optional, List
+from app.schemas.comment import Comment
+from app.schemas.marker import Marker, LoopRegion
+
+
+class AnnotationDensity(BaseModel):
+    bucket_start: float
+    bucket_end: float
+    markers: int
+    comments: int
+    loop_regions: int
+
+
+class AnnotationWindow(BaseModel):
+    recitation_id: int
+    start: float
+    end: float
+    markers: List[Marker] = []
+    comments: List[Comment] = []
+    loop_regions: List[LoopRegion] = []  # Loops overlapping [start, end]
+    density: Optional[List[AnnotationDensity]] = None
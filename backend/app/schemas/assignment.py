@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+from typing import List
+
+
+class ScholarLoad(BaseModel):
+    scholar_id: int
+    open_assignments: int
+
+
+class AssignmentOverview(BaseModel):
+    waiting: int  # Pending recitations no scholar had room for
+    loads: List[ScholarLoad]
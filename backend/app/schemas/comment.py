@@ -13,6 +13,7 @@ class CommentCreate(CommentBase):
 class CommentUpdate(BaseModel):
     text_comment: Optional[str] = None
     is_resolved: Optional[bool] = None
+    version: Optional[int] = None  # Version being edited; If-Match also works
 
 class CommentInDB(CommentBase):
     id: int
@@ -21,6 +22,7 @@ class CommentInDB(CommentBase):
     user_id: int
     audio_comment_path: Optional[str] = None
     is_resolved: bool
+    version: int = 1
     created_at: datetime
     updated_at: Optional[datetime] = None
 
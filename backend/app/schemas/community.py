@@ -1,9 +1,19 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, Field, model_validator
+from typing import Literal, Optional, List
 from datetime import datetime
 from app.schemas.user import User
 
-class CommunityBase(BaseModel):
+class Coordinates(BaseModel):
+    latitude: Optional[float] = Field(None, ge=-90, le=90)
+    longitude: Optional[float] = Field(None, ge=-180, le=180)
+
+    @model_validator(mode="after")
+    def check_pair(self):
+        if (self.latitude is None) != (self.longitude is None):
+            raise ValueError("latitude and longitude must be given together")
+        return self
+
+class CommunityBase(Coordinates):
     name: str
     description: Optional[str] = None
     address: Optional[str] = None
@@ -12,7 +22,7 @@ class CommunityBase(BaseModel):
 class CommunityCreate(CommunityBase):
     pass
 
-class CommunityUpdate(BaseModel):
+class CommunityUpdate(Coordinates):
     name: Optional[str] = None
     description: Optional[str] = None
     address: Optional[str] = None
@@ -54,6 +64,12 @@ class Community(CommunityBase):
     class Config:
         from_attributes = True
 
+class CommunityNearby(CommunityBase):
+    id: int
+    created_by: int
+    created_at: datetime
+    distance_km: float
+
 class CommunityWithMembers(Community):
     members: Optional[List[User]] = None
     member_count: Optional[int] = None
@@ -89,4 +105,18 @@ class CommunityStats(BaseModel):
     total_scholars: int
     total_recitations: int
     pending_reviews: int
-    active_members: int
+    reviewed_recitations: int = 0
+    active_members: int  # Members who submitted a recitation in the last 30 days
+
+class CommunityInvitationBulkCreate(BaseModel):
+    emails: List[EmailStr] = Field(..., min_length=1)
+    role: Literal["member", "scholar", "admin"] = "member"
+    expires_in_days: Optional[int] = Field(None, ge=1, le=90)
+
+class CommunityInvitationIssued(BaseModel):
+    email: str
+    token: str  # Only returned here; the server keeps a hash
+    expires_at: datetime
+
+class CommunityInvitationBulkResult(BaseModel):
+    invitations: List[CommunityInvitationIssued]
@@ -94,6 +94,7 @@ class UserFeedbackUpdate(BaseModel):
     status: Optional[str] = None
     priority: Optional[str] = None
     admin_response: Optional[str] = None
+    version: Optional[int] = None  # Version being edited; If-Match also works
 
 class UserFeedback(UserFeedbackBase):
     id: int
@@ -102,6 +103,7 @@ class UserFeedback(UserFeedbackBase):
     admin_response: Optional[str] = None
     resolved_by: Optional[int] = None
     resolved_at: Optional[datetime] = None
+    version: int = 1
     created_at: datetime
     updated_at: Optional[datetime] = None
 
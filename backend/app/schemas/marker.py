@@ -20,12 +20,14 @@ class MarkerUpdate(BaseModel):
     description: Optional[str] = None
     category: Optional[str] = None
     color: Optional[str] = None
+    version: Optional[int] = None  # Version being edited; If-Match also works
 
 
 class MarkerInDB(MarkerBase):
     id: int
     recitation_id: int
     scholar_id: int
+    version: int = 1
     created_at: datetime
     updated_at: Optional[datetime] = None
 
@@ -55,6 +57,7 @@ class LoopRegionUpdate(BaseModel):
     label: Optional[str] = None
     color: Optional[str] = None
     is_active: Optional[bool] = None
+    version: Optional[int] = None  # Version being edited; If-Match also works
 
 
 class LoopRegionInDB(LoopRegionBase):
@@ -62,6 +65,7 @@ class LoopRegionInDB(LoopRegionBase):
     recitation_id: int
     scholar_id: int
     is_active: bool = False
+    version: int = 1
     created_at: datetime
     updated_at: Optional[datetime] = None
 
@@ -0,0 +1,9 @@
+from datetime import datetime
+from pydantic import BaseModel
+
+
+class StoredProfile(BaseModel):
+    kind: str  # "requests" or "continuous"
+    id: str
+    size: int
+    created_at: datetime
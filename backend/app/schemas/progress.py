@@ -0,0 +1,16 @@
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+from datetime import datetime
+
+
+class SurahProgress(BaseModel):
+    surah_number: int
+    surah_name: str
+    total_ayahs: int
+    ayahs_covered: int
+    covered_ranges: List[List[int]]  # [first, last] runs of recited ayahs
+    recitation_count: int
+    reviewed_count: int
+    unresolved_comments: int
+    error_counts: Dict[str, int]  # Marker category -> count
+    updated_at: Optional[datetime] = None
@@ -1,9 +1,10 @@
 from app.schemas.marker import Marker
 from app.schemas.comment import Comment
 from app.schemas.user import User
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from typing import Optional, List
 from datetime import datetime
+from app.core import quran
 from app.models.recitation import RecitationStatus
 
 
@@ -14,9 +15,22 @@ class RecitationBase(BaseModel):
 
 
 class RecitationCreate(RecitationBase):
+    surah_number: Optional[int] = None  # Filled in from surah_name when omitted
+    community_id: Optional[int] = None  # Defaults to the student's only community
     audio_data: Optional[str] = None  # Base64 encoded audio
     duration: Optional[float] = None
 
+    @model_validator(mode="after")
+    def check_reference(self):
+        if self.surah_number is not None:
+            named = quran.surah_number(self.surah_name)
+            if named is not None and named != self.surah_number:
+                raise ValueError(f"surah_name does not match surah {self.surah_number}")
+        self.surah_number = quran.validate_range(
+            self.surah_number if self.surah_number is not None else self.surah_name,
+            self.ayah_start, self.ayah_end)
+        return self
+
 
 class RecitationUpdate(BaseModel):
     status: Optional[RecitationStatus] = None
@@ -25,9 +39,16 @@ class RecitationUpdate(BaseModel):
 class RecitationInDB(RecitationBase):
     id: int
     user_id: int
+    community_id: Optional[int] = None
+    surah_number: Optional[int] = None
     audio_file_path: Optional[str] = None
     duration: Optional[float] = None
     status: RecitationStatus
+    comment_count: int = 0
+    unresolved_comment_count: int = 0
+    marker_count: int = 0
+    loop_region_count: int = 0
+    last_feedback_at: Optional[datetime] = None
     created_at: datetime
     updated_at: Optional[datetime] = None
 
@@ -43,3 +64,33 @@ class RecitationWithDetails(Recitation):
     user: Optional[dict] = None
     comments: Optional[List[dict]] = None
     markers: Optional[List[dict]] = None
+
+
+class RecitationBatchItem(RecitationCreate):
+    idempotency_key: str  # Client-generated, unique per queued recording
+    file: Optional[str] = None  # Filename of the matching multipart audio part
+
+
+class RecitationBatchItemResult(BaseModel):
+    idempotency_key: Optional[str] = None
+    status: str  # created, duplicate, error
+    recitation_id: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class RecitationBatchResult(BaseModel):
+    results: List[RecitationBatchItemResult]
+
+
+class RecitationCounters(BaseModel):
+    comment_count: int
+    unresolved_comment_count: int
+    marker_count: int
+    loop_region_count: int
+    last_feedback_at: Optional[datetime] = None
+
+
+class RecitationCounterDrift(BaseModel):
+    recitation_id: int
+    stored: RecitationCounters
+    actual: RecitationCounters
@@ -0,0 +1,16 @@
+from datetime import datetime
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+
+
+class SlowQuery(BaseModel):
+    fingerprint: str
+    statement: str  # normalized, values replaced by ?
+    calls: int  # slow runs, not all runs
+    total_ms: float
+    mean_ms: float
+    max_ms: float
+    last_seen: Optional[datetime] = None
+    routes: Dict[str, int]  # "METHOD /route" -> slow runs
+    parameter_shapes: List[str]
+    plans: List[Any]  # EXPLAIN (FORMAT JSON) output, Postgres only
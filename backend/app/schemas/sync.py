@@ -0,0 +1,15 @@
+from pydantic import BaseModel
+from typing import Optional, List
+
+
+class SyncChange(BaseModel):
+    entity: str  # recitation, comment, marker, loop_region
+    id: int
+    op: str  # upsert, delete
+    data: Optional[dict] = None  # Current state for upserts, None for tombstones
+
+
+class SyncChanges(BaseModel):
+    next_token: str
+    has_more: bool
+    changes: List[SyncChange]
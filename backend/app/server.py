@@ -0,0 +1,90 @@
+"""
+Production server entry point.
+
+Runs the API under gunicorn with uvicorn workers:
+
+    python -m app.server
+
+The schema and seed data are created once in the master process, the
+application is imported before the workers are forked, workers are recycled
+after a bounded number of requests, and SIGTERM drains in-flight requests
+for up to ``server_graceful_timeout`` seconds before exiting. Workers share
+metrics and slow query totals through ``multiprocess_dir``, a temporary
+directory unless configured, emptied at start.
+"""
+import multiprocessing
+import tempfile
+
+from gunicorn.app.base import BaseApplication
+
+from app.core import multiprocess
+from app.core.config import settings
+from app.db.database import SessionLocal, engine
+from app.db.init_db import create_initial_data, create_tables
+
+
+def default_workers() -> int:
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def init_database():
+    """Create tables and seed data, then drop pooled connections before fork"""
+    create_tables()
+    db = SessionLocal()
+    try:
+        create_initial_data(db)
+    finally:
+        db.close()
+    engine.dispose()
+
+
+def post_fork(server, worker):
+    # Never reuse a connection inherited from the master process
+    engine.dispose(close=False)
+
+
+def build_options() -> dict:
+    return {
+        "bind": f"{settings.server_host}:{settings.server_port}",
+        "workers": settings.web_concurrency or default_workers(),
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "max_requests": settings.server_max_requests,
+        "max_requests_jitter": settings.server_max_requests_jitter,
+        "graceful_timeout": settings.server_graceful_timeout,
+        "timeout": settings.server_timeout,
+        "keepalive": settings.server_keepalive,
+        "backlog": settings.server_backlog,
+        "forwarded_allow_ips": "*",
+        "accesslog": "-",
+        "post_fork": post_fork,
+    }
+
+
+class Server(BaseApplication):
+    def __init__(self, application, options: dict):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def main():
+    settings.init_db_on_startup = False
+    # Import the app (and with it every model) once, before any worker forks
+    from app.main import app
+    init_database()
+    if not settings.multiprocess_dir:
+        settings.multiprocess_dir = tempfile.mkdtemp(prefix="saut-stats-")
+    multiprocess.clear()
+    Server(app, build_options()).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Markers, comments and loop regions of a recitation inside a time window.
+
+The scholar player zoomed into a few seconds of a long recitation only needs
+the annotations it can show. Markers and comments are point annotations
+found through their ``(recitation_id, timestamp)`` indexes; loop regions are
+spans found by range overlap. For the zoomed-out overview, ``density``
+returns per-bucket counts computed in the database, so the client never has
+to hold the whole annotation set.
+
+``can_edit`` is the one rule for who may update or delete a marker or loop
+region, over REST (app/api/api_v1/endpoints/markers.py) and in co-review
+rooms (app.services.review_rooms) alike: the scholar who created it, or an
+admin.
+"""
+from typing import List, Optional
+
+from sqlalchemy import Integer, and_, cast, func
+from sqlalchemy.orm import Session
+
+from app.core.serialization import row_dicts, schema_columns
+from app.models.comment import Comment
+from app.models.marker import LoopRegion, Marker
+from app.models.user import UserRole
+from app.schemas.comment import Comment as CommentSchema
+from app.schemas.marker import LoopRegion as LoopRegionSchema, Marker as MarkerSchema
+
+
+def can_edit(user_id: int, role: UserRole, scholar_id: int) -> bool:
+    """May this user update or delete a marker or loop region ``scholar_id`` created"""
+    return role == UserRole.ADMIN or scholar_id == user_id
+
+
+def edit_guards(model, user_id: int, role: UserRole) -> list:
+    """``can_edit`` as ``conditional_update`` guards on ``model.scholar_id``"""
+    if role == UserRole.ADMIN:
+        return []
+    return [(model.scholar_id == user_id, 403, "Not enough permissions")]
+
+
+def _is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def loop_overlaps(db: Session, recitation_id: int, start: float, end: float):
+    """Criterion for loop regions of ``recitation_id`` overlapping [start, end]"""
+    same_recitation = LoopRegion.recitation_id == recitation_id
+    if _is_postgres(db):
+        # Must match the ix_loop_regions_span expression to use the GiST index
+        span = func.box(func.point(LoopRegion.start_time, LoopRegion.recitation_id),
+                        func.point(LoopRegion.end_time, LoopRegion.recitation_id))
+        window = func.box(func.point(start, recitation_id), func.point(end, recitation_id))
+        return and_(same_recitation, span.op("&&")(window))
+    return and_(same_recitation, LoopRegion.start_time <= end, LoopRegion.end_time >= start)
+
+
+def _bucket_index(db: Session, column, start: float, width: float):
+    position = (column - start) / width
+    if _is_postgres(db):
+        return func.floor(position)
+    # SQLite has no floor() without the math extension; offsets in the window
+    # are never negative, so truncation is the same thing
+    return cast(position, Integer)
+
+
+def annotations_in_window(db: Session, recitation_id: int, start: float, end: float) -> dict:
+    markers = db.query(*schema_columns(Marker, MarkerSchema)).filter(
+        Marker.recitation_id == recitation_id,
+        Marker.timestamp.between(start, end),
+    ).order_by(Marker.timestamp).all()
+    comments = db.query(*schema_columns(Comment, CommentSchema)).filter(
+        Comment.recitation_id == recitation_id,
+        Comment.timestamp.between(start, end),
+    ).order_by(Comment.timestamp).all()
+    loop_regions = db.query(*schema_columns(LoopRegion, LoopRegionSchema)).filter(
+        loop_overlaps(db, recitation_id, start, end)
+    ).order_by(LoopRegion.start_time).all()
+    return {
+        "markers": row_dicts(markers),
+        "comments": row_dicts(comments),
+        "loop_regions": row_dicts(loop_regions),
+    }
+
+
+def density(db: Session, recitation_id: int, start: float, end: float,
+            buckets: int) -> List[dict]:
+    """Annotation counts for ``buckets`` equal slices of [start, end]"""
+    width = (end - start) / buckets
+    counts = [{"markers": 0, "comments": 0, "loop_regions": 0} for _ in range(buckets)]
+
+    for key, model in (("markers", Marker), ("comments", Comment)):
+        bucket = _bucket_index(db, model.timestamp, start, width).label("bucket")
+        rows = db.query(bucket, func.count()).filter(
+            model.recitation_id == recitation_id,
+            model.timestamp.between(start, end),
+        ).group_by(bucket).all()
+        for index, count in rows:
+            # A timestamp exactly at ``end`` belongs to the last bucket
+            counts[min(int(index), buckets - 1)][key] += count
+
+    # Loops span buckets; there are few of them, so spread them here
+    for loop_start, loop_end in db.query(LoopRegion.start_time, LoopRegion.end_time).filter(
+            loop_overlaps(db, recitation_id, start, end)):
+        first = max(0, int((loop_start - start) // width))
+        last = min(buckets - 1, int((loop_end - start) // width))
+        for index in range(first, last + 1):
+            counts[index]["loop_regions"] += 1
+
+    return [
+        {"bucket_start": start + index * width, "bucket_end": start + (index + 1) * width,
+         **bucket_counts}
+        for index, bucket_counts in enumerate(counts)
+    ]
+
+
+def annotation_window(db: Session, recitation_id: int, start: float, end: float,
+                      include_items: bool = True, buckets: Optional[int] = None) -> dict:
+    window = {"recitation_id": recitation_id, "start": start, "end": end}
+    if include_items:
+        window.update(annotations_in_window(db, recitation_id, start, end))
+    if buckets:
+        window["density"] = density(db, recitation_id, start, end, buckets)
+    return window
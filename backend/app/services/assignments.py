@@ -0,0 +1,488 @@
+"""
+Assignment of pending recitations to scholars.
+
+Each scholar belongs to review pools: one per community where they hold a
+``scholar`` membership, plus the global pool for users with the scholar
+role. A recitation is offered to the pool of the community it was
+submitted to (or of all its student's communities) first and then to the
+global pool.
+
+- A new recitation goes to the least-loaded scholar (fewest open
+  assignments) with spare capacity in the first tier that has one.
+  Otherwise it waits in the queue of each of its pools.
+- When a scholar finishes a review, or opens their queue, they pull the
+  longest-waiting recitation from their community queues, then from the
+  global queue, until they reach ``settings.review_max_open_assignments``.
+- Scholars are never assigned their own recitations.
+
+Pools are heaps keyed on (open assignments, scholar id) and queues are
+heaps keyed on (waiting since, recitation id). Entries are never removed
+in place: a load change pushes a fresh entry and a recitation taken from
+one queue stays in the others. Stale entries are skipped when they reach
+the top, and a heap is compacted once it is mostly stale. Every operation
+is O(log n) amortized per pool.
+
+The scheduler lives in memory. Assignments are persisted in
+``review_assignments``, whose unique recitation id makes sure two workers
+never both assign the same recitation. Each worker's scheduler may lag the
+others by a message, so the capacity is enforced when an assignment is
+stored: the scholar's ``users`` row is locked (``FOR UPDATE``; SQLite
+serializes writers anyway) while their open assignments are counted, and a
+scholar found full is given their real load and the recitation is placed
+again. The scheduler is rebuilt from the database on startup, and again
+after the backplane reconnects. Decisions are published on the backplane
+so every worker's scheduler sees them.
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.core.config import settings
+from app.db.database import SessionLocal
+from app.models.assignment import AssignmentStatus, ReviewAssignment
+from app.models.community import CommunityMembership
+from app.models.recitation import Recitation, RecitationStatus
+from app.models.user import User, UserRole
+from app.services.backplane import backplane
+
+logger = logging.getLogger(__name__)
+
+TOPIC = "assignments"
+GLOBAL = None  # Pool key of the global pool; community pools use the community id
+
+
+class AssignmentScheduler:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._load: Dict[int, int] = {}
+            self._scholar_pools: Dict[int, Set[Optional[int]]] = {}
+            self._pools: Dict[Optional[int], List[Tuple[int, int]]] = {}
+            self._queues: Dict[Optional[int], List[Tuple[float, int]]] = {}
+            # recitation -> (waiting since, pools, student)
+            self._waiting: Dict[int, Tuple[float, Tuple[Optional[int], ...], Optional[int]]] = {}
+            self._assigned: Dict[int, int] = {}
+            self._origins: Dict[int, tuple] = {}  # _waiting entries of assigned recitations
+            self._limits: Dict[tuple, int] = {}
+
+    # Heaps with lazy deletion
+
+    def _live_scholar(self, pool, entry) -> bool:
+        load, scholar = entry
+        return pool in self._scholar_pools.get(scholar, ()) and self._load.get(scholar, 0) == load
+
+    def _live_recitation(self, entry) -> bool:
+        return entry[1] in self._waiting
+
+    def _push(self, heaps: dict, key, entry, live) -> None:
+        heap = heaps.setdefault(key, [])
+        heapq.heappush(heap, entry)
+        # Compact when the heap doubled since the last compaction: O(1) amortized
+        limit = self._limits.get((id(heaps), key), 64)
+        if len(heap) > limit:
+            heap[:] = [item for item in heap if live(item)]
+            heapq.heapify(heap)
+            self._limits[(id(heaps), key)] = max(64, 2 * len(heap))
+
+    @staticmethod
+    def _top(heap: list, live):
+        while heap and not live(heap[0]):
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def _top_except(self, heap: list, live, excluded):
+        """The top live entry that isn't ``excluded``; the skipped ones stay"""
+        skipped = []
+        entry = self._top(heap, live)
+        while entry is not None and excluded(entry):
+            skipped.append(heapq.heappop(heap))
+            entry = self._top(heap, live)
+        for item in skipped:
+            heapq.heappush(heap, item)
+        return entry
+
+    def _set_load(self, scholar: int, load: int) -> None:
+        self._load[scholar] = load
+        for pool in self._scholar_pools.get(scholar, ()):
+            self._push(self._pools, pool, (load, scholar),
+                       lambda entry, pool=pool: self._live_scholar(pool, entry))
+
+    def _least_loaded(self, pool, capacity: int,
+                      student: Optional[int]) -> Optional[Tuple[int, int]]:
+        entry = self._top_except(self._pools.get(pool, []),
+                                 lambda entry: self._live_scholar(pool, entry),
+                                 lambda entry: entry[1] == student)
+        return entry if entry is not None and entry[0] < capacity else None
+
+    def _assign(self, recitation_id: int, scholar: int, origin: Optional[tuple]) -> None:
+        self._waiting.pop(recitation_id, None)
+        self._assigned[recitation_id] = scholar
+        if origin is not None:
+            self._origins[recitation_id] = origin
+        self._set_load(scholar, self._load.get(scholar, 0) + 1)
+
+    # Operations
+
+    def set_scholar(self, scholar: int, pools: Iterable[Optional[int]]) -> None:
+        """Replace the pools ``scholar`` reviews for"""
+        with self._lock:
+            self._scholar_pools[scholar] = set(pools)
+            self._set_load(scholar, self._load.get(scholar, 0))
+
+    def waiting(self, recitation_id: int) -> bool:
+        with self._lock:
+            return recitation_id in self._waiting
+
+    def knows(self, scholar: int) -> bool:
+        with self._lock:
+            return scholar in self._scholar_pools
+
+    def place(self, recitation_id: int, waiting_since: float,
+              communities: Iterable[int], capacity: int,
+              student: Optional[int] = None) -> Optional[int]:
+        """
+        Assign a recitation of ``student`` to the least-loaded other scholar
+        with capacity in its communities, else in the global pool; returns
+        the scholar, or None when it was queued (or is already assigned).
+        A waiting recitation is taken out of its queues and placed again.
+        """
+        with self._lock:
+            if recitation_id in self._assigned:
+                return None
+            self._waiting.pop(recitation_id, None)
+            pools = (*communities, GLOBAL)
+            for tier in (pools[:-1], pools[-1:]):
+                candidates = [entry for entry in (
+                    self._least_loaded(pool, capacity, student) for pool in tier) if entry]
+                if candidates:
+                    scholar = min(candidates)[1]
+                    self._assign(recitation_id, scholar, (waiting_since, pools, student))
+                    return scholar
+            self.enqueue(recitation_id, waiting_since, pools, student)
+            return None
+
+    def enqueue(self, recitation_id: int, waiting_since: float,
+                pools: Iterable[Optional[int]], student: Optional[int] = None) -> None:
+        with self._lock:
+            if recitation_id in self._assigned or recitation_id in self._waiting:
+                return
+            pools = tuple(pools)
+            self._waiting[recitation_id] = (waiting_since, pools, student)
+            for pool in pools:
+                self._push(self._queues, pool, (waiting_since, recitation_id),
+                           self._live_recitation)
+
+    def next_for(self, scholar: int, capacity: int) -> Optional[int]:
+        """Assign ``scholar`` the longest-waiting recitation of their pools, if they have room"""
+        with self._lock:
+            if self._load.get(scholar, 0) >= capacity:
+                return None
+            pools = self._scholar_pools.get(scholar, set())
+            communities = [pool for pool in pools if pool is not GLOBAL]
+            for tier in (communities, [GLOBAL] if GLOBAL in pools else []):
+                heads = [entry for entry in (
+                    self._top_except(self._queues.get(pool, []), self._live_recitation,
+                                     lambda entry: self._waiting[entry[1]][2] == scholar)
+                    for pool in tier) if entry]
+                if heads:
+                    recitation_id = min(heads)[1]
+                    self._assign(recitation_id, scholar, self._waiting[recitation_id])
+                    return recitation_id
+            return None
+
+    def assigned(self, recitation_id: int, scholar: int) -> None:
+        """Record an assignment decided elsewhere"""
+        with self._lock:
+            if self._assigned.get(recitation_id) == scholar:
+                return
+            self.finished(recitation_id)
+            self._assign(recitation_id, scholar, None)
+
+    def finished(self, recitation_id: int) -> Optional[int]:
+        """Drop a recitation; returns the scholar it was assigned to"""
+        with self._lock:
+            self._waiting.pop(recitation_id, None)
+            self._origins.pop(recitation_id, None)
+            scholar = self._assigned.pop(recitation_id, None)
+            if scholar is not None:
+                self._set_load(scholar, max(0, self._load.get(scholar, 0) - 1))
+            return scholar
+
+    def refused(self, recitation_id: int, scholar: int, load: int) -> None:
+        """
+        Undo an assignment the database refused because ``scholar`` already
+        has ``load`` open ones: the recitation waits in its queues again
+        """
+        with self._lock:
+            origin = self._origins.get(recitation_id)
+            self.finished(recitation_id)
+            self._set_load(scholar, load)
+            if origin is not None:
+                self.enqueue(recitation_id, *origin)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "waiting": len(self._waiting),
+                "loads": [{"scholar_id": scholar, "open_assignments": load}
+                          for scholar, load in sorted(self._load.items())
+                          if scholar in self._scholar_pools or load],
+            }
+
+
+scheduler = AssignmentScheduler()
+_rebuild_lock = threading.RLock()
+
+
+def _timestamp(value: Optional[datetime]) -> float:
+    return value.timestamp() if value is not None else time.time()
+
+
+def _student_communities(db: Session, user_ids: Iterable[int]) -> Dict[int, List[int]]:
+    communities: Dict[int, List[int]] = {}
+    for user_id, community_id in db.query(
+            CommunityMembership.user_id, CommunityMembership.community_id).filter(
+            CommunityMembership.user_id.in_(set(user_ids)),
+            CommunityMembership.is_active == True):
+        communities.setdefault(user_id, []).append(community_id)
+    return communities
+
+
+def _scholar_pools(db: Session, user_ids: Optional[Iterable[int]] = None
+                   ) -> Dict[int, Set[Optional[int]]]:
+    scholars = db.query(User.id).filter(User.role == UserRole.SCHOLAR, User.is_active == True)
+    memberships = db.query(CommunityMembership.user_id, CommunityMembership.community_id).filter(
+        CommunityMembership.role == "scholar", CommunityMembership.is_active == True)
+    if user_ids is not None:
+        user_ids = set(user_ids)
+        scholars = scholars.filter(User.id.in_(user_ids))
+        memberships = memberships.filter(CommunityMembership.user_id.in_(user_ids))
+    pools: Dict[int, Set[Optional[int]]] = {user_id: set() for user_id in user_ids or ()}
+    for (user_id,) in scholars:
+        pools.setdefault(user_id, set()).add(GLOBAL)
+    for user_id, community_id in memberships:
+        pools.setdefault(user_id, set()).add(community_id)
+    return pools
+
+
+def _persist(db: Session, recitation_id: int, scholar: int) -> Optional[bool]:
+    """
+    Store an assignment. Returns False if another worker assigned the
+    recitation first, and None (after telling the scheduler the scholar's
+    real load) if the scholar has no room left.
+    """
+    try:
+        with db.begin_nested():
+            db.execute(select(User.id).where(User.id == scholar).with_for_update())
+            load = db.query(func.count(ReviewAssignment.id)).filter(
+                ReviewAssignment.scholar_id == scholar,
+                ReviewAssignment.status == AssignmentStatus.OPEN,
+            ).scalar()
+            if load >= settings.review_max_open_assignments:
+                scheduler.refused(recitation_id, scholar, load)
+                return None
+            reopened = db.execute(
+                update(ReviewAssignment)
+                .where(ReviewAssignment.recitation_id == recitation_id,
+                       ReviewAssignment.status != AssignmentStatus.OPEN)
+                .values(scholar_id=scholar, status=AssignmentStatus.OPEN,
+                        assigned_at=func.now(), completed_at=None)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if not reopened:
+                db.add(ReviewAssignment(recitation_id=recitation_id, scholar_id=scholar))
+                db.flush()
+    except IntegrityError:
+        scheduler.finished(recitation_id)
+        return False
+    return True
+
+
+def _publish_assigned(assignments: List[Tuple[int, int]]) -> None:
+    for recitation_id, scholar in assignments:
+        backplane.publish(TOPIC, {"op": "assigned", "recitation": recitation_id,
+                                  "scholar": scholar})
+
+
+def rebuild(db: Session) -> None:
+    """Load scholars, open assignments and waiting recitations, then assign what fits"""
+    with _rebuild_lock:
+        scheduler.loaded = False
+        scheduler.reset()
+        for scholar, pools in _scholar_pools(db).items():
+            scheduler.set_scholar(scholar, pools)
+        for recitation_id, scholar in db.query(
+                ReviewAssignment.recitation_id, ReviewAssignment.scholar_id).filter(
+                ReviewAssignment.status == AssignmentStatus.OPEN):
+            scheduler.assigned(recitation_id, scholar)
+
+        waiting = db.query(Recitation.id, Recitation.user_id, Recitation.community_id,
+                           Recitation.created_at).outerjoin(
+            ReviewAssignment, and_(ReviewAssignment.recitation_id == Recitation.id,
+                                   ReviewAssignment.status == AssignmentStatus.OPEN)
+        ).filter(
+            Recitation.status == RecitationStatus.PENDING, ReviewAssignment.id.is_(None)
+        ).order_by(Recitation.created_at, Recitation.id).all()
+        communities = _student_communities(db, (row.user_id for row in waiting))
+        made = []
+        for row in waiting:
+            pools = ([row.community_id] if row.community_id is not None
+                     else communities.get(row.user_id, ()))
+            scholar = _place(db, row.id, _timestamp(row.created_at), pools, row.user_id)
+            if scholar is not None:
+                made.append((row.id, scholar))
+            # One scholar row locked at a time, so rebuilding workers can't deadlock
+            db.commit()
+        scheduler.loaded = True
+    _publish_assigned(made)
+
+
+def _ready(db: Session) -> None:
+    if not scheduler.loaded:
+        with _rebuild_lock:
+            if not scheduler.loaded:
+                rebuild(db)
+
+
+def _place(db: Session, recitation_id: int, waiting_since: float,
+           communities: List[int], student: int) -> Optional[int]:
+    """
+    Assign and store a recitation, trying the next scholar while the chosen
+    one turns out to be full; returns the scholar, or None when it was
+    queued or another worker assigned it. The caller commits.
+    """
+    while True:
+        scholar = scheduler.place(recitation_id, waiting_since, communities,
+                                  settings.review_max_open_assignments, student)
+        if scholar is None:
+            return None
+        stored = _persist(db, recitation_id, scholar)
+        if stored is not None:
+            return scholar if stored else None
+
+
+def submit(db: Session, recitation: Recitation) -> Optional[int]:
+    """Assign (or queue) a recitation that became pending; returns the scholar"""
+    _ready(db)
+    if recitation.community_id is not None:
+        communities = [recitation.community_id]
+    else:
+        communities = _student_communities(db, [recitation.user_id]).get(recitation.user_id, [])
+    waiting_since = _timestamp(recitation.created_at)
+    scholar = _place(db, recitation.id, waiting_since, communities, recitation.user_id)
+    if scholar is None:
+        if scheduler.waiting(recitation.id):
+            backplane.publish(TOPIC, {"op": "waiting", "recitation": recitation.id,
+                                      "since": waiting_since, "pools": [*communities, GLOBAL],
+                                      "student": recitation.user_id})
+        return None
+    db.commit()
+    _publish_assigned([(recitation.id, scholar)])
+    return scholar
+
+
+def fill(db: Session, scholar: int) -> List[int]:
+    """Give ``scholar`` waiting recitations up to their capacity; returns the new ones"""
+    _ready(db)
+    made = []
+    while True:
+        recitation_id = scheduler.next_for(scholar, settings.review_max_open_assignments)
+        if recitation_id is None:
+            break
+        stored = _persist(db, recitation_id, scholar)
+        if stored is None:
+            break  # Full after all; the recitation is back in its queues
+        if stored:
+            made.append((recitation_id, scholar))
+    if made:
+        db.commit()
+        _publish_assigned(made)
+    return [recitation_id for recitation_id, _ in made]
+
+
+def complete(db: Session, recitation_id: int) -> None:
+    """The recitation left pending: close its assignment and refill that scholar"""
+    _ready(db)
+    db.execute(
+        update(ReviewAssignment)
+        .where(ReviewAssignment.recitation_id == recitation_id,
+               ReviewAssignment.status == AssignmentStatus.OPEN)
+        .values(status=AssignmentStatus.COMPLETED, completed_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    scholar = scheduler.finished(recitation_id)
+    backplane.publish(TOPIC, {"op": "finished", "recitation": recitation_id})
+    if scholar is not None:
+        fill(db, scholar)
+
+
+def scholar_changed(db: Session, user_id: int) -> None:
+    """Reload ``user_id``'s pools after a role or membership change"""
+    _ready(db)
+    pools = _scholar_pools(db, [user_id])[user_id]
+    scheduler.set_scholar(user_id, pools)
+    backplane.publish(TOPIC, {"op": "scholar", "scholar": user_id, "pools": list(pools)})
+    if pools:
+        fill(db, user_id)
+
+
+def open_assignments(db: Session, scholar: User) -> List[int]:
+    """Ids of ``scholar``'s open assignments, pulling new work first if they have room"""
+    _ready(db)
+    if not scheduler.knows(scholar.id):
+        scholar_changed(db, scholar.id)
+    else:
+        fill(db, scholar.id)
+    return [recitation_id for (recitation_id,) in db.query(ReviewAssignment.recitation_id).filter(
+        ReviewAssignment.scholar_id == scholar.id,
+        ReviewAssignment.status == AssignmentStatus.OPEN,
+    ).order_by(ReviewAssignment.assigned_at, ReviewAssignment.id)]
+
+
+def overview(db: Session) -> dict:
+    _ready(db)
+    return scheduler.snapshot()
+
+
+def start() -> None:
+    """Build the scheduler at startup; on failure it is built on first use"""
+    try:
+        with SessionLocal() as db:
+            rebuild(db)
+    except Exception:
+        logger.exception("Could not build the assignment scheduler")
+
+
+def _deliver(message: dict) -> None:
+    if not scheduler.loaded:
+        return  # Rebuilt from the database on first use
+    op = message["op"]
+    if op == "assigned":
+        scheduler.assigned(message["recitation"], message["scholar"])
+    elif op == "finished":
+        scheduler.finished(message["recitation"])
+    elif op == "waiting":
+        scheduler.enqueue(message["recitation"], message["since"], message["pools"],
+                          message.get("student"))
+    elif op == "scholar":
+        scheduler.set_scholar(message["scholar"], message["pools"])
+
+
+def _missed_messages() -> None:
+    scheduler.loaded = False
+
+
+backplane.subscribe(TOPIC, _deliver)
+backplane.on_reconnect(_missed_messages)
@@ -0,0 +1,339 @@
+"""
+Cross-process pub/sub over Postgres LISTEN/NOTIFY.
+
+With several workers (and nodes) each process has its own SSE subscribers,
+co-review rooms and in-memory caches. Publishing through the backplane
+delivers a message to the local handlers immediately and to every other
+process through ``NOTIFY`` on ``settings.backplane_channel``; each process
+listens on a dedicated connection in a background thread.
+
+Outgoing messages are held for ``settings.backplane_coalesce_ms`` and sent
+together: messages published with the same ``key`` collapse into the latest
+one (cache invalidations, mostly), and the rest are packed into as few
+NOTIFY payloads as fit under Postgres' 8000-byte limit. A message too large
+to fit is replaced by its ``fallback`` (or dropped), so publishers should
+pass a small fallback that tells receivers to refetch.
+
+The listener reconnects with backoff after losing its connection and then
+calls the ``on_reconnect`` handlers, since notifications sent while it was
+away are lost. With SQLite, or ``settings.backplane == "local"``, messages
+are only delivered inside the process.
+
+Handlers of an ``ordered`` topic get its messages, their own process's
+included, in the order the transport delivers them, which is the same in
+every process: a publisher's own handlers wait for its NOTIFY to come back
+instead of running straight away.
+"""
+import json
+import logging
+import re
+import select
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.engine import make_url
+
+from app.core.config import settings
+from app.core.serialization import dumps
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:  # pragma: no cover - optional dependency
+    psycopg2 = None
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7900
+INVALIDATE = "invalidate"
+
+Handler = Callable[[Any], None]
+
+
+def pack(origin: str, messages: List[Tuple[str, Any, Optional[Any]]],
+         limit: int = MAX_PAYLOAD) -> List[str]:
+    """
+    Encode (topic, data, fallback) messages into as few payloads as fit in
+    ``limit`` bytes, each ``{"o": origin, "m": [[topic, data], ...]}``.
+    """
+    envelope = len(dumps({"o": origin, "m": []}))
+    payloads, batch, size = [], [], envelope
+    for topic, data, fallback in messages:
+        encoded = dumps([topic, data])
+        if envelope + len(encoded) > limit:
+            if fallback is None:
+                logger.warning("Dropping %s message of %d bytes", topic, len(encoded))
+                continue
+            encoded = dumps([topic, fallback])
+        if batch and size + len(encoded) + 1 > limit:
+            payloads.append(_join(origin, batch))
+            batch, size = [], envelope
+        batch.append(encoded)
+        size += len(encoded) + 1
+    if batch:
+        payloads.append(_join(origin, batch))
+    return payloads
+
+
+def _join(origin: str, encoded: List[bytes]) -> str:
+    return '{"o":%s,"m":[%s]}' % (json.dumps(origin), b",".join(encoded).decode())
+
+
+class LocalTransport:
+    """No other processes to reach"""
+    remote = False
+
+    def start(self, receive: Callable[[str], None], reconnected: Callable[[], None]) -> None:
+        pass
+
+    def send(self, payloads: List[str]) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+
+class PostgresTransport:
+    remote = True
+
+    def __init__(self, dsn: str, channel: str):
+        if psycopg2 is None:
+            raise RuntimeError("The Postgres backplane requires psycopg2")
+        if not re.fullmatch(r"[a-z_][a-z0-9_]*", channel):
+            raise ValueError(f"Invalid backplane channel name: {channel!r}")
+        self.dsn = dsn
+        self.channel = channel
+        self._send_lock = threading.Lock()
+        self._send_conn = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def start(self, receive: Callable[[str], None], reconnected: Callable[[], None]) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._listen, args=(receive, reconnected),
+            name="backplane-listener", daemon=True)
+        self._thread.start()
+
+    def send(self, payloads: List[str]) -> None:
+        with self._send_lock:
+            for attempt in (1, 2):
+                try:
+                    if self._send_conn is None or self._send_conn.closed:
+                        self._send_conn = self._connect()
+                    with self._send_conn.cursor() as cursor:
+                        # One round trip for the whole batch
+                        cursor.execute(
+                            "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+                            (self.channel, payloads))
+                    return
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    self._close_sender()
+                    if attempt == 2:
+                        raise
+
+    def _close_sender(self) -> None:
+        if self._send_conn is not None:
+            try:
+                self._send_conn.close()
+            except psycopg2.Error:
+                pass
+            self._send_conn = None
+
+    def _listen(self, receive: Callable[[str], None], reconnected: Callable[[], None]) -> None:
+        backoff, connected_before = 0.5, False
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.channel}")
+                if connected_before:
+                    reconnected()
+                connected_before, backoff = True, 0.5
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 5.0) == ([], [], []):
+                        # Idle: make sure the connection is still alive
+                        with conn.cursor() as cursor:
+                            cursor.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        receive(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError) as exc:
+                if self._stopped.is_set():
+                    break
+                logger.warning("Backplane listener lost its connection (%s); "
+                               "retrying in %.1fs", exc, backoff)
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        with self._send_lock:
+            self._close_sender()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+
+class Backplane:
+    def __init__(self, transport=None):
+        self.origin = uuid.uuid4().hex[:12]
+        self.transport = transport or LocalTransport()
+        self._handlers: Dict[str, List[Handler]] = {}
+        self._invalidation_handlers: Dict[str, List[Callable[[Any], None]]] = {}
+        self._reconnect_handlers: List[Callable[[], None]] = []
+        self._ordered: Set[str] = set()
+        self._lock = threading.Condition()
+        # Pending outgoing messages in publish order; keyed ones are replaced
+        self._outbox: Dict[Any, Tuple[str, Any, Optional[Any]]] = {}
+        self._sequence = 0
+        self._sender: Optional[threading.Thread] = None
+        self._running = False
+
+    def subscribe(self, topic: str, handler: Handler, ordered: bool = False) -> None:
+        """Call ``handler(data)`` for every message on ``topic``, from any process"""
+        self._handlers.setdefault(topic, []).append(handler)
+        if ordered:
+            self._ordered.add(topic)
+
+    def on_invalidate(self, namespace: str, handler: Callable[[Any], None]) -> None:
+        self._invalidation_handlers.setdefault(namespace, []).append(handler)
+
+    def on_reconnect(self, handler: Callable[[], None]) -> None:
+        """Called when messages from other processes may have been missed"""
+        self._reconnect_handlers.append(handler)
+
+    def publish(self, topic: str, data: Any, *, key: Optional[str] = None,
+                fallback: Optional[Any] = None) -> None:
+        """
+        Deliver ``data`` to local handlers now (ordered topics: once it comes
+        back through the transport) and to other processes after the
+        coalescing window. Pending messages with the same ``key`` are
+        replaced by the newest one.
+        """
+        if not self._running or not self.transport.remote:
+            self._dispatch(topic, data)
+            return
+        if topic not in self._ordered:
+            self._dispatch(topic, data)
+        with self._lock:
+            if key is None:
+                self._sequence += 1
+                slot = self._sequence
+            else:
+                slot = (topic, key)
+                self._outbox.pop(slot, None)
+            self._outbox[slot] = (topic, data, fallback)
+            self._lock.notify()
+
+    def invalidate(self, namespace: str, key: Any) -> None:
+        """Drop ``key`` from ``namespace`` caches in every process"""
+        self.publish(INVALIDATE, {"ns": namespace, "key": key}, key=f"{namespace}:{key}")
+
+    def receive(self, payload: str) -> None:
+        """Handle a NOTIFY payload from the transport"""
+        try:
+            message = json.loads(payload)
+            own = message["o"] == self.origin
+            items = message["m"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed backplane payload")
+            return
+        for topic, data in items:
+            # Only ordered topics weren't already delivered locally
+            if not own or topic in self._ordered:
+                self._dispatch(topic, data)
+
+    def _dispatch(self, topic: str, data: Any) -> None:
+        if topic == INVALIDATE:
+            handlers, argument = self._invalidation_handlers.get(data["ns"], ()), data["key"]
+        else:
+            handlers, argument = self._handlers.get(topic, ()), data
+        for handler in list(handlers):
+            try:
+                handler(argument)
+            except Exception:
+                logger.exception("Backplane handler for %s failed", topic)
+
+    def _reconnected(self) -> None:
+        for handler in self._reconnect_handlers:
+            try:
+                handler()
+            except Exception:
+                logger.exception("Backplane reconnect handler failed")
+
+    def _send_loop(self) -> None:
+        while True:
+            with self._lock:
+                while self._running and not self._outbox:
+                    self._lock.wait()
+                if not self._running and not self._outbox:
+                    return
+            # Let a burst of publishes collapse into one batch
+            time.sleep(settings.backplane_coalesce_ms / 1000)
+            with self._lock:
+                messages = list(self._outbox.values())
+                self._outbox.clear()
+            try:
+                self.transport.send(pack(self.origin, messages))
+            except Exception:
+                logger.exception("Backplane failed to send %d messages", len(messages))
+
+    def start(self, transport=None) -> None:
+        if self._running:
+            return
+        if transport is not None:
+            self.transport = transport
+        self._running = True
+        self.transport.start(self.receive, self._reconnected)
+        if self.transport.remote:
+            self._sender = threading.Thread(
+                target=self._send_loop, name="backplane-sender", daemon=True)
+            self._sender.start()
+
+    def stop(self) -> None:
+        if not self._running:
+            return
+        with self._lock:
+            self._running = False
+            self._lock.notify()
+        if self._sender is not None:
+            self._sender.join(timeout=10)
+            self._sender = None
+        self.transport.stop()
+
+
+def _default_transport():
+    kind = settings.backplane
+    url = make_url(settings.database_url)
+    if kind == "auto":
+        kind = "postgres" if url.get_backend_name() == "postgresql" and psycopg2 else "local"
+    if kind == "postgres":
+        dsn = url.set(drivername="postgresql").render_as_string(hide_password=False)
+        return PostgresTransport(dsn, settings.backplane_channel)
+    return LocalTransport()
+
+
+backplane = Backplane()
+
+
+def start() -> None:
+    """Connect the process-wide backplane (called from app startup)"""
+    backplane.start(_default_transport())
+
+
+def stop() -> None:
+    backplane.stop()
@@ -0,0 +1,286 @@
+"""
+Recitation and activity counters per community.
+
+``community_stats`` holds each community's total, pending and reviewed
+recitation counts. An ``after_flush`` hook adjusts them with
+``column + delta`` in the transaction that creates, re-statuses or deletes a
+recitation, so the stats endpoint reads one row.
+
+Active members are the distinct members who submitted a recitation in the
+last ``ACTIVE_WINDOW_DAYS`` days. Each member's last active day is kept in
+``community_member_activity`` and ``community_activity_days`` counts members
+per last active day. When a member is active again their count moves from
+the old day to today, so the active-member count is the sum of at most
+``ACTIVE_WINDOW_DAYS`` day buckets, and days that slid out of the window are
+dropped when a community's first bucket of the day is created.
+
+After backfills, rebuild every row with::
+
+    python -m app.services.community_stats [--community ID]
+
+Recitations submitted before they recorded a community have none, so they
+wouldn't count anywhere; the rebuild first assigns each of them to its
+author's community when the author belongs to exactly one, the same rule
+``community_for`` applies to new submissions (``backfill_communities``).
+Recitations of members of several communities stay unassigned.
+"""
+import argparse
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from app.models.community import (
+    CommunityActivityDay,
+    CommunityCounters,
+    CommunityMemberActivity,
+    CommunityMembership,
+)
+from app.models.recitation import Recitation, RecitationStatus
+
+ACTIVE_WINDOW_DAYS = 30
+
+_COUNTERS = ("total_recitations", "pending_reviews", "reviewed_recitations")
+
+
+def today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _window_start(day: date) -> date:
+    return day - timedelta(days=ACTIVE_WINDOW_DAYS - 1)
+
+
+def _status_counts(status, sign: int) -> Dict[str, int]:
+    return {
+        "pending_reviews": sign * (status == RecitationStatus.PENDING),
+        "reviewed_recitations": sign * (status == RecitationStatus.REVIEWED),
+    }
+
+
+def _dialect(connection: Connection):
+    return {"postgresql": postgresql, "sqlite": sqlite}.get(connection.dialect.name)
+
+
+def _add(connection: Connection, model, key: dict, counts: Dict[str, int]) -> None:
+    """Add ``counts`` to the row of ``model`` at ``key``, creating it if missing"""
+    table = model.__table__
+    # Upserts skip onupdate defaults
+    touched = {"updated_at": func.now()} if "updated_at" in table.c else {}
+    dialect = _dialect(connection)
+    if dialect is not None:
+        statement = dialect.insert(table).values(**key, **counts)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=list(key),
+            set_={**{column: table.c[column] + statement.excluded[column] for column in counts},
+                  **touched},
+        ))
+        return
+    updated = connection.execute(
+        update(table).where(*(table.c[column] == value for column, value in key.items()))
+        .values({**{column: table.c[column] + change for column, change in counts.items()},
+                 **touched})
+    ).rowcount
+    if not updated:
+        connection.execute(insert(table).values(**key, **counts))
+
+
+def _member_active(connection: Connection, community_id: int, user_id: int, day: date) -> None:
+    activity = CommunityMemberActivity.__table__
+    criteria = (activity.c.community_id == community_id, activity.c.user_id == user_id)
+    query = select(activity.c.last_active_on).where(*criteria).with_for_update()
+    last_active = connection.execute(query).scalar()
+    if last_active is not None and last_active >= day:
+        return
+
+    if last_active is None:
+        values = {"community_id": community_id, "user_id": user_id, "last_active_on": day}
+        dialect = _dialect(connection)
+        if dialect is None:
+            connection.execute(insert(activity).values(**values))
+        else:
+            # Another transaction may be recording the same member
+            inserted = connection.execute(dialect.insert(activity).values(**values)
+                                          .on_conflict_do_nothing(
+                                              index_elements=["community_id", "user_id"]))
+            if not inserted.rowcount:
+                return _member_active(connection, community_id, user_id, day)
+    else:
+        connection.execute(update(activity).where(*criteria).values(last_active_on=day))
+        if last_active >= _window_start(day):
+            _add(connection, CommunityActivityDay,
+                 {"community_id": community_id, "day": last_active}, {"members": -1})
+
+    days = CommunityActivityDay.__table__
+    opened = connection.execute(select(days.c.day).where(
+        days.c.community_id == community_id, days.c.day == day)).first() is None
+    _add(connection, CommunityActivityDay, {"community_id": community_id, "day": day},
+         {"members": 1})
+    if opened:
+        connection.execute(delete(days).where(
+            days.c.community_id == community_id, days.c.day < _window_start(day)))
+
+
+def _history(obj, attribute: str) -> Optional[Tuple[object, object]]:
+    history = inspect(obj).attrs[attribute].history
+    if not history.added:
+        return None
+    return (history.deleted[0] if history.deleted else None), history.added[0]
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed_recitations(session: Session, flush_context) -> None:
+    deltas: Dict[int, Dict[str, int]] = {}
+    active = set()
+
+    def add(community_id, counts: Dict[str, int]) -> None:
+        if community_id is None:
+            return
+        totals = deltas.setdefault(community_id, dict.fromkeys(_COUNTERS, 0))
+        for column, change in counts.items():
+            totals[column] += change
+
+    for obj in session.new:
+        if isinstance(obj, Recitation) and obj.community_id is not None:
+            add(obj.community_id, {"total_recitations": 1, **_status_counts(obj.status, 1)})
+            active.add((obj.community_id, obj.user_id))
+    for obj in session.deleted:
+        if isinstance(obj, Recitation):
+            add(obj.community_id, {"total_recitations": -1, **_status_counts(obj.status, -1)})
+    for obj in session.dirty:
+        if not isinstance(obj, Recitation):
+            continue
+        moved = _history(obj, "community_id")
+        status = _history(obj, "status")
+        if moved is None and status is None:
+            continue
+        old_community, new_community = moved or (obj.community_id, obj.community_id)
+        old_status, new_status = status or (obj.status, obj.status)
+        add(old_community, {"total_recitations": -1, **_status_counts(old_status, -1)})
+        add(new_community, {"total_recitations": 1, **_status_counts(new_status, 1)})
+
+    if not deltas and not active:
+        return
+    connection = session.connection()
+    for community_id, counts in deltas.items():
+        counts = {column: change for column, change in counts.items() if change}
+        if counts:
+            _add(connection, CommunityCounters, {"community_id": community_id}, counts)
+    day = today()
+    for community_id, user_id in sorted(active):
+        _member_active(connection, community_id, user_id, day)
+
+
+def community_for(db: Session, user_id: int, requested: Optional[int]) -> Optional[int]:
+    """
+    The community a new recitation of ``user_id`` is submitted to: the
+    requested one, which must be among the user's active memberships, or
+    the user's only community. Raises ``PermissionError`` for a community
+    the user is not a member of.
+    """
+    query = db.query(CommunityMembership.community_id).filter(
+        CommunityMembership.user_id == user_id, CommunityMembership.is_active == True)
+    if requested is not None:
+        if query.filter(CommunityMembership.community_id == requested).first() is None:
+            raise PermissionError("Not a member of this community")
+        return requested
+    communities = query.limit(2).all()
+    return communities[0].community_id if len(communities) == 1 else None
+
+
+def stats_for(db: Session, community_id: int) -> dict:
+    counters = db.query(*(getattr(CommunityCounters, column) for column in _COUNTERS)).filter(
+        CommunityCounters.community_id == community_id).first()
+    active_members = db.query(func.coalesce(func.sum(CommunityActivityDay.members), 0)).filter(
+        CommunityActivityDay.community_id == community_id,
+        CommunityActivityDay.day >= _window_start(today()),
+    ).scalar()
+    values = dict(counters._mapping) if counters else dict.fromkeys(_COUNTERS, 0)
+    return {**values, "active_members": int(active_members)}
+
+
+def backfill_communities(db: Session, community_id: Optional[int] = None) -> int:
+    """
+    Assign recitations without a community to their author's only active
+    community (only to ``community_id``); returns how many. The caller commits.
+    """
+    memberships = select(CommunityMembership.community_id).where(
+        CommunityMembership.user_id == Recitation.user_id,
+        CommunityMembership.is_active == True,
+    )
+    sole = memberships.with_only_columns(func.min(CommunityMembership.community_id)) \
+        .having(func.count(CommunityMembership.community_id.distinct()) == 1).scalar_subquery()
+    query = update(Recitation).where(Recitation.community_id.is_(None), sole.isnot(None))
+    if community_id is not None:
+        query = query.where(sole == community_id)
+    return db.connection().execute(query.values(community_id=sole)).rowcount
+
+
+def rebuild(db: Session, community_id: Optional[int] = None) -> int:
+    """Recompute the counters and activity (of ``community_id``); the caller commits"""
+    connection = db.connection()
+    criteria = [Recitation.community_id.isnot(None)]
+    if community_id is not None:
+        criteria.append(Recitation.community_id == community_id)
+    for model in (CommunityCounters, CommunityMemberActivity, CommunityActivityDay):
+        query = delete(model)
+        if community_id is not None:
+            query = query.where(model.community_id == community_id)
+        connection.execute(query)
+
+    counters: Dict[int, dict] = {}
+    for community, status, count in connection.execute(
+            select(Recitation.community_id, Recitation.status, func.count())
+            .where(*criteria).group_by(Recitation.community_id, Recitation.status)):
+        row = counters.setdefault(community, {"community_id": community,
+                                              **dict.fromkeys(_COUNTERS, 0)})
+        row["total_recitations"] += count
+        for column, change in _status_counts(status, count).items():
+            row[column] += change
+    if counters:
+        connection.execute(insert(CommunityCounters), list(counters.values()))
+
+    window_start = _window_start(today())
+    activity: List[dict] = []
+    days: Dict[Tuple[int, date], int] = {}
+    for community, user_id, last_active in connection.execute(
+            select(Recitation.community_id, Recitation.user_id, func.max(Recitation.created_at))
+            .where(*criteria).group_by(Recitation.community_id, Recitation.user_id)):
+        if last_active is None:
+            continue
+        day = last_active.date()
+        activity.append({"community_id": community, "user_id": user_id, "last_active_on": day})
+        if day >= window_start:
+            days[(community, day)] = days.get((community, day), 0) + 1
+    if activity:
+        connection.execute(insert(CommunityMemberActivity), activity)
+    if days:
+        connection.execute(insert(CommunityActivityDay), [
+            {"community_id": community, "day": day, "members": members}
+            for (community, day), members in days.items()])
+    return len(counters)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild community recitation counters")
+    parser.add_argument("--community", type=int, help="only rebuild this community's rows")
+    args = parser.parse_args()
+
+    from app.db.database import SessionLocal
+    from app.models import donation  # noqa: F401 - mappers User refers to
+    db = SessionLocal()
+    try:
+        assigned = backfill_communities(db, args.community)
+        count = rebuild(db, args.community)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Assigned {assigned} recitations to their author's community")
+    print(f"Rebuilt counters of {count} communities")
+
+
+if __name__ == "__main__":
+    main()
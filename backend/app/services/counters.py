@@ -0,0 +1,190 @@
+"""
+Summary counters on recitations.
+
+List views show each recitation's comment, unresolved-comment, marker and
+loop-region counts and when feedback last arrived. These are columns on
+``recitations``, so the student's list and the scholar queue read them with
+the row instead of loading child collections.
+
+Counters are adjusted with ``column = column + :delta`` in the transaction
+that writes the child rows: an ``after_flush`` hook covers ORM writes (the
+REST endpoints and co-review rooms), and the resolve toggle in
+update_comment, which bypasses the ORM, calls ``comment_resolved``.
+``check`` recounts from the child tables and reports, or fixes, any drift;
+it runs periodically and from the admin endpoints. A fix locks the drifted
+rows and then recounts them inside the UPDATE, so a child written while the
+check ran is counted once, either by the recount or by its hook.
+"""
+import logging
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import case, event, func, inspect, or_, select, union_all, update
+from sqlalchemy.orm import Session
+
+from app.db.database import SessionLocal
+from app.models.comment import Comment
+from app.models.marker import LoopRegion, Marker
+from app.models.recitation import Recitation
+
+logger = logging.getLogger(__name__)
+
+_COUNTED = {Comment: "comment_count", Marker: "marker_count", LoopRegion: "loop_region_count"}
+
+
+def _feedback_times():
+    return union_all(*(
+        select(model.recitation_id, model.created_at) for model in _COUNTED
+    )).subquery()
+
+
+def _last_feedback(recitation_id: int):
+    times = _feedback_times()
+    return select(func.max(times.c.created_at)).where(
+        times.c.recitation_id == recitation_id).scalar_subquery()
+
+
+def _adjust(connection, recitation_id: int, counts: Dict[str, int],
+            feedback_changed: bool = False) -> None:
+    values = {column: getattr(Recitation, column) + change
+              for column, change in counts.items() if change}
+    if feedback_changed:
+        values["last_feedback_at"] = _last_feedback(recitation_id)
+    if values:
+        # Counters aren't an edit of the recitation: keep updated_at
+        connection.execute(update(Recitation).where(Recitation.id == recitation_id).values(
+            **values, updated_at=Recitation.updated_at))
+
+
+@event.listens_for(Session, "after_flush")
+def _count_flushed_children(session: Session, flush_context) -> None:
+    deltas: Dict[int, Dict[str, int]] = {}
+    added_or_removed: Set[int] = set()
+    for objects, sign in ((session.new, 1), (session.deleted, -1)):
+        for obj in objects:
+            column = _COUNTED.get(type(obj))
+            if column is None:
+                continue
+            counts = deltas.setdefault(obj.recitation_id, {})
+            counts[column] = counts.get(column, 0) + sign
+            if column == "comment_count" and not obj.is_resolved:
+                counts["unresolved_comment_count"] = \
+                    counts.get("unresolved_comment_count", 0) + sign
+            added_or_removed.add(obj.recitation_id)
+    for obj in session.dirty:
+        if not isinstance(obj, Comment):
+            continue
+        history = inspect(obj).attrs.is_resolved.history
+        if history.added and history.deleted:
+            counts = deltas.setdefault(obj.recitation_id, {})
+            counts["unresolved_comment_count"] = counts.get("unresolved_comment_count", 0) + (
+                bool(history.deleted[0]) - bool(history.added[0]))
+    if not deltas:
+        return
+
+    connection = session.connection()
+    for recitation_id, counts in deltas.items():
+        _adjust(connection, recitation_id, counts, recitation_id in added_or_removed)
+
+
+def comment_resolved(db: Session, recitation_id: int, resolved: bool) -> None:
+    """A comment on ``recitation_id`` was resolved (or reopened) without the ORM"""
+    _adjust(db.connection(), recitation_id, {"unresolved_comment_count": -1 if resolved else 1})
+
+
+def _actual_counts():
+    """Per-recitation counters recomputed from the child tables"""
+    comments = select(
+        Comment.recitation_id,
+        func.count().label("comment_count"),
+        func.sum(case((Comment.is_resolved.is_(True), 0), else_=1)).label(
+            "unresolved_comment_count"),
+    ).group_by(Comment.recitation_id).subquery()
+    markers = select(Marker.recitation_id, func.count().label("marker_count")).group_by(
+        Marker.recitation_id).subquery()
+    loops = select(LoopRegion.recitation_id, func.count().label("loop_region_count")).group_by(
+        LoopRegion.recitation_id).subquery()
+    times = _feedback_times()
+    feedback = select(times.c.recitation_id, func.max(times.c.created_at).label(
+        "last_feedback_at")).group_by(times.c.recitation_id).subquery()
+    actual = {
+        "comment_count": func.coalesce(comments.c.comment_count, 0),
+        "unresolved_comment_count": func.coalesce(comments.c.unresolved_comment_count, 0),
+        "marker_count": func.coalesce(markers.c.marker_count, 0),
+        "loop_region_count": func.coalesce(loops.c.loop_region_count, 0),
+        "last_feedback_at": feedback.c.last_feedback_at,
+    }
+    joins = [(comments, comments.c.recitation_id), (markers, markers.c.recitation_id),
+             (loops, loops.c.recitation_id), (feedback, feedback.c.recitation_id)]
+    return actual, joins
+
+
+def check(db: Session, fix: bool = False, limit: Optional[int] = None) -> List[dict]:
+    """
+    Recitations whose stored counters disagree with their comments, markers
+    and loop regions. With ``fix`` the stored values are corrected; the
+    caller commits.
+    """
+    actual, joins = _actual_counts()
+    query = select(
+        Recitation.id,
+        *(getattr(Recitation, column) for column in actual),
+        *(expression.label(f"actual_{column}") for column, expression in actual.items()),
+    )
+    for subquery, recitation_id in joins:
+        query = query.outerjoin(subquery, recitation_id == Recitation.id)
+    query = query.where(or_(*(
+        getattr(Recitation, column).is_distinct_from(expression)
+        for column, expression in actual.items()
+    ))).order_by(Recitation.id)
+    if limit is not None:
+        query = query.limit(limit)
+
+    drift = []
+    for row in db.execute(query):
+        mapping = row._mapping
+        drift.append({
+            "recitation_id": row.id,
+            "stored": {column: mapping[column] for column in actual},
+            "actual": {column: mapping[f"actual_{column}"] for column in actual},
+        })
+    if fix and drift:
+        _recount(db, [item["recitation_id"] for item in drift])
+    return drift
+
+
+def _count_of(model, *criteria):
+    return select(func.count()).where(
+        model.recitation_id == Recitation.id, *criteria).scalar_subquery()
+
+
+def _recount(db: Session, recitation_ids: List[int]) -> None:
+    """
+    Store counters recomputed by the UPDATE itself. The rows are locked
+    first: a writer whose hook already adjusted one has committed by then,
+    and on Postgres the UPDATE's fresh snapshot sees its child rows too.
+    """
+    db.execute(select(Recitation.id).where(Recitation.id.in_(recitation_ids))
+               .order_by(Recitation.id).with_for_update())
+    values = {column: _count_of(model) for model, column in _COUNTED.items()}
+    db.execute(
+        update(Recitation)
+        .where(Recitation.id.in_(recitation_ids))
+        .values(
+            **values,
+            unresolved_comment_count=_count_of(Comment, Comment.is_resolved.isnot(True)),
+            # Same expression as the hook, so SQLite stores the same text
+            last_feedback_at=_last_feedback(Recitation.id),
+            updated_at=Recitation.updated_at,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reconcile() -> int:
+    """Fix drifted counters (periodic job); returns the number of recitations fixed"""
+    with SessionLocal() as db:
+        drift = check(db, fix=True)
+        db.commit()
+    if drift:
+        logger.warning("Reconciled summary counters of %d recitations", len(drift))
+    return len(drift)
@@ -0,0 +1,86 @@
+"""
+Which recitations cover a passage of the Qur'an.
+
+Recitations store the global indexes of their first and last ayah (see
+``app.core.quran``), so coverage is a range overlap on two integers. On
+Postgres the overlap is written against the ``ix_recitations_ayah_range``
+GiST expression so it is answered from that index; elsewhere it uses the
+``(ayah_index_start, ayah_index_end)`` btree.
+
+Recitations created before these columns existed are filled in from their
+``surah_name`` and ayah range by ``backfill_references``, which the
+progress rebuild (``python -m app.services.progress``) runs first.
+"""
+import logging
+from typing import Optional, Tuple
+
+from sqlalchemy import and_, bindparam, func, literal_column, or_, select, update
+from sqlalchemy.orm import Query, Session
+
+from app.core import quran
+from app.models.recitation import Recitation
+
+logger = logging.getLogger(__name__)
+BACKFILL_BATCH = 1000
+
+
+def _is_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+
+def _ayah_range(lower, upper):
+    return func.int4range(lower, upper, literal_column("'[]'"))
+
+
+def reference_columns(surah_number: int, ayah_start: int, ayah_end: int) -> dict:
+    """Indexed reference columns for a validated surah and ayah range"""
+    return {
+        "surah_number": surah_number,
+        "ayah_index_start": quran.ayah_index(surah_number, ayah_start),
+        "ayah_index_end": quran.ayah_index(surah_number, ayah_end),
+    }
+
+
+def overlaps(db: Session, first: int, last: int):
+    """Criterion for recitations covering any ayah of global indexes [first, last]"""
+    if _is_postgres(db):
+        # Must match the ix_recitations_ayah_range expression to use the GiST index
+        return _ayah_range(Recitation.ayah_index_start, Recitation.ayah_index_end).op("&&")(
+            _ayah_range(first, last))
+    return and_(Recitation.ayah_index_start <= last, Recitation.ayah_index_end >= first)
+
+
+def covering(db: Session, query: Query, surah: int, ayah_start: int,
+             ayah_end: Optional[int] = None) -> Query:
+    """Restrict ``query`` to recitations that include any of surah:ayah_start-ayah_end"""
+    ayah_end = ayah_start if ayah_end is None else ayah_end
+    return query.filter(overlaps(
+        db, quran.ayah_index(surah, ayah_start), quran.ayah_index(surah, ayah_end)))
+
+
+def backfill_references(db: Session) -> Tuple[int, int]:
+    """
+    Fill in the reference columns of recitations missing them; returns
+    (updated, unresolved). Rows whose surah name or range doesn't validate
+    are left as they are and logged. The caller commits.
+    """
+    connection = db.connection()
+    rows = connection.execute(
+        select(Recitation.id, Recitation.surah_name, Recitation.ayah_start, Recitation.ayah_end)
+        .where(or_(Recitation.surah_number.is_(None), Recitation.ayah_index_start.is_(None),
+                   Recitation.ayah_index_end.is_(None)))
+    ).all()
+    updates, unresolved = [], 0
+    for recitation_id, surah_name, ayah_start, ayah_end in rows:
+        try:
+            number = quran.validate_range(surah_name, ayah_start, ayah_end)
+        except ValueError as exc:
+            logger.warning("Recitation %d keeps no surah reference: %s", recitation_id, exc)
+            unresolved += 1
+            continue
+        updates.append({"row_id": recitation_id,
+                        **reference_columns(number, ayah_start, ayah_end)})
+    statement = update(Recitation).where(Recitation.id == bindparam("row_id"))
+    for start in range(0, len(updates), BACKFILL_BATCH):
+        connection.execute(statement, updates[start:start + BACKFILL_BATCH])
+    return len(updates), unresolved
@@ -0,0 +1,207 @@
+"""
+Live events for a student's recitations.
+
+Endpoints publish comment, marker, loop-region and status events addressed
+to the owner of the recitation they touch; the SSE stream subscribes per
+user. Publishing is thread-safe (sync endpoints run in the threadpool) and
+never blocks: each event is framed once and handed to every open
+connection's bounded queue on that connection's event loop.
+
+Every user has a bounded replay buffer so a reconnecting client can resume
+from ``Last-Event-ID``. A connection whose queue fills up (a client that
+stopped reading) is closed once the queued events are flushed; the client
+reconnects and picks up the dropped events from the replay buffer. When
+the client's last event is no longer in the buffer (it was evicted, came
+from a previous process or hasn't reached this one yet) the stream starts
+with a ``reset`` event and the client should refetch through /sync/changes.
+
+Events travel through the backplane as an ordered topic: every process,
+the publishing one included, receives them in the same order with the same
+ids. Ids (``<origin>-<n>``) are unique but not comparable across
+processes, so a resume sends whatever follows the client's last event in
+the buffer rather than everything with a higher id.
+"""
+import asyncio
+import itertools
+import threading
+import uuid
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Set
+
+from app.core.config import settings
+from app.core.serialization import dumps
+from app.services.backplane import backplane
+
+TOPIC = "events"
+RESET = "reset"
+RETRY_MS = 3000
+
+
+class Event:
+    __slots__ = ("id", "user_id", "type", "frame")
+
+    def __init__(self, event_id: str, user_id: int, event_type: str, data: bytes):
+        self.id = event_id
+        self.user_id = user_id
+        self.type = event_type
+        self.frame = b"id: %s\nevent: %s\ndata: %s\n\n" % (
+            event_id.encode(), event_type.encode(), data)
+
+
+class _ReplayBuffer:
+    __slots__ = ("events",)
+
+    def __init__(self, size: int):
+        self.events: Deque[Event] = deque(maxlen=size)
+
+    def after(self, event_id: str) -> Optional[List[Event]]:
+        """Events received after ``event_id``, or None if it isn't buffered"""
+        for index in range(len(self.events) - 1, -1, -1):
+            if self.events[index].id == event_id:
+                return list(itertools.islice(self.events, index + 1, None))
+        return None
+
+
+class Subscription:
+    """One open stream: a bounded queue fed on its own event loop"""
+
+    def __init__(self, broker: "EventBroker", user_id: int, queue_size: int):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: "asyncio.Queue[Event]" = asyncio.Queue(queue_size)
+        self.backlog: List[Event] = []
+        self.reset = False
+        self.reset_id: Optional[str] = None
+        self.overflowed = False
+
+    def offer(self, event: Event) -> None:
+        # Offered in buffer order, and only events after the backlog
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    async def stream(self, heartbeat: float) -> AsyncIterator[bytes]:
+        """SSE frames: backlog, then live events with periodic heartbeats"""
+        try:
+            yield b"retry: %d\n\n" % RETRY_MS
+            if self.reset:
+                # Without an id the client would keep resuming from the lost one
+                event_id = b"id: %s\n" % self.reset_id.encode() if self.reset_id else b""
+                yield b"%sevent: %s\ndata: {}\n\n" % (event_id, RESET.encode())
+            for event in self.backlog:
+                yield event.frame
+            self.backlog = []
+            while not (self.overflowed and self.queue.empty()):
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), heartbeat)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                yield event.frame
+        finally:
+            self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    def __init__(self, replay_size: int, buffered_users: int, queue_size: int):
+        self.replay_size = replay_size
+        self.buffered_users = buffered_users
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._buffers: "OrderedDict[int, _ReplayBuffer]" = OrderedDict()
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self.origin = uuid.uuid4().hex[:8]
+        self._sequence = itertools.count(1)
+
+    def next_id(self) -> str:
+        return f"{self.origin}-{next(self._sequence)}"
+
+    def publish(self, user_id: int, event_type: str, data: dict,
+                event_id: Optional[str] = None) -> Event:
+        payload = dumps(data)
+        closed = []
+        with self._lock:
+            event = Event(event_id or self.next_id(), user_id, event_type, payload)
+            buffer = self._buffers.get(user_id)
+            if buffer is None:
+                buffer = self._buffers[user_id] = _ReplayBuffer(self.replay_size)
+                if len(self._buffers) > self.buffered_users:
+                    self._buffers.popitem(last=False)
+            else:
+                self._buffers.move_to_end(user_id)
+            buffer.events.append(event)
+            # Handed over under the lock so every stream gets buffer order
+            for subscription in self._subscribers.get(user_id, ()):
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.offer, event)
+                except RuntimeError:  # Loop already closed
+                    closed.append(subscription)
+
+        for subscription in closed:
+            self.unsubscribe(subscription)
+        return event
+
+    def subscribe(self, user_id: int, last_event_id: Optional[str] = None) -> Subscription:
+        """Register a stream; must be called on the event loop that reads it"""
+        subscription = Subscription(self, user_id, self.queue_size)
+        with self._lock:
+            if last_event_id is not None:
+                buffer = self._buffers.get(user_id)
+                backlog = buffer.after(last_event_id) if buffer else None
+                if backlog is None:
+                    subscription.reset = True
+                    subscription.reset_id = buffer.events[-1].id if buffer else None
+                else:
+                    subscription.backlog = backlog
+            self._subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    def forget_history(self) -> None:
+        """Make every resume start with a reset (events may have been missed)"""
+        with self._lock:
+            self._buffers.clear()
+
+    def backlog(self, user_id: int) -> List[Event]:
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            return list(buffer.events) if buffer else []
+
+    def connection_count(self) -> int:
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+broker = EventBroker(
+    replay_size=settings.events_replay_size,
+    buffered_users=settings.events_buffered_users,
+    queue_size=settings.events_queue_size,
+)
+
+
+def publish(user_id: int, event_type: str, data: dict) -> None:
+    """Send an event to ``user_id``'s streams in every process"""
+    message = {"user_id": user_id, "type": event_type, "id": broker.next_id()}
+    backplane.publish(TOPIC, {**message, "data": data},
+                      fallback={**message, "data": {"truncated": True}})
+
+
+def _deliver(message: dict) -> None:
+    broker.publish(message["user_id"], message["type"], message["data"],
+                   event_id=message["id"])
+
+
+backplane.subscribe(TOPIC, _deliver, ordered=True)
+backplane.on_reconnect(broker.forget_history)
@@ -0,0 +1,71 @@
+"""
+Nearby community search.
+
+Communities with coordinates also store their geohash. A search turns the
+radius into a bounding box and narrows candidates with an index: on
+Postgres, a GiST index on ``point(longitude, latitude)`` answers a box
+containment; elsewhere (SQLite in tests), the box's covering geohash
+prefixes become range scans of the geohash index. Distance filtering and
+ordering then happen in SQL on the candidates, using an equirectangular
+approximation (accurate to well under 1% at search radii) that needs only
+arithmetic, so it runs on any database.
+"""
+import math
+from typing import List, Tuple
+
+from sqlalchemy import and_, case, event, func, literal, or_
+from sqlalchemy.orm import Session
+
+from app.core import geohash
+from app.models.community import Community
+
+
+@event.listens_for(Community, "before_insert")
+@event.listens_for(Community, "before_update")
+def _set_geohash(mapper, connection, community: Community) -> None:
+    if community.latitude is None or community.longitude is None:
+        community.geohash = None
+    else:
+        community.geohash = geohash.encode(community.latitude, community.longitude)
+
+
+def _in_box(db: Session, south: float, west: float, north: float, east: float):
+    if db.get_bind().dialect.name == "postgresql":
+        # Must match the ix_communities_location expression to use the GiST index
+        position = func.point(Community.longitude, Community.latitude)
+        boxes = [(west, east)]
+        if west < -180:
+            boxes = [(-180.0, east), (west + 360, 180.0)]
+        elif east > 180:
+            boxes = [(west, 180.0), (-180.0, east - 360)]
+        return or_(*(position.op("<@")(func.box(func.point(low, south), func.point(high, north)))
+                     for low, high in boxes))
+
+    prefixes = geohash.cover(south, west, north, east)
+    if not prefixes:
+        return literal(True)
+    return or_(*(and_(Community.geohash >= prefix,
+                      Community.geohash < geohash.prefix_upper_bound(prefix))
+                 for prefix in prefixes))
+
+
+def nearby(db: Session, latitude: float, longitude: float, radius_km: float,
+           limit: int = 20) -> List[Tuple[Community, float]]:
+    """Active communities within ``radius_km``, nearest first, with their distance in km"""
+    delta_lon = Community.longitude - longitude
+    delta_lon = case((delta_lon > 180, delta_lon - 360),
+                     (delta_lon < -180, delta_lon + 360), else_=delta_lon)
+    x = delta_lon * math.cos(math.radians(latitude))
+    y = Community.latitude - latitude
+    # Squared distance in degrees of latitude: no square root needed to compare
+    distance = (x * x + y * y).label("distance")
+    radius = radius_km / geohash.KM_PER_DEGREE
+
+    rows = db.query(Community, distance).filter(
+        Community.is_active == True,
+        Community.latitude.isnot(None),
+        _in_box(db, *geohash.bounding_box(latitude, longitude, radius_km)),
+        distance <= radius * radius,
+    ).order_by(distance, Community.id).limit(limit).all()
+    return [(community, math.sqrt(squared) * geohash.KM_PER_DEGREE)
+            for community, squared in rows]
@@ -0,0 +1,139 @@
+"""
+Community invitations.
+
+A community admin invites a whole class at once: ``issue`` draws every
+token from one ``os.urandom`` call and writes the invitations with
+multi-row INSERTs. Only a SHA-256 hash of each token is stored, in the
+unique ``token`` column, so redeeming is one indexed lookup and a leaked
+table doesn't leak usable tokens. The plain tokens are returned once, to be
+sent to the invitees.
+
+An invitation's role is granted as is, except that ``scholar`` only goes
+to users with the scholar role; anyone else joins as a member, as they
+would through the join endpoint.
+
+``sweep`` runs periodically and deletes used and expired invitations in
+bounded batches.
+"""
+import base64
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+from sqlalchemy import insert, or_, update
+from sqlalchemy.orm import Session
+
+from app.core import tasks
+from app.core.config import settings
+from app.db.database import SessionLocal
+from app.models.community import CommunityInvitation, CommunityMembership
+from app.models.user import User, UserRole
+
+TOKEN_BYTES = 32
+# Rows per INSERT: 6 parameters each keeps a statement well under SQLite's
+# variable limit
+INSERT_CHUNK = 500
+
+
+class InvitationError(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _aware(value: datetime) -> datetime:
+    # SQLite hands timestamps back without their timezone
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def new_tokens(count: int) -> List[str]:
+    entropy = os.urandom(TOKEN_BYTES * count)
+    return [
+        base64.urlsafe_b64encode(entropy[i:i + TOKEN_BYTES]).rstrip(b"=").decode()
+        for i in range(0, len(entropy), TOKEN_BYTES)
+    ]
+
+
+def issue(db: Session, community_id: int, inviter_id: int, emails: Iterable[str],
+          role: str = "member", expires_in_days: Optional[int] = None) -> List[dict]:
+    """
+    Invite every address in ``emails`` (duplicates ignored, case-insensitively)
+    and return each with its plain token; the caller commits.
+    """
+    unique = list(dict.fromkeys(email.strip().lower() for email in emails))
+    expires_at = tasks.utcnow() + timedelta(days=expires_in_days or settings.invitation_expire_days)
+    tokens = new_tokens(len(unique))
+    rows = [
+        {"community_id": community_id, "invited_by": inviter_id, "email": email,
+         "role": role, "token": hash_token(token), "expires_at": expires_at}
+        for email, token in zip(unique, tokens)
+    ]
+    for start in range(0, len(rows), INSERT_CHUNK):
+        db.execute(insert(CommunityInvitation).values(rows[start:start + INSERT_CHUNK]))
+    return [{"email": email, "token": token, "expires_at": expires_at}
+            for email, token in zip(unique, tokens)]
+
+
+def redeem(db: Session, token: str, user: User) -> CommunityMembership:
+    """
+    Join ``user`` to the community ``token`` invites them to, with the
+    invited role (``member`` instead of ``scholar`` for users who aren't
+    scholars), and commit. Raises ``InvitationError``.
+    """
+    invitation = db.query(CommunityInvitation).filter(
+        CommunityInvitation.token == hash_token(token)).first()
+    if invitation is None:
+        raise InvitationError(404, "Invitation not found")
+    if invitation.email.lower() != user.email.lower():
+        raise InvitationError(403, "This invitation is for a different email address")
+    if invitation.is_used:
+        raise InvitationError(409, "Invitation has already been used")
+    if _aware(invitation.expires_at) <= tasks.utcnow():
+        raise InvitationError(410, "Invitation has expired")
+
+    # Claim it so a concurrent redemption of the same token fails
+    claimed = db.execute(
+        update(CommunityInvitation)
+        .where(CommunityInvitation.id == invitation.id, CommunityInvitation.is_used == False)
+        .values(is_used=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not claimed:
+        db.rollback()
+        raise InvitationError(409, "Invitation has already been used")
+
+    role = invitation.role
+    if role == "scholar" and user.role != UserRole.SCHOLAR:
+        role = "member"
+    membership = db.query(CommunityMembership).filter(
+        CommunityMembership.community_id == invitation.community_id,
+        CommunityMembership.user_id == user.id,
+    ).first()
+    if membership is None:
+        membership = CommunityMembership(
+            community_id=invitation.community_id, user_id=user.id, role=role)
+        db.add(membership)
+    else:
+        if not membership.is_active or membership.role == "member":
+            membership.role = role
+        membership.is_active = True
+        membership.left_at = None
+    db.commit()
+    db.refresh(membership)
+    return membership
+
+
+def sweep(batch_size: Optional[int] = None) -> int:
+    """Delete used and expired invitations in bounded batches; returns the number removed"""
+    with SessionLocal() as db:
+        return tasks.delete_in_batches(
+            db, CommunityInvitation,
+            or_(CommunityInvitation.is_used == True,
+                CommunityInvitation.expires_at <= tasks.utcnow()),
+            batch_size=batch_size)
@@ -0,0 +1,371 @@
+"""
+Per-surah progress for each student.
+
+``student_progress`` has one row per (user, surah) with the ayahs the
+student has recited (a bitmap and its count), how many recitations were
+submitted and reviewed, how many comments are still unresolved and how many
+markers of each category scholars have placed. Dashboards read one row
+instead of scanning the student's recitations and their annotations.
+
+Rows are maintained incrementally: an ``after_flush`` hook turns the
+recitations, comments and markers written in a flush into per-row deltas
+and applies them in the same transaction. Writes that bypass the ORM call
+``comment_resolved`` or ``refresh_recitation`` themselves. Changes that
+can't be applied as a delta, such as a deleted recitation (it may uncover
+ayahs) or a marker re-categorised by a bulk UPDATE, recount that one row.
+
+After backfills or schema changes, rebuild every row with::
+
+    python -m app.services.progress [--user ID]
+
+which first fills in the surah number and ayah indexes of recitations
+stored before they existed (``coverage.backfill_references``).
+"""
+import argparse
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from app.core import quran
+from app.models.comment import Comment
+from app.models.marker import Marker
+from app.models.progress import StudentProgress
+from app.models.recitation import Recitation, RecitationStatus
+
+DEFAULT_CATEGORY = "general"
+
+Key = Tuple[int, int]  # (user_id, surah_number)
+
+
+def empty_bitmap(surah: int) -> bytes:
+    return bytes((quran.AYAH_COUNTS[surah] + 7) // 8)
+
+
+def mark_ayahs(bitmap: bytearray, ayah_start: int, ayah_end: int) -> None:
+    for ayah in range(ayah_start, ayah_end + 1):
+        bitmap[(ayah - 1) >> 3] |= 1 << ((ayah - 1) & 7)
+
+
+def covered_count(bitmap: bytes) -> int:
+    return int.from_bytes(bitmap, "little").bit_count()
+
+
+def covered_ranges(bitmap: bytes) -> List[List[int]]:
+    """Runs of covered ayahs as [first, last] pairs"""
+    bits = int.from_bytes(bitmap, "little")
+    ranges: List[List[int]] = []
+    ayah = 1
+    while bits:
+        if bits & 1:
+            if ranges and ranges[-1][1] == ayah - 1:
+                ranges[-1][1] = ayah
+            else:
+                ranges.append([ayah, ayah])
+        bits >>= 1
+        ayah += 1
+    return ranges
+
+
+class _Delta:
+    __slots__ = ("ranges", "recitations", "reviewed", "unresolved", "errors", "recount")
+
+    def __init__(self):
+        self.ranges: List[Tuple[int, int]] = []
+        self.recitations = 0
+        self.reviewed = 0
+        self.unresolved = 0
+        self.errors: Dict[str, int] = {}
+        self.recount = False
+
+    def count_error(self, category: Optional[str], change: int) -> None:
+        category = category or DEFAULT_CATEGORY
+        self.errors[category] = self.errors.get(category, 0) + change
+
+
+def _empty_values(user_id: int, surah: int) -> dict:
+    return {
+        "user_id": user_id,
+        "surah_number": surah,
+        "covered": empty_bitmap(surah),
+        "ayahs_covered": 0,
+        "recitation_count": 0,
+        "reviewed_count": 0,
+        "unresolved_comments": 0,
+        "error_counts": {},
+    }
+
+
+def _lock_row(connection: Connection, user_id: int, surah: int):
+    """The progress row for (user, surah), created if missing and locked for update"""
+    query = select(StudentProgress.__table__).where(
+        StudentProgress.user_id == user_id, StudentProgress.surah_number == surah
+    ).with_for_update()
+    row = connection.execute(query).first()
+    if row is not None:
+        return row
+    values = _empty_values(user_id, surah)
+    dialect = {"postgresql": postgresql, "sqlite": sqlite}.get(connection.dialect.name)
+    if dialect is None:
+        connection.execute(insert(StudentProgress).values(**values))
+    else:
+        # Another transaction may be creating the same row
+        connection.execute(dialect.insert(StudentProgress).values(**values)
+                           .on_conflict_do_nothing(index_elements=["user_id", "surah_number"]))
+    return connection.execute(query).one()
+
+
+def _apply(connection: Connection, deltas: Dict[Key, _Delta]) -> None:
+    for (user_id, surah), delta in deltas.items():
+        if delta.recount:
+            _recount(connection, user_id, surah)
+            continue
+        row = _lock_row(connection, user_id, surah)
+        covered = bytearray(row.covered)
+        for ayah_start, ayah_end in delta.ranges:
+            mark_ayahs(covered, ayah_start, ayah_end)
+        errors = dict(row.error_counts or {})
+        for category, change in delta.errors.items():
+            count = errors.get(category, 0) + change
+            if count > 0:
+                errors[category] = count
+            else:
+                errors.pop(category, None)
+        connection.execute(update(StudentProgress).where(StudentProgress.id == row.id).values(
+            covered=bytes(covered),
+            ayahs_covered=covered_count(covered),
+            recitation_count=row.recitation_count + delta.recitations,
+            reviewed_count=row.reviewed_count + delta.reviewed,
+            unresolved_comments=row.unresolved_comments + delta.unresolved,
+            error_counts=errors,
+        ))
+
+
+def _compute(connection: Connection, user_id: Optional[int] = None,
+             surah: Optional[int] = None) -> Dict[Key, dict]:
+    """Progress rows recomputed from recitations, comments and markers"""
+    criteria = [Recitation.surah_number.isnot(None)]
+    if user_id is not None:
+        criteria.append(Recitation.user_id == user_id)
+    if surah is not None:
+        criteria.append(Recitation.surah_number == surah)
+
+    rows: Dict[Key, dict] = {}
+    for owner, number, ayah_start, ayah_end, status in connection.execute(select(
+            Recitation.user_id, Recitation.surah_number, Recitation.ayah_start,
+            Recitation.ayah_end, Recitation.status).where(*criteria)):
+        row = rows.get((owner, number))
+        if row is None:
+            row = rows[(owner, number)] = _empty_values(owner, number)
+            row["covered"] = bytearray(row["covered"])
+        mark_ayahs(row["covered"], ayah_start, ayah_end)
+        row["recitation_count"] += 1
+        row["reviewed_count"] += status == RecitationStatus.REVIEWED
+
+    key_columns = (Recitation.user_id, Recitation.surah_number)
+    for owner, number, count in connection.execute(
+            select(*key_columns, func.count()).select_from(Comment)
+            .join(Recitation, Recitation.id == Comment.recitation_id)
+            .where(Comment.is_resolved.isnot(True), *criteria).group_by(*key_columns)):
+        rows[(owner, number)]["unresolved_comments"] = count
+    for owner, number, category, count in connection.execute(
+            select(*key_columns, Marker.category, func.count()).select_from(Marker)
+            .join(Recitation, Recitation.id == Marker.recitation_id)
+            .where(*criteria).group_by(*key_columns, Marker.category)):
+        errors = rows[(owner, number)]["error_counts"]
+        category = category or DEFAULT_CATEGORY
+        errors[category] = errors.get(category, 0) + count
+
+    for row in rows.values():
+        row["covered"] = bytes(row["covered"])
+        row["ayahs_covered"] = covered_count(row["covered"])
+    return rows
+
+
+def _recount(connection: Connection, user_id: int, surah: int) -> None:
+    values = _compute(connection, user_id, surah).get((user_id, surah))
+    if values is None:
+        connection.execute(delete(StudentProgress).where(
+            StudentProgress.user_id == user_id, StudentProgress.surah_number == surah))
+        return
+    row = _lock_row(connection, user_id, surah)
+    connection.execute(update(StudentProgress).where(StudentProgress.id == row.id).values(
+        **values))
+
+
+def _change(obj, attribute: str) -> Optional[Tuple[object, object]]:
+    """(old, new) if ``attribute`` changed in this flush"""
+    history = inspect(obj).attrs[attribute].history
+    if not history.added:
+        return None
+    return (history.deleted[0] if history.deleted else None), history.added[0]
+
+
+def _before(obj, attribute: str):
+    change = _change(obj, attribute)
+    return change[0] if change else getattr(obj, attribute)
+
+
+@event.listens_for(Session, "after_flush")
+def _track_flushed_changes(session: Session, flush_context) -> None:
+    recitations, annotations = [], []
+    for objects in (session.new, session.dirty, session.deleted):
+        for obj in objects:
+            if isinstance(obj, Recitation):
+                recitations.append((obj, objects))
+            elif isinstance(obj, (Comment, Marker)):
+                annotations.append((obj, objects))
+    if not recitations and not annotations:
+        return
+
+    deltas: Dict[Key, _Delta] = {}
+
+    def delta_for(user_id, surah) -> Optional[_Delta]:
+        if user_id is None or surah is None:
+            return None
+        if (user_id, surah) not in deltas:
+            deltas[(user_id, surah)] = _Delta()
+        return deltas[(user_id, surah)]
+
+    for obj, objects in recitations:
+        if objects is session.new:
+            delta = delta_for(obj.user_id, obj.surah_number)
+            if delta is not None:
+                delta.recitations += 1
+                delta.ranges.append((obj.ayah_start, obj.ayah_end))
+                delta.reviewed += obj.status == RecitationStatus.REVIEWED
+        elif objects is session.deleted:
+            delta = delta_for(obj.user_id, obj.surah_number)
+            if delta is not None:
+                delta.recount = True
+        elif any(_change(obj, attribute) for attribute in
+                 ("user_id", "surah_number", "ayah_start", "ayah_end")):
+            for delta in (delta_for(_before(obj, "user_id"), _before(obj, "surah_number")),
+                          delta_for(obj.user_id, obj.surah_number)):
+                if delta is not None:
+                    delta.recount = True
+        else:
+            change = _change(obj, "status")
+            delta = delta_for(obj.user_id, obj.surah_number)
+            if change and delta is not None:
+                delta.reviewed += ((change[1] == RecitationStatus.REVIEWED)
+                                   - (change[0] == RecitationStatus.REVIEWED))
+
+    connection = session.connection()
+    if annotations:
+        # Comments and markers count towards their recitation's (owner, surah)
+        recitation_ids = {obj.recitation_id for obj, _ in annotations}
+        keys = {
+            recitation_id: (owner, number) for recitation_id, owner, number in connection.execute(
+                select(Recitation.id, Recitation.user_id, Recitation.surah_number)
+                .where(Recitation.id.in_(recitation_ids)))
+        }
+        for obj, objects in annotations:
+            delta = delta_for(*keys.get(obj.recitation_id, (None, None)))
+            if delta is None:
+                continue
+            if isinstance(obj, Comment):
+                if objects is session.new:
+                    delta.unresolved += not obj.is_resolved
+                elif objects is session.deleted:
+                    delta.unresolved -= not obj.is_resolved
+                elif (change := _change(obj, "is_resolved")):
+                    delta.unresolved += bool(change[0]) - bool(change[1])
+            elif objects is session.new:
+                delta.count_error(obj.category, 1)
+            elif objects is session.deleted:
+                delta.count_error(obj.category, -1)
+            elif (change := _change(obj, "category")):
+                delta.count_error(change[0], -1)
+                delta.count_error(change[1], 1)
+
+    if deltas:
+        _apply(connection, deltas)
+
+
+def _recitation_key(db: Session, recitation_id: int) -> Optional[Key]:
+    row = db.query(Recitation.user_id, Recitation.surah_number).filter(
+        Recitation.id == recitation_id).first()
+    if row is None or row.surah_number is None:
+        return None
+    return row.user_id, row.surah_number
+
+
+def comment_resolved(db: Session, recitation_id: int, resolved: bool) -> None:
+    """A comment on ``recitation_id`` was resolved (or reopened) without the ORM"""
+    key = _recitation_key(db, recitation_id)
+    if key is not None:
+        delta = _Delta()
+        delta.unresolved = -1 if resolved else 1
+        _apply(db.connection(), {key: delta})
+
+
+def refresh_recitation(db: Session, recitation_id: int) -> None:
+    """Recount the progress row ``recitation_id`` contributes to"""
+    key = _recitation_key(db, recitation_id)
+    if key is not None:
+        _recount(db.connection(), *key)
+
+
+def render(row) -> dict:
+    return {
+        "surah_number": row.surah_number,
+        "surah_name": quran.surah_name(row.surah_number),
+        "total_ayahs": quran.AYAH_COUNTS[row.surah_number],
+        "ayahs_covered": row.ayahs_covered,
+        "covered_ranges": covered_ranges(row.covered),
+        "recitation_count": row.recitation_count,
+        "reviewed_count": row.reviewed_count,
+        "unresolved_comments": row.unresolved_comments,
+        "error_counts": row.error_counts or {},
+        "updated_at": row.updated_at,
+    }
+
+
+def progress_for(db: Session, user_id: int, surah: Optional[int] = None) -> List[dict]:
+    query = db.query(StudentProgress).filter(StudentProgress.user_id == user_id)
+    if surah is not None:
+        query = query.filter(StudentProgress.surah_number == surah)
+    return [render(row) for row in query.order_by(StudentProgress.surah_number)]
+
+
+def empty_progress(surah: int) -> dict:
+    return render(StudentProgress(**_empty_values(0, surah)))
+
+
+def rebuild(db: Session, user_id: Optional[int] = None) -> int:
+    """Recompute every progress row (of ``user_id``); the caller commits"""
+    connection = db.connection()
+    rows = _compute(connection, user_id)
+    query = delete(StudentProgress)
+    if user_id is not None:
+        query = query.where(StudentProgress.user_id == user_id)
+    connection.execute(query)
+    if rows:
+        connection.execute(insert(StudentProgress), list(rows.values()))
+    return len(rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild student progress rows")
+    parser.add_argument("--user", type=int, help="only rebuild this user's rows")
+    args = parser.parse_args()
+
+    from app.db.database import SessionLocal
+    from app.models import community, donation  # noqa: F401 - mappers User refers to
+    from app.services.coverage import backfill_references
+    db = SessionLocal()
+    try:
+        updated, unresolved = backfill_references(db)
+        count = rebuild(db, args.user)
+        db.commit()
+    finally:
+        db.close()
+    print(f"Backfilled references of {updated} recitations ({unresolved} unresolved)")
+    print(f"Rebuilt {count} progress rows")
+
+
+if __name__ == "__main__":
+    main()
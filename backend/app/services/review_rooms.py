@@ -0,0 +1,405 @@
+"""
+Co-review rooms for scholars working on the same recitation.
+
+Each recitation has a room that members join over a WebSocket. On joining
+they receive a snapshot of the recitation's markers and loop regions. Edits
+sent by members are collected for ``settings.review_batch_window_ms`` and
+written in a single transaction. The operations that were applied are
+broadcast to the room as one message, encoded once and queued to every
+member. REST edits through markers.py are broadcast the same way, so every
+client sees the others' changes without reloading.
+
+Permissions are those of the REST endpoints. Scholars and admins may create
+items; updates and deletes follow ``annotations.can_edit`` (the scholar who
+created the item, or an admin), the same check markers.py makes. The
+recitation's owner may join read-only.
+
+Client messages::
+
+    {"op": "create", "entity": "marker", "data": {...}, "ref": "c1"}
+    {"op": "update", "entity": "loop_region", "id": 7, "data": {...}}
+    {"op": "delete", "entity": "marker", "id": 3}
+
+Server messages: ``snapshot``, ``ops`` (a list of applied operations),
+``presence``, ``error`` (sent only to the member whose operation failed,
+echoing its ``ref``) and ``resync`` (updates may have been missed; reconnect
+for a fresh snapshot).
+
+Members connect with a single-use ticket from ``POST /api/v1/events/ticket``
+(app.services.stream_tickets), never their bearer token, which would end
+up in proxy and access logs as part of the URL.
+
+Room messages travel through the backplane, so members connected to
+different workers share the room.
+"""
+import asyncio
+import json
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+from starlette.concurrency import run_in_threadpool
+
+from app.core.concurrency import CONFLICT
+from app.core.config import settings
+from app.core.serialization import dumps, row_dicts, schema_columns
+from app.db.database import app_session
+from app.models.marker import LoopRegion, Marker
+from app.models.recitation import Recitation
+from app.models.user import User, UserRole
+from app.schemas.marker import (
+    LoopRegion as LoopRegionSchema,
+    LoopRegionCreate,
+    LoopRegionUpdate,
+    Marker as MarkerSchema,
+    MarkerCreate,
+    MarkerUpdate,
+)
+from app.services import annotations, events, stream_tickets
+from app.services.backplane import backplane
+
+TOPIC = "review"
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+# entity -> (model, create schema, update schema, response schema)
+ENTITIES = {
+    "marker": (Marker, MarkerCreate, MarkerUpdate, MarkerSchema),
+    "loop_region": (LoopRegion, LoopRegionCreate, LoopRegionUpdate, LoopRegionSchema),
+}
+
+# Close code asking the client to reconnect (and take a fresh snapshot)
+TRY_AGAIN_LATER = 1013
+
+
+class OperationError(Exception):
+    def __init__(self, status_code: int, detail):
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Member:
+    """A connected socket with its own bounded outbox"""
+
+    def __init__(self, websocket: WebSocket, user: User, can_edit: bool):
+        self.websocket = websocket
+        self.user_id = user.id
+        self.username = user.username
+        self.role = user.role
+        self.can_edit = can_edit
+        self.loop = asyncio.get_running_loop()
+        self.outbox: "asyncio.Queue[Optional[str]]" = asyncio.Queue(settings.review_queue_size)
+
+    def send(self, frame: str) -> None:
+        """Queue an encoded frame; safe to call from any thread"""
+        try:
+            self.loop.call_soon_threadsafe(self._enqueue, frame)
+        except RuntimeError:  # Loop already closed
+            pass
+
+    def _enqueue(self, frame: str) -> None:
+        try:
+            self.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Too far behind to catch up: drop the backlog and disconnect
+            while not self.outbox.empty():
+                self.outbox.get_nowait()
+            self.outbox.put_nowait(None)
+
+    async def write(self) -> None:
+        try:
+            while True:
+                frame = await self.outbox.get()
+                if frame is None:
+                    await self.websocket.close(code=TRY_AGAIN_LATER)
+                    return
+                await self.websocket.send_text(frame)
+        except Exception:
+            return
+
+
+def _encode(message: dict) -> str:
+    return dumps(message).decode()
+
+
+class ReviewRoom:
+    def __init__(self, recitation_id: int, app):
+        self.recitation_id = recitation_id
+        self.app = app
+        self.members: Set[Member] = set()
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Member, dict]] = []
+        self._flushing = False
+
+    def broadcast(self, message: dict) -> None:
+        frame = _encode(message)
+        with self._lock:
+            members = list(self.members)
+        for member in members:
+            member.send(frame)
+
+    def submit(self, member: Member, message: dict) -> None:
+        """Queue an edit for the next batch; called on the member's loop"""
+        with self._lock:
+            self._pending.append((member, message))
+            if self._flushing:
+                return
+            self._flushing = True
+        member.loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while True:
+            await asyncio.sleep(settings.review_batch_window_ms / 1000)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                if not batch:
+                    self._flushing = False
+                    return
+            applied, errors = await run_in_threadpool(self._apply, batch)
+            for member, error in errors:
+                member.send(_encode(error))
+            if applied:
+                publish_to_room(self.recitation_id, {"type": "ops", "ops": applied})
+
+    def _apply(self, batch: List[Tuple[Member, dict]]):
+        with app_session(self.app) as db:
+            return apply_operations(db, self.recitation_id, batch)
+
+
+_rooms: Dict[int, ReviewRoom] = {}
+_rooms_lock = threading.Lock()
+
+
+def join(recitation_id: int, member: Member, app) -> ReviewRoom:
+    with _rooms_lock:
+        room = _rooms.get(recitation_id)
+        if room is None:
+            room = _rooms[recitation_id] = ReviewRoom(recitation_id, app)
+        with room._lock:
+            room.members.add(member)
+    return room
+
+
+def leave(room: ReviewRoom, member: Member) -> None:
+    with _rooms_lock:
+        with room._lock:
+            room.members.discard(member)
+            empty = not room.members
+        if empty and _rooms.get(room.recitation_id) is room:
+            del _rooms[room.recitation_id]
+
+
+def publish_to_room(recitation_id: int, message: dict) -> None:
+    """Broadcast to a recitation's room members in every process"""
+    backplane.publish(
+        TOPIC, {"recitation_id": recitation_id, "message": message},
+        fallback={"recitation_id": recitation_id, "message": {"type": "resync"}})
+
+
+def _deliver(data: dict) -> None:
+    room = _rooms.get(data["recitation_id"])
+    if room is not None:
+        room.broadcast(data["message"])
+
+
+def _resync_all() -> None:
+    for room in list(_rooms.values()):
+        room.broadcast({"type": "resync"})
+
+
+backplane.subscribe(TOPIC, _deliver)
+backplane.on_reconnect(_resync_all)
+
+
+def broadcast_change(recitation_id: int, entity: str, op: str, entity_id: int,
+                     data: Optional[dict], by: int) -> None:
+    """Tell a recitation's room about an edit made outside it (REST)"""
+    publish_to_room(recitation_id, {"type": "ops", "ops": [
+        {"entity": entity, "op": op, "id": entity_id, "data": data, "by": by}]})
+
+
+def _validate(schema, data):
+    try:
+        return schema(**data)
+    except ValidationError as exc:
+        raise OperationError(422, json.loads(exc.json(include_url=False)))
+
+
+def _check_time_range(start_time: float, end_time: float) -> None:
+    if start_time >= end_time:
+        raise OperationError(400, "Start time must be less than end time")
+
+
+def _apply_operation(db: Session, recitation_id: int, member: Member, message: dict,
+                     existing: Dict[Tuple[str, int], object]):
+    entity, op = message.get("entity"), message.get("op")
+    if entity not in ENTITIES or op not in (CREATE, UPDATE, DELETE):
+        raise OperationError(400, "Unknown operation")
+    if not member.can_edit:
+        raise OperationError(403, "Not enough permissions")
+    model, create_schema, update_schema, schema = ENTITIES[entity]
+    data = message.get("data") or {}
+    if not isinstance(data, dict):
+        raise OperationError(422, "Invalid data")
+
+    if op == CREATE:
+        values = _validate(create_schema, {**data, "recitation_id": recitation_id}).dict()
+        if entity == "loop_region":
+            _check_time_range(values["start_time"], values["end_time"])
+        obj = model(**values, scholar_id=member.user_id)
+        db.add(obj)
+        db.flush()
+        return entity, op, obj
+
+    obj = existing.get((entity, message.get("id")))
+    if obj is None:
+        raise OperationError(404, f"{entity.replace('_', ' ').capitalize()} not found")
+    if not annotations.can_edit(member.user_id, member.role, obj.scholar_id):
+        raise OperationError(403, "Not enough permissions")
+    # Same optimistic concurrency as If-Match on the REST endpoints
+    version = message.get("version", data.get("version"))
+    if version is not None and version != obj.version:
+        raise OperationError(409, {
+            "message": CONFLICT,
+            "current": schema.model_validate(obj).model_dump(mode="json"),
+        })
+
+    if op == DELETE:
+        del existing[(entity, obj.id)]
+        db.delete(obj)
+        db.flush()
+        return entity, op, obj
+
+    values = _validate(update_schema, data).dict(exclude_unset=True, exclude={"version"})
+    if entity == "loop_region" and ("start_time" in values or "end_time" in values):
+        _check_time_range(values.get("start_time", obj.start_time),
+                          values.get("end_time", obj.end_time))
+    for field, value in values.items():
+        setattr(obj, field, value)
+    db.flush()
+    return entity, op, obj
+
+
+def apply_operations(db: Session, recitation_id: int, batch: List[Tuple[Member, dict]]):
+    """
+    Apply a batch of member operations in one transaction. Returns the
+    applied operations (with current data) and per-member error messages.
+    """
+    errors = []
+    owner_id = db.query(Recitation.user_id).filter(Recitation.id == recitation_id).scalar()
+    if owner_id is None:
+        return [], [
+            (member, {"type": "error", "ref": message.get("ref"), "status": 404,
+                      "detail": "Recitation not found"})
+            for member, message in batch
+        ]
+
+    # Load every item the batch updates or deletes up front, one query per type
+    wanted: Dict[str, Set[int]] = {}
+    for _, message in batch:
+        if message.get("op") in (UPDATE, DELETE) and isinstance(message.get("id"), int):
+            wanted.setdefault(message.get("entity"), set()).add(message["id"])
+    existing = {}
+    for entity, ids in wanted.items():
+        if entity not in ENTITIES:
+            continue
+        model = ENTITIES[entity][0]
+        for obj in db.query(model).filter(
+                model.id.in_(ids), model.recitation_id == recitation_id):
+            existing[(entity, obj.id)] = obj
+
+    results = []
+    for member, message in batch:
+        try:
+            with db.begin_nested():
+                entity, op, obj = _apply_operation(db, recitation_id, member, message, existing)
+        except OperationError as exc:
+            errors.append((member, {"type": "error", "ref": message.get("ref"),
+                                    "status": exc.status_code, "detail": exc.detail}))
+            continue
+        except StaleDataError:
+            # Changed through REST between loading and writing
+            errors.append((member, {"type": "error", "ref": message.get("ref"),
+                                    "status": 409, "detail": {"message": CONFLICT}}))
+            continue
+        results.append((entity, op, obj.id, member.user_id, message.get("ref")))
+    db.commit()
+
+    # Render the latest state of everything touched, one query per type
+    changed: Dict[str, Set[int]] = {}
+    for entity, op, entity_id, _, _ in results:
+        if op != DELETE:
+            changed.setdefault(entity, set()).add(entity_id)
+    current = {}
+    for entity, ids in changed.items():
+        model, _, _, schema = ENTITIES[entity]
+        for row in row_dicts(db.query(*schema_columns(model, schema)).filter(model.id.in_(ids))):
+            current[(entity, row["id"])] = row
+
+    applied = []
+    for entity, op, entity_id, by, ref in results:
+        data = current.get((entity, entity_id))
+        if op == DELETE or data is None:
+            op, data = DELETE, None
+        elif op == CREATE:
+            events.publish(owner_id, f"{entity}.created", data)
+        applied.append({"entity": entity, "op": op, "id": entity_id,
+                        "data": data, "by": by, "ref": ref})
+    return applied, errors
+
+
+def _load_snapshot(app, recitation_id: int, ticket: Optional[str]):
+    with app_session(app) as db:
+        user_id = stream_tickets.redeem(db, ticket)
+        user = db.get(User, user_id) if user_id is not None else None
+        if user is None:
+            return None
+        recitation = db.query(Recitation).filter(Recitation.id == recitation_id).first()
+        is_reviewer = user.role in (UserRole.SCHOLAR, UserRole.ADMIN)
+        if recitation is None or not (is_reviewer or recitation.user_id == user.id):
+            return None
+        snapshot = {"type": "snapshot", "recitation_id": recitation_id}
+        for entity, (model, _, _, schema) in ENTITIES.items():
+            snapshot[f"{entity}s"] = row_dicts(
+                db.query(*schema_columns(model, schema))
+                .filter(model.recitation_id == recitation_id).all())
+        db.expunge(user)
+        return user, is_reviewer, snapshot
+
+
+async def serve(websocket: WebSocket, recitation_id: int, ticket: Optional[str]) -> None:
+    """Run one member's connection, opened with a stream ticket, until it disconnects"""
+    loaded = await run_in_threadpool(_load_snapshot, websocket.app, recitation_id, ticket)
+    if loaded is None:
+        await websocket.close(code=1008)
+        return
+    user, can_edit, snapshot = loaded
+    await websocket.accept()
+
+    member = Member(websocket, user, can_edit)
+    room = join(recitation_id, member, websocket.app)
+    writer = asyncio.create_task(member.write())
+    try:
+        snapshot["members"] = sorted({m.username for m in list(room.members)})
+        member.send(_encode(snapshot))
+        publish_to_room(recitation_id, {"type": "presence", "joined": user.username})
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except WebSocketDisconnect:
+                break
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                member.send(_encode({"type": "error", "status": 400,
+                                     "detail": "Invalid message"}))
+                continue
+            room.submit(member, message)
+    finally:
+        leave(room, member)
+        writer.cancel()
+        publish_to_room(recitation_id, {"type": "presence", "left": user.username})
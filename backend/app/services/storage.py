@@ -0,0 +1,32 @@
+"""
+Audio file storage.
+
+Uploads are streamed to ``settings.upload_dir`` in fixed-size chunks, so a
+large recording never has to be held in memory.
+"""
+import os
+import shutil
+import uuid
+from typing import BinaryIO, Optional
+
+from app.core.config import settings
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def save_audio(source: BinaryIO, subdir: str, filename: Optional[str] = None) -> str:
+    """Copy ``source`` into storage and return its path relative to upload_dir"""
+    extension = os.path.splitext(filename or "")[1].lower() or ".webm"
+    relative_path = os.path.join(subdir, f"{uuid.uuid4().hex}{extension}")
+    full_path = os.path.join(settings.upload_dir, relative_path)
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    with open(full_path, "wb") as destination:
+        shutil.copyfileobj(source, destination, CHUNK_SIZE)
+    return relative_path
+
+
+def delete_audio(relative_path: str) -> None:
+    try:
+        os.remove(os.path.join(settings.upload_dir, relative_path))
+    except FileNotFoundError:
+        pass
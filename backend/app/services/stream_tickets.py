@@ -0,0 +1,68 @@
+"""
+Tickets for opening the event stream and co-review sockets.
+
+Browsers' EventSource and WebSocket can't send an Authorization header, so
+the credential travels in the URL, where access logs, proxies and browser
+history keep it. Rather than a bearer token, the client first trades its
+token for a ticket (``POST /api/v1/events/ticket``) and opens
+``/api/v1/events/stream?ticket=...`` or
+``/api/v1/markers/ws/{recitation_id}?ticket=...``. A ticket is good for one
+connection and ``settings.events_ticket_seconds``; only its SHA-256 hash is
+stored, and ``sweep`` deletes the ones never used.
+"""
+import hashlib
+import secrets
+from datetime import timedelta
+from typing import Optional
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from app.core import tasks
+from app.core.config import settings
+from app.db.database import SessionLocal
+from app.models.stream_ticket import StreamTicket
+from app.models.user import User
+
+TICKET_BYTES = 32
+
+
+def hash_ticket(ticket: str) -> str:
+    return hashlib.sha256(ticket.encode()).hexdigest()
+
+
+def issue(db: Session, user_id: int) -> str:
+    """A new ticket for ``user_id``; the caller commits"""
+    ticket = secrets.token_urlsafe(TICKET_BYTES)
+    db.add(StreamTicket(
+        token=hash_ticket(ticket), user_id=user_id,
+        expires_at=tasks.utcnow() + timedelta(seconds=settings.events_ticket_seconds)))
+    return ticket
+
+
+def redeem(db: Session, ticket: Optional[str]) -> Optional[int]:
+    """Use up ``ticket`` and commit; returns its active user's id, or None"""
+    if not ticket:
+        return None
+    row = db.query(StreamTicket.id, StreamTicket.user_id).join(
+        User, User.id == StreamTicket.user_id).filter(
+        StreamTicket.token == hash_ticket(ticket),
+        StreamTicket.expires_at > tasks.utcnow(),
+        User.is_active == True,
+    ).first()
+    if row is None:
+        return None
+    # Only one of two concurrent redemptions deletes it
+    used = db.execute(
+        delete(StreamTicket).where(StreamTicket.id == row.id),
+        execution_options={"synchronize_session": False},
+    ).rowcount
+    db.commit()
+    return row.user_id if used else None
+
+
+def sweep(batch_size: Optional[int] = None) -> int:
+    """Delete expired tickets in bounded batches; returns the number removed"""
+    with SessionLocal() as db:
+        return tasks.delete_in_batches(
+            db, StreamTicket, StreamTicket.expires_at <= tasks.utcnow(), batch_size=batch_size)
@@ -0,0 +1,218 @@
+"""
+Change feed for offline clients.
+
+Every flush that creates, updates or deletes a recitation, comment, marker
+or loop region appends a row to ``change_log``. Clients hold an opaque sync
+token (the last change they have seen) and ask for everything after it;
+repeated changes to the same entity collapse to its latest state, and
+deletions come back as tombstones.
+
+Change ids are assigned when a row is inserted, not when its transaction
+commits, so on Postgres a lower id can become visible after a client has
+read past it. There the feed is ordered by the writing transaction's id
+instead and only returns changes of transactions older than every one
+still in flight (the snapshot's xmin); a long-running transaction holds
+the feed back until it ends. SQLite has one writer at a time, so its ids
+are already in commit order.
+"""
+import base64
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func, insert, literal, select, tuple_
+from sqlalchemy.orm import Session
+
+from app.core.serialization import row_dicts, schema_columns
+from app.models.comment import Comment
+from app.models.marker import LoopRegion, Marker
+from app.models.recitation import Recitation
+from app.models.sync import ChangeLogEntry
+from app.models.user import User, UserRole
+from app.schemas.comment import Comment as CommentSchema
+from app.schemas.marker import LoopRegion as LoopRegionSchema, Marker as MarkerSchema
+from app.schemas.recitation import Recitation as RecitationSchema
+
+UPSERT = "upsert"
+DELETE = "delete"
+
+# entity type -> (model, schema used to render it)
+ENTITIES = {
+    "recitation": (Recitation, RecitationSchema),
+    "comment": (Comment, CommentSchema),
+    "marker": (Marker, MarkerSchema),
+    "loop_region": (LoopRegion, LoopRegionSchema),
+}
+_ENTITY_TYPES = {model: name for name, (model, _) in ENTITIES.items()}
+
+
+class InvalidSyncToken(ValueError):
+    pass
+
+
+def encode_token(txid: int, change_id: int) -> str:
+    return base64.urlsafe_b64encode(f"v2:{txid}:{change_id}".encode()).decode().rstrip("=")
+
+
+def decode_token(token: Optional[str]) -> Tuple[Optional[int], int]:
+    """(txid, change id) of the last change seen; v1 tokens carry no txid"""
+    if not token:
+        return 0, 0
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        version, _, cursor = base64.urlsafe_b64decode(padded).decode().partition(":")
+        if version == "v1":
+            return None, int(cursor)
+        if version != "v2":
+            raise ValueError(version)
+        txid, _, change_id = cursor.partition(":")
+        return int(txid), int(change_id)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise InvalidSyncToken("Invalid sync token") from exc
+
+
+def record_changes(db: Session, changes: Iterable[Tuple[str, int, int, Optional[int], str]]) -> None:
+    """
+    Append (entity_type, entity_id, owner_id, recitation_id, operation)
+    rows to the change log, for writes that bypass the ORM unit of work.
+    """
+    rows = [
+        {
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "owner_id": owner_id,
+            "recitation_id": recitation_id,
+            "operation": operation,
+        }
+        for entity_type, entity_id, owner_id, recitation_id, operation in changes
+    ]
+    if rows:
+        db.connection().execute(insert(ChangeLogEntry), rows)
+
+
+def record_recitation_change(db: Session, entity_type: str, entity_id: int,
+                             recitation_id: int, operation: str = UPSERT) -> None:
+    """record_changes() for a marker or loop region, reading the owner in the same statement"""
+    db.execute(insert(ChangeLogEntry).from_select(
+        ["entity_type", "entity_id", "owner_id", "recitation_id", "operation"],
+        select(
+            literal(entity_type), literal(entity_id), Recitation.user_id, Recitation.id,
+            literal(operation),
+        ).where(Recitation.id == recitation_id),
+    ))
+
+
+@event.listens_for(Session, "after_flush")
+def _log_flushed_changes(session: Session, flush_context) -> None:
+    pending = []
+    for objects, operation in (
+        (session.new, UPSERT),
+        (session.dirty, UPSERT),
+        (session.deleted, DELETE),
+    ):
+        for obj in objects:
+            entity_type = _ENTITY_TYPES.get(type(obj))
+            if entity_type is None:
+                continue
+            if objects is session.dirty and not session.is_modified(obj, include_collections=False):
+                continue
+            pending.append((entity_type, obj, operation))
+    if not pending:
+        return
+
+    # Markers and loop regions don't carry the owner; look it up in one query
+    connection = session.connection()
+    missing = {
+        obj.recitation_id for entity_type, obj, _ in pending
+        if entity_type in ("marker", "loop_region")
+    }
+    owners: Dict[int, int] = {}
+    if missing:
+        owners = dict(connection.execute(
+            select(Recitation.id, Recitation.user_id).where(Recitation.id.in_(missing))
+        ).all())
+
+    rows = []
+    for entity_type, obj, operation in pending:
+        if entity_type == "recitation":
+            owner_id, recitation_id = obj.user_id, obj.id
+        elif entity_type == "comment":
+            owner_id, recitation_id = obj.user_id, obj.recitation_id
+        else:
+            owner_id, recitation_id = owners.get(obj.recitation_id), obj.recitation_id
+        if owner_id is None:
+            continue
+        rows.append({
+            "entity_type": entity_type,
+            "entity_id": obj.id,
+            "owner_id": owner_id,
+            "recitation_id": recitation_id,
+            "operation": operation,
+        })
+    if rows:
+        connection.execute(insert(ChangeLogEntry), rows)
+
+
+def changes_since(db: Session, user: User, token: Optional[str], limit: int) -> dict:
+    """Changes visible to ``user`` after ``token``, oldest first, one page"""
+    since_txid, since = decode_token(token)
+    query = db.query(
+        ChangeLogEntry.id,
+        ChangeLogEntry.txid,
+        ChangeLogEntry.entity_type,
+        ChangeLogEntry.entity_id,
+        ChangeLogEntry.operation,
+    )
+    if db.get_bind().dialect.name == "postgresql":
+        if since_txid is None:
+            since_txid = db.query(ChangeLogEntry.txid).filter(
+                ChangeLogEntry.id == since).scalar() or 0
+        query = query.filter(
+            tuple_(ChangeLogEntry.txid, ChangeLogEntry.id) > tuple_(since_txid, since),
+            ChangeLogEntry.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()),
+        ).order_by(ChangeLogEntry.txid, ChangeLogEntry.id)
+    else:
+        since_txid = 0
+        query = query.filter(ChangeLogEntry.id > since).order_by(ChangeLogEntry.id)
+    # Students see their own recitations; scholars and admins see everything
+    if user.role not in (UserRole.SCHOLAR, UserRole.ADMIN):
+        query = query.filter(ChangeLogEntry.owner_id == user.id)
+    entries = query.limit(limit + 1).all()
+
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    if not entries:
+        return {"next_token": encode_token(since_txid, since), "has_more": False, "changes": []}
+
+    # Last change per entity wins; keep feed order by that change
+    latest: Dict[Tuple[str, int], Tuple[int, str]] = {}
+    for position, (_, _, entity_type, entity_id, operation) in enumerate(entries):
+        latest[(entity_type, entity_id)] = (position, operation)
+
+    upserts: Dict[str, List[int]] = {}
+    for (entity_type, entity_id), (_, operation) in latest.items():
+        if operation == UPSERT:
+            upserts.setdefault(entity_type, []).append(entity_id)
+
+    current: Dict[Tuple[str, int], dict] = {}
+    for entity_type, ids in upserts.items():
+        model, schema = ENTITIES[entity_type]
+        for row in row_dicts(
+            db.query(*schema_columns(model, schema)).filter(model.id.in_(ids)).all()
+        ):
+            current[(entity_type, row["id"])] = row
+
+    changes = []
+    for key, (_, operation) in sorted(latest.items(), key=lambda item: item[1][0]):
+        data = current.get(key) if operation == UPSERT else None
+        changes.append({
+            "entity": key[0],
+            "id": key[1],
+            # Rows removed after this page's change are reported as deleted
+            "op": UPSERT if data is not None else DELETE,
+            "data": data,
+        })
+
+    return {
+        "next_token": encode_token(entries[-1].txid or 0, entries[-1].id),
+        "has_more": has_more,
+        "changes": changes,
+    }
@@ -0,0 +1,450 @@
+"""
+Latency and throughput of the hot API endpoints over a synthetic corpus.
+
+    python -m benchmarks.bench_api --scale 0.01 --output results.json
+    python -m benchmarks.bench_api --scale 0.01 --requests 30 \\
+        --baseline benchmarks/baselines/sqlite-scale-0.01.json
+
+Seeds a reproducible corpus (``--seed``) sized by ``--scale``: at 1 that is
+50k users, 1k communities, 500k recitations, 5M markers, 5M comments and
+1M donations. Without ``--database-url`` it goes into a throwaway SQLite
+file; an existing database is seeded once and reused by later runs with
+``--reuse``. Rows are written with multi-row INSERTs that bypass the ORM
+hooks, then the derived tables (recitation counters, community stats,
+surah progress) are rebuilt as after a backfill.
+
+Each endpoint is called in-process through the full middleware stack with
+real bearer tokens: ``--requests`` sequential calls for the latency
+percentiles, then ``--concurrency`` clients making ``--requests`` calls
+each for throughput. Results are printed as a table or JSON, ``--output``
+stores them, and ``--baseline`` compares against stored results; a p50
+slower or throughput lower than the baseline by more than ``--tolerance``
+counts as a regression and the exit status is 1. Numbers only compare on
+the same machine and database; store a baseline there first. A baseline
+taken with a different database, ``--scale``, ``--seed``, ``--requests`` or
+``--concurrency`` is refused unless ``--allow-mismatch`` is given, which
+only warns.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Callable, Dict, Iterator, List
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, func, insert, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import sessionmaker
+
+from app.core import geohash, quran
+from app.core.security import create_access_token, get_password_hash
+from app.db.database import Base, get_db
+from app.main import app
+from app.models.comment import Comment
+from app.models.community import Community, CommunityMembership
+from app.models.donation import Donation, DonationStatus, PaymentProvider
+from app.models.marker import Marker
+from app.models.recitation import Recitation, RecitationStatus
+from app.models.user import User, UserRole
+from app.services import community_stats, progress
+
+# Rows at --scale 1
+CORPUS = {
+    "users": 50_000,
+    "communities": 1_000,
+    "recitations": 500_000,
+    "markers": 5_000_000,
+    "comments": 5_000_000,
+    "donations": 1_000_000,
+}
+SCHOLAR_EVERY = 20  # every 20th user is a scholar
+CHUNK = 5_000  # rows per INSERT batch
+WORDS = ("Nur", "Huda", "Furqan", "Rahma", "Iman", "Sakina", "Taqwa", "Ihsan", "Barakah")
+CITIES = (("Kano", 12.0, 8.5), ("Lagos", 6.5, 3.4), ("Abuja", 9.1, 7.5), ("Ilorin", 8.5, 4.5))
+
+# (name, path template, who calls it)
+ENDPOINTS = [
+    ("me", "/api/v1/users/me", "user"),
+    ("my recitations", "/api/v1/recitations/", "user"),
+    ("my progress", "/api/v1/users/me/progress", "user"),
+    ("review queue", "/api/v1/recitations/pending", "scholar"),
+    ("review queue rows", "/api/v1/recitations/pending?include_details=false", "scholar"),
+    ("markers", "/api/v1/markers/recitation/{recitation_id}", "scholar"),
+    ("comments", "/api/v1/comments/recitation/{recitation_id}", "scholar"),
+    ("my donations", "/api/v1/donations/", "user"),
+    ("donation stats", "/api/v1/donations/stats", "user"),
+    ("community search", "/api/v1/communities/?search=rahma", "user"),
+    ("my communities", "/api/v1/communities/my-communities", "user"),
+    ("community stats", "/api/v1/communities/{community_id}/stats", "user"),
+]
+
+
+def corpus_size(scale: float) -> Dict[str, int]:
+    return {table: max(1, int(count * scale)) for table, count in CORPUS.items()}
+
+
+def _chunks(rows: Iterator[dict]) -> Iterator[List[dict]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _insert(connection: Connection, model, rows: Iterator[dict]) -> None:
+    for chunk in _chunks(rows):
+        connection.execute(insert(model), chunk)
+
+
+def seed(connection: Connection, sizes: Dict[str, int], seed_value: int) -> None:
+    """Write the synthetic corpus; ids are 1..n per table"""
+    rng = random.Random(seed_value)
+    now = datetime.now(timezone.utc)
+    users, communities = sizes["users"], sizes["communities"]
+    recitations = sizes["recitations"]
+    password = get_password_hash("benchmark")
+
+    def ago(days: float) -> datetime:
+        return now - timedelta(days=rng.random() * days)
+
+    def scholar() -> int:
+        return rng.randrange(0, users, SCHOLAR_EVERY) + 1
+
+    _insert(connection, User, ({
+        "id": i, "email": f"user{i}@bench.example", "username": f"user{i}",
+        "full_name": f"Bench User {i}", "hashed_password": password,
+        "role": UserRole.SCHOLAR if i % SCHOLAR_EVERY == 1 else UserRole.USER,
+        "is_active": True, "is_verified": True, "created_at": ago(730),
+    } for i in range(1, users + 1)))
+
+    def community(i: int) -> dict:
+        city, latitude, longitude = CITIES[i % len(CITIES)]
+        latitude += rng.uniform(-0.5, 0.5)
+        longitude += rng.uniform(-0.5, 0.5)
+        return {
+            "id": i, "name": f"{rng.choice(WORDS)} Circle {i}",
+            "description": f"Weekly {rng.choice(WORDS).lower()} halaqa in {city}",
+            "location": city, "latitude": latitude, "longitude": longitude,
+            "geohash": geohash.encode(latitude, longitude), "is_active": True,
+            "created_by": scholar(), "created_at": ago(730),
+        }
+    _insert(connection, Community, (community(i) for i in range(1, communities + 1)))
+    # Every user belongs to one community
+    _insert(connection, CommunityMembership, ({
+        "community_id": (i - 1) % communities + 1, "user_id": i,
+        "role": "scholar" if i % SCHOLAR_EVERY == 1 else "member", "is_active": True,
+    } for i in range(1, users + 1)))
+
+    # Children per recitation are drawn up front so the summary counters match
+    marker_mean = sizes["markers"] / recitations
+    comment_mean = sizes["comments"] / recitations
+    marker_counts = [int(rng.random() * (2 * marker_mean + 1)) for _ in range(recitations)]
+    comment_counts = [int(rng.random() * (2 * comment_mean + 1)) for _ in range(recitations)]
+    unresolved_counts = [rng.randint(0, count) for count in comment_counts]
+    owners = [rng.randrange(users) + 1 for _ in range(recitations)]
+    created = [ago(365) for _ in range(recitations)]
+
+    def recitation(i: int) -> dict:
+        surah = rng.randint(1, quran.SURAH_COUNT)
+        ayahs = quran.AYAH_COUNTS[surah]
+        start = rng.randint(1, ayahs)
+        end = min(ayahs, start + rng.randint(0, 20))
+        feedback = marker_counts[i] + comment_counts[i]
+        return {
+            "id": i + 1, "user_id": owners[i],
+            "community_id": (owners[i] - 1) % communities + 1,
+            "surah_name": quran.surah_name(surah), "surah_number": surah,
+            "ayah_start": start, "ayah_end": end,
+            "ayah_index_start": quran.ayah_index(surah, start),
+            "ayah_index_end": quran.ayah_index(surah, end),
+            "audio_file_path": f"uploads/bench/{i + 1}.webm",
+            "duration": rng.uniform(30, 900),
+            "status": rng.choices(list(RecitationStatus), (3, 6, 1))[0],
+            "comment_count": comment_counts[i],
+            "unresolved_comment_count": unresolved_counts[i],
+            "marker_count": marker_counts[i],
+            "loop_region_count": 0,
+            "last_feedback_at": created[i] + timedelta(days=1) if feedback else None,
+            "created_at": created[i],
+        }
+    _insert(connection, Recitation, (recitation(i) for i in range(recitations)))
+
+    def markers() -> Iterator[dict]:
+        for i, count in enumerate(marker_counts):
+            for k in range(count):
+                yield {"recitation_id": i + 1, "scholar_id": scholar(),
+                       "timestamp": k * 7.5, "label": f"marker {k}",
+                       "category": rng.choice(("tajweed", "makharij", "general")),
+                       "created_at": created[i] + timedelta(days=1)}
+    _insert(connection, Marker, markers())
+
+    def comments() -> Iterator[dict]:
+        for i, count in enumerate(comment_counts):
+            for k in range(count):
+                yield {"recitation_id": i + 1, "scholar_id": scholar(), "user_id": owners[i],
+                       "timestamp": k * 5.0, "text_comment": f"Review note {k}",
+                       "is_resolved": k >= unresolved_counts[i],
+                       "created_at": created[i] + timedelta(days=1)}
+    _insert(connection, Comment, comments())
+
+    _insert(connection, Donation, ({
+        "user_id": rng.randrange(users) + 1,
+        "amount": Decimal(rng.randint(500, 500_000)) / 100,
+        "status": DonationStatus.COMPLETED if rng.random() < 0.8 else DonationStatus.PENDING,
+        "payment_provider": PaymentProvider.PAYSTACK,
+        "transaction_id": f"BENCH-{i}", "payment_reference": f"BENCH-REF-{i}",
+        "created_at": ago(365),
+    } for i in range(1, sizes["donations"] + 1)))
+
+    if connection.dialect.name == "postgresql":
+        # Explicit ids leave the sequences behind
+        for model in (User, Community, Recitation):
+            table = model.__tablename__
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT max(id) FROM {table}))"))
+
+
+def counted(connection: Connection) -> Dict[str, int]:
+    models = {"users": User, "communities": Community, "recitations": Recitation,
+              "markers": Marker, "comments": Comment, "donations": Donation}
+    return {table: connection.execute(select(func.count()).select_from(model)).scalar()
+            for table, model in models.items()}
+
+
+def percentile(values: List[float], share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def measure(make_client: Callable[[], TestClient], path: str, headers: dict,
+            requests: int, concurrency: int) -> dict:
+    client = make_client()
+    response = client.get(path, headers=headers)  # warm up
+    assert response.status_code == 200, f"{path}: {response.status_code} {response.text[:200]}"
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        client.get(path, headers=headers)
+        latencies.append(time.perf_counter() - start)
+
+    clients = [make_client() for _ in range(concurrency)]
+    barrier = threading.Barrier(concurrency + 1)
+
+    def run(worker: TestClient) -> None:
+        barrier.wait()
+        for _ in range(requests):
+            worker.get(path, headers=headers)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in clients]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": requests,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "concurrency": concurrency,
+        "throughput_rps": concurrency * requests / elapsed,
+    }
+
+
+COMPARED_SETTINGS = ("database", "scale", "seed", "requests", "concurrency")
+
+
+def run_settings(report: dict) -> dict:
+    """What a run's numbers depend on besides the code, from its JSON report"""
+    results = report.get("results") or [{}]
+    return {"database": report.get("database"), "scale": report.get("scale"),
+            "seed": report.get("seed"), "requests": results[0].get("requests"),
+            "concurrency": results[0].get("concurrency")}
+
+
+def mismatches(current: dict, baseline: dict) -> List[str]:
+    """Settings of this run that differ from the baseline's, described"""
+    stored = run_settings(baseline)
+    return [f"{name} {current[name]} (baseline {stored[name]})"
+            for name in COMPARED_SETTINGS if current[name] != stored[name]]
+
+
+def compare(results: List[dict], baseline: dict, tolerance: float) -> List[dict]:
+    """Per endpoint changes against ``baseline``; regressions are flagged"""
+    before = {result["endpoint"]: result for result in baseline["results"]}
+    changes = []
+    for result in results:
+        old = before.get(result["endpoint"])
+        if old is None:
+            continue
+        latency = result["p50_ms"] / old["p50_ms"] - 1
+        throughput = result["throughput_rps"] / old["throughput_rps"] - 1
+        changes.append({
+            "endpoint": result["endpoint"],
+            "p50_change": latency,
+            "throughput_change": throughput,
+            "regression": latency > tolerance or throughput < -tolerance,
+        })
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-url", help="benchmark this database instead of a "
+                                               "throwaway SQLite file")
+    parser.add_argument("--scale", type=float, default=0.01,
+                        help="corpus size relative to 50k users / 500k recitations")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--reuse", action="store_true",
+                        help="keep the corpus already in --database-url")
+    parser.add_argument("--requests", type=int, default=50, help="calls per endpoint and client")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--only", action="append", help="endpoint names to run")
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--baseline", help="compare against JSON results stored earlier")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative slowdown counted as a regression")
+    parser.add_argument("--allow-mismatch", action="store_true",
+                        help="compare against a baseline run with other settings anyway")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.database_url or f"sqlite:///{tmp}/bench.db"
+        engine = create_engine(url, connect_args={"check_same_thread": False}
+                               if url.startswith("sqlite") else {})
+        Base.metadata.create_all(bind=engine)
+        BenchSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        sizes = corpus_size(args.scale)
+        if baseline is not None:
+            differences = mismatches({
+                "database": engine.dialect.name, "scale": args.scale, "seed": args.seed,
+                "requests": args.requests, "concurrency": args.concurrency,
+            }, baseline)
+            if differences and not args.allow_mismatch:
+                sys.exit("Not comparable with the baseline: " + ", ".join(differences)
+                         + "; pass --allow-mismatch to compare anyway")
+            for difference in differences:
+                print(f"Warning: baseline differs in {difference}", file=sys.stderr)
+
+        if not args.reuse:
+            with engine.connect() as connection:
+                if connection.execute(select(func.count()).select_from(User)).scalar():
+                    sys.exit("The database already has users; pass --reuse to benchmark them")
+            started = time.perf_counter()
+            with engine.begin() as connection:
+                seed(connection, sizes, args.seed)
+            with BenchSession() as db:
+                community_stats.rebuild(db)
+                progress.rebuild(db)
+                db.commit()
+            print(f"Seeded in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+        with engine.connect() as connection:
+            corpus = counted(connection)
+            # The busiest recitation and community make the per-item endpoints worst case
+            recitation_id, owner_id = connection.execute(
+                select(Recitation.id, Recitation.user_id)
+                .order_by((Recitation.marker_count + Recitation.comment_count).desc(),
+                          Recitation.id).limit(1)).one()
+            community_id = connection.execute(
+                select(Recitation.community_id).group_by(Recitation.community_id)
+                .order_by(func.count().desc(), Recitation.community_id).limit(1)).scalar()
+            scholar_name = connection.execute(
+                select(User.username).where(User.role == UserRole.SCHOLAR)
+                .order_by(User.id).limit(1)).scalar()
+            user_name = connection.execute(
+                select(User.username).where(User.id == owner_id)).scalar()
+
+        def bench_db():
+            db = BenchSession()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_db] = bench_db
+        headers = {
+            role: {"Authorization": f"Bearer {create_access_token({'sub': name})}"}
+            for role, name in (("user", user_name), ("scholar", scholar_name))
+        }
+        results = []
+        try:
+            for name, template, role in ENDPOINTS:
+                if args.only and name not in args.only:
+                    continue
+                path = template.format(recitation_id=recitation_id, community_id=community_id)
+                result = measure(lambda: TestClient(app), path, headers[role],
+                                 args.requests, args.concurrency)
+                results.append({"endpoint": name, "path": template, **result})
+        finally:
+            app.dependency_overrides.clear()
+            engine.dispose()
+
+    report = {
+        "benchmark": "api",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "database": engine.dialect.name,
+        "scale": args.scale,
+        "seed": args.seed,
+        "corpus": corpus,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+    changes = []
+    if baseline is not None:
+        changes = compare(results, baseline, args.tolerance)
+        report["baseline"] = {"path": args.baseline, "created_at": baseline.get("created_at"),
+                              "tolerance": args.tolerance, "changes": changes}
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        deltas = {change["endpoint"]: change for change in changes}
+        print(f"{engine.dialect.name}, " + ", ".join(f"{count} {table}"
+                                                    for table, count in corpus.items()))
+        print(f"{'endpoint':<20}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+              f"{'req/s':>9}" + (f"{'p50':>9}{'req/s':>9}" if changes else ""))
+        for r in results:
+            line = (f"{r['endpoint']:<20}{r['mean_ms']:>9.2f}{r['p50_ms']:>9.2f}"
+                    f"{r['p95_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['throughput_rps']:>9.0f}")
+            change = deltas.get(r["endpoint"])
+            if change:
+                line += (f"{change['p50_change']:>+9.0%}{change['throughput_change']:>+9.0%}"
+                         + ("  REGRESSION" if change["regression"] else ""))
+            print(line)
+    if any(change["regression"] for change in changes):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""
+Per-item serialization cost of the list endpoints, with and without
+``fast_list_responses``.
+
+    python -m benchmarks.bench_serialization --items 2000 --repeat 20
+
+Seeds a throwaway SQLite database, calls each list endpoint in-process and
+reports the mean cost per returned item for both response paths.
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from decimal import Decimal
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi import Depends
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.core import deps
+from app.core.config import settings
+from app.db.database import Base, get_db
+from app.main import app
+from app.models.comment import Comment
+from app.models.donation import Donation, DonationStatus, PaymentProvider
+from app.models.marker import LoopRegion, Marker
+from app.models.recitation import Recitation
+from app.models.user import User, UserRole
+
+ENDPOINTS = [
+    ("recitations", "/api/v1/recitations/"),
+    ("pending recitations", "/api/v1/recitations/pending"),
+    ("markers", "/api/v1/markers/recitation/{recitation_id}"),
+    ("loop regions", "/api/v1/markers/loops/recitation/{recitation_id}"),
+    ("comments", "/api/v1/comments/recitation/{recitation_id}"),
+    ("donations", "/api/v1/donations/"),
+]
+
+
+def seed(session: Session, items: int) -> int:
+    scholar = User(
+        email="bench@example.com", username="bench", hashed_password="x",
+        role=UserRole.SCHOLAR, is_active=True, is_verified=True,
+    )
+    session.add(scholar)
+    session.flush()
+
+    target = Recitation(user_id=scholar.id, surah_name="Al-Baqarah",
+                        ayah_start=1, ayah_end=286, duration=3600.0)
+    session.add(target)
+    session.flush()
+
+    session.add_all(
+        Recitation(user_id=scholar.id, surah_name="Al-Fatiha", ayah_start=1,
+                   ayah_end=7, duration=60.0)
+        for _ in range(items - 1)
+    )
+    session.add_all(
+        Marker(recitation_id=target.id, scholar_id=scholar.id, timestamp=i * 0.5,
+               label=f"marker {i}", category="tajweed")
+        for i in range(items)
+    )
+    session.add_all(
+        LoopRegion(recitation_id=target.id, scholar_id=scholar.id,
+                   start_time=i * 1.0, end_time=i * 1.0 + 0.8, label=f"loop {i}")
+        for i in range(items)
+    )
+    session.add_all(
+        Comment(recitation_id=target.id, scholar_id=scholar.id, user_id=scholar.id,
+                timestamp=i * 0.5, text_comment=f"comment {i}")
+        for i in range(items)
+    )
+    session.add_all(
+        Donation(user_id=scholar.id, amount=Decimal("1000.00"),
+                 payment_provider=PaymentProvider.PAYSTACK,
+                 status=DonationStatus.COMPLETED, transaction_id=f"T{i}",
+                 payment_reference=f"R{i}")
+        for i in range(items)
+    )
+    session.commit()
+    return target.id
+
+
+def measure(client: TestClient, path: str, repeat: int) -> tuple:
+    client.get(path)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        response = client.get(path)
+    elapsed = (time.perf_counter() - start) / repeat
+    assert response.status_code == 200, response.text
+    return elapsed, len(response.json())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--json", action="store_true", help="print JSON results")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{tmp}/bench.db",
+                               connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        BenchSession = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        with BenchSession() as session:
+            recitation_id = seed(session, args.items)
+
+        def bench_db():
+            db = BenchSession()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        def bench_user(db: Session = Depends(get_db)):
+            return db.query(User).filter(User.username == "bench").one()
+
+        app.dependency_overrides[get_db] = bench_db
+        app.dependency_overrides[deps.get_current_user] = bench_user
+        client = TestClient(app)
+
+        results = []
+        original = settings.fast_list_responses
+        try:
+            for name, template in ENDPOINTS:
+                path = template.format(recitation_id=recitation_id)
+                settings.fast_list_responses = False
+                before, count = measure(client, path, args.repeat)
+                settings.fast_list_responses = True
+                after, _ = measure(client, path, args.repeat)
+                results.append({
+                    "endpoint": name,
+                    "items": count,
+                    "before_us_per_item": before / count * 1e6,
+                    "after_us_per_item": after / count * 1e6,
+                    "speedup": before / after,
+                })
+        finally:
+            settings.fast_list_responses = original
+            app.dependency_overrides.clear()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'endpoint':<22}{'items':>7}{'before us/item':>16}{'after us/item':>15}{'speedup':>9}")
+    for r in results:
+        print(f"{r['endpoint']:<22}{r['items']:>7}{r['before_us_per_item']:>16.1f}"
+              f"{r['after_us_per_item']:>15.1f}{r['speedup']:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
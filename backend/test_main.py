@@ -1,11 +1,53 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import threading
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import msgpack
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from starlette.websockets import WebSocketDisconnect
+from sqlalchemy import create_engine, update
 from sqlalchemy.orm import sessionmaker
+from app import server
 from app.main import app
+from app.api.api_v1.endpoints import comments as comment_endpoints
+from app.api.api_v1.endpoints import recitations as recitation_endpoints
 from app.db.database import get_db, Base
-from app.core.security import get_password_hash
+from app.core import (
+    idempotency, profiling, quran, slow_queries, sql_timing, tasks, tracing)
+from app.core.config import settings
+from app.core.encoding import encoding_stats
+from app.core.metrics import RequestSQL
+from app.core.query_budget import QueryBudgetExceeded, violations
+from app.core.security import (
+    create_access_token,
+    get_password_hash,
+    token_cache,
+    verification_stats,
+    verify_token,
+)
+from app.models.assignment import ReviewAssignment
+from app.models.community import CommunityInvitation
+from app.models.idempotency import IdempotencyRecord
+from app.models.recitation import Recitation
 from app.models.user import User, UserRole
+from app.services.backplane import Backplane, LocalTransport, pack
+from app.services import (
+    assignments, community_stats, counters, coverage, invitations, progress, stream_tickets,
+    sync)
+from app.services.assignments import AssignmentScheduler
+from app.services.events import EventBroker, broker
+
+# Fail requests that blow their SQL budget or run N+1 queries
+settings.query_budget_mode = "raise"
 
 # Create test database
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
@@ -255,3 +297,1255 @@ def test_scholar_access_pending_recitations(setup_database, test_scholar, test_u
     assert response.status_code == 200
     data = response.json()
     assert len(data) >= 1
+
+
+def register_and_login(role: str = "user"):
+    """Register a fresh user with the given role and return auth headers."""
+    suffix = uuid.uuid4().hex[:8]
+    username = f"{role}_{suffix}"
+    client.post(
+        "/api/v1/auth/register",
+        json={
+            "email": f"{username}@example.com",
+            "username": username,
+            "full_name": username,
+            "password": "password123",
+            "role": role
+        }
+    )
+    return get_auth_headers(username, "password123")
+
+
+def test_token_verification_is_cached():
+    token = create_access_token({"sub": "cached"}, timedelta(minutes=5))
+    hits_before = verification_stats.snapshot()["cache_hits"]
+    assert verify_token(token) == "cached"
+    assert verify_token(token) == "cached"
+    assert verification_stats.snapshot()["cache_hits"] == hits_before + 1
+
+    expired = create_access_token({"sub": "expired"}, timedelta(seconds=-1))
+    assert verify_token(expired) is None
+
+
+def test_token_key_rotation(monkeypatch):
+    monkeypatch.setattr(settings, "jwt_signing_keys", {"k1": "one", "k2": "two"})
+    monkeypatch.setattr(settings, "jwt_active_kid", "k1")
+    old_token = create_access_token({"sub": "rotated"})
+    monkeypatch.setattr(settings, "jwt_active_kid", "k2")
+    new_token = create_access_token({"sub": "rotated"})
+
+    assert verify_token(old_token) == "rotated"
+    assert verify_token(new_token) == "rotated"
+
+    # Retiring k1 invalidates tokens signed with it, cached or not
+    monkeypatch.setattr(settings, "jwt_signing_keys", {"k2": "two"})
+    assert verify_token(old_token) is None
+    assert verify_token(new_token) == "rotated"
+
+
+def test_account_changes_drop_cached_verifications(setup_database):
+    user_headers = register_and_login()
+    admin_headers = register_and_login("admin")
+    me = client.get("/api/v1/users/me", headers=user_headers).json()
+    digest = hashlib.sha256(user_headers["Authorization"].split()[1].encode()).digest()
+    assert token_cache.get(digest) is not None
+
+    # The admin's change is published as a backplane invalidation
+    client.put(f"/api/v1/users/{me['id']}", json={"is_active": False}, headers=admin_headers)
+    assert token_cache.get(digest) is None
+    assert client.get("/api/v1/users/me", headers=user_headers).status_code == 400
+
+
+def test_auth_server_timing_header(setup_database):
+    headers = register_and_login()
+    response = client.get("/api/v1/users/me", headers=headers)
+    assert response.status_code == 200
+    assert "jwt;dur=" in response.headers["server-timing"]
+
+
+def test_fast_list_responses_match_default(setup_database, monkeypatch):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Asr", "ayah_start": 1, "ayah_end": 3},
+        headers=user_headers
+    ).json()
+    client.post(
+        "/api/v1/markers/",
+        json={"recitation_id": recitation["id"], "timestamp": 1.5, "label": "madd"},
+        headers=scholar_headers
+    )
+    client.post(
+        "/api/v1/comments/",
+        json={"recitation_id": recitation["id"], "timestamp": 2.0, "text_comment": "Good"},
+        headers=scholar_headers
+    )
+
+    paths = [
+        "/api/v1/recitations/",
+        f"/api/v1/markers/recitation/{recitation['id']}",
+        f"/api/v1/comments/recitation/{recitation['id']}",
+    ]
+    monkeypatch.setattr(settings, "fast_list_responses", False)
+    default = [client.get(path, headers=user_headers).json() for path in paths]
+    default_pending = client.get("/api/v1/recitations/pending", headers=scholar_headers).json()
+    monkeypatch.setattr(settings, "fast_list_responses", True)
+    fast = [client.get(path, headers=user_headers).json() for path in paths]
+    fast_pending = client.get("/api/v1/recitations/pending", headers=scholar_headers).json()
+    assert fast == default
+    assert fast_pending == default_pending
+    assert default[2][0]["scholar"]["id"] == default[1][0]["scholar_id"]
+    pending = next(r for r in default_pending if r["id"] == recitation["id"])
+    assert pending["surah_number"] == 103
+    assert pending["comments"][0]["version"] == pending["markers"][0]["version"] == 1
+
+
+def test_list_response_compression_and_msgpack(setup_database):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Mulk", "ayah_start": 1, "ayah_end": 30},
+        headers=user_headers
+    ).json()
+    for i in range(20):
+        client.post(
+            "/api/v1/markers/",
+            json={"recitation_id": recitation["id"], "timestamp": i, "label": f"m{i}"},
+            headers=scholar_headers
+        )
+    path = f"/api/v1/markers/recitation/{recitation['id']}"
+
+    compressed = client.get(path, headers={**user_headers, "Accept-Encoding": "gzip"})
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert len(compressed.json()) == 20
+
+    packed = client.get(path, headers={**user_headers, "Accept": "application/msgpack"})
+    assert packed.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(packed.content) == compressed.json()
+    assert encoding_stats.snapshot()["gzip"]["bytes_saved"] > 0
+
+
+def test_sync_changes_feed(setup_database):
+    user_headers = register_and_login()
+    other_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+
+    start = client.get("/api/v1/sync/changes", headers=user_headers).json()
+    token = start["next_token"]
+    assert start["changes"] == []
+
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Falaq", "ayah_start": 1, "ayah_end": 5},
+        headers=user_headers
+    ).json()
+    marker = client.post(
+        "/api/v1/markers/",
+        json={"recitation_id": recitation["id"], "timestamp": 3.0, "label": "ghunnah"},
+        headers=scholar_headers
+    ).json()
+    client.put(
+        f"/api/v1/markers/{marker['id']}",
+        json={"label": "ikhfa"},
+        headers=scholar_headers
+    )
+
+    feed = client.get(f"/api/v1/sync/changes?since={token}", headers=user_headers).json()
+    changes = {(c["entity"], c["id"]): c for c in feed["changes"]}
+    assert len(feed["changes"]) == 2
+    assert changes[("recitation", recitation["id"])]["op"] == "upsert"
+    assert changes[("marker", marker["id"])]["data"]["label"] == "ikhfa"
+
+    client.delete(f"/api/v1/markers/{marker['id']}", headers=scholar_headers)
+    feed = client.get(
+        f"/api/v1/sync/changes?since={feed['next_token']}", headers=user_headers).json()
+    assert feed["changes"] == [
+        {"entity": "marker", "id": marker["id"], "op": "delete", "data": None}]
+
+    # Other students never see this user's changes
+    other = client.get(f"/api/v1/sync/changes?since={token}", headers=other_headers).json()
+    assert other["changes"] == []
+
+    # Tokens issued before the commit-ordered cursor still resume
+    legacy = base64.urlsafe_b64encode(b"v1:0").decode().rstrip("=")
+    assert sync.decode_token(legacy) == (None, 0)
+    resumed = client.get(f"/api/v1/sync/changes?since={legacy}", headers=user_headers).json()
+    assert len(resumed["changes"]) == 2
+
+    assert client.get(
+        "/api/v1/sync/changes?since=garbage", headers=user_headers).status_code == 400
+
+
+def test_batch_upload_is_idempotent(setup_database, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "upload_dir", str(tmp_path))
+    headers = register_and_login()
+    manifest = json.dumps([
+        {"idempotency_key": "rec-1", "surah_name": "An-Nas", "ayah_start": 1,
+         "ayah_end": 6, "duration": 30.0, "file": "rec-1.webm"},
+        {"idempotency_key": "rec-2", "surah_name": "Al-Kawthar", "ayah_start": 1,
+         "ayah_end": 3},
+        {"surah_name": "missing key"},
+        {"idempotency_key": ["rec-3"], "surah_name": "Al-Ikhlas", "ayah_start": 1,
+         "ayah_end": 4},
+        {"idempotency_key": {"k": "rec-4"}, "surah_name": "Al-Falaq", "ayah_start": 1,
+         "ayah_end": 5},
+    ])
+    files = [("audio", ("rec-1.webm", b"\x1a\x45\xdf\xa3audio", "audio/webm"))]
+
+    response = client.post("/api/v1/recitations/batch",
+                           data={"manifest": manifest}, files=files, headers=headers)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [r["status"] for r in results] == ["created", "created", "error", "error", "error"]
+    assert [r["idempotency_key"] for r in results[2:]] == [None, None, None]
+    assert len(list(tmp_path.rglob("*.webm"))) == 1
+
+    replay = client.post("/api/v1/recitations/batch",
+                         data={"manifest": manifest}, files=files, headers=headers)
+    replayed = replay.json()["results"]
+    assert [r["status"] for r in replayed[:2]] == ["duplicate", "duplicate"]
+    assert [r["recitation_id"] for r in replayed[:2]] == \
+        [r["recitation_id"] for r in results[:2]]
+    assert len(list(tmp_path.rglob("*.webm"))) == 1
+    assert len(client.get("/api/v1/recitations/", headers=headers).json()) == 2
+
+
+def test_idempotency_key_replays_response(setup_database, monkeypatch):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Qadr", "ayah_start": 1, "ayah_end": 5},
+        headers=user_headers
+    ).json()
+    headers = {**scholar_headers, "Idempotency-Key": "comment-retry-1"}
+    payload = {"recitation_id": recitation["id"], "timestamp": 4.0, "text_comment": "Idgham"}
+
+    first = client.post("/api/v1/comments/", json=payload, headers=headers)
+    retry = client.post("/api/v1/comments/", json=payload, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert retry.headers["idempotent-replayed"] == "true"
+    assert retry.json() == first.json()
+    comments = client.get(
+        f"/api/v1/comments/recitation/{recitation['id']}", headers=user_headers).json()
+    assert len(comments) == 1
+
+    changed = client.post("/api/v1/comments/", json={**payload, "timestamp": 5.0},
+                          headers=headers)
+    assert changed.status_code == 422
+
+    # Keys belong to the user, not to one token
+    scholar = client.get("/api/v1/users/me", headers=scholar_headers).json()
+    token = create_access_token({"sub": scholar["username"]}, timedelta(minutes=7))
+    relogged = client.post("/api/v1/comments/", json=payload, headers={
+        "Authorization": f"Bearer {token}", "Idempotency-Key": "comment-retry-1"})
+    assert relogged.headers["idempotent-replayed"] == "true"
+
+    # A duplicate of a request still running in another worker
+    body = json.dumps(payload).encode()
+    db = TestingSessionLocal()
+    db.add(IdempotencyRecord(
+        key=idempotency._digest(str(scholar["id"]).encode(), b"in-flight"),
+        method="POST", path="/api/v1/comments/",
+        fingerprint=idempotency._digest(b"POST", b"/api/v1/comments/", b"", body),
+        expires_at=datetime.now(timezone.utc) + timedelta(minutes=1)))
+    db.commit()
+    db.close()
+    busy = client.post("/api/v1/comments/", content=body, headers={
+        **scholar_headers, "Content-Type": "application/json", "Idempotency-Key": "in-flight"})
+    assert busy.status_code == 409
+    assert busy.headers["retry-after"] == "1"
+
+    # The idempotency lookup and claim don't count against the route's budget
+    monkeypatch.setattr(comment_endpoints.create_comment, "__query_budget__", 0)
+    with pytest.raises(QueryBudgetExceeded) as exceeded:
+        client.post("/api/v1/comments/", json=payload, headers=scholar_headers)
+    own = int(re.search(r"ran (\d+) SQL", str(exceeded.value)).group(1))
+    monkeypatch.setattr(comment_endpoints.create_comment, "__query_budget__", own)
+    budgeted = client.post("/api/v1/comments/", json=payload, headers={
+        **scholar_headers, "Idempotency-Key": "within-budget"})
+    assert budgeted.status_code == 200
+
+
+def test_feedback_events_published_and_resumable(setup_database):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    user_id = client.get("/api/v1/users/me", headers=user_headers).json()["id"]
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Ikhlas", "ayah_start": 1, "ayah_end": 4},
+        headers=user_headers
+    ).json()
+    client.post(
+        "/api/v1/comments/",
+        json={"recitation_id": recitation["id"], "timestamp": 1.5, "text_comment": "Qalqalah"},
+        headers=scholar_headers
+    )
+    client.put(f"/api/v1/recitations/{recitation['id']}",
+               json={"status": "reviewed"}, headers=scholar_headers)
+
+    published = broker.backlog(user_id)
+    assert [e.type for e in published] == ["comment.created", "recitation.status"]
+    assert b'"text_comment":"Qalqalah"' in published[0].frame
+
+    async def resume():
+        subscription = broker.subscribe(user_id, last_event_id=published[0].id)
+        frames = subscription.stream(heartbeat=0.05)
+        received = [await frames.__anext__() for _ in range(3)]
+        await frames.aclose()
+        return received
+
+    retry, replayed, ping = asyncio.run(resume())
+    assert retry.startswith(b"retry:")
+    assert replayed == published[1].frame
+    assert ping == b": ping\n\n"
+    assert broker.connection_count() == 0
+
+    assert client.get("/api/v1/events/stream").status_code == 401
+
+    # The stream is opened with a single-use ticket, never the bearer token
+    assert client.post("/api/v1/events/ticket").status_code in (401, 403)
+    ticket = client.post("/api/v1/events/ticket", headers=user_headers).json()["ticket"]
+    db = TestingSessionLocal()
+    try:
+        assert stream_tickets.redeem(db, ticket) == user_id
+        assert stream_tickets.redeem(db, ticket) is None
+    finally:
+        db.close()
+    assert client.get("/api/v1/events/stream", params={"ticket": ticket}).status_code == 401
+    token = user_headers["Authorization"].split()[1]
+    assert client.get("/api/v1/events/stream",
+                      params={"access_token": token}).status_code == 401
+
+
+def test_event_stream_backpressure_and_reset():
+    local = EventBroker(replay_size=2, buffered_users=10, queue_size=2)
+
+    async def slow_reader():
+        subscription = local.subscribe(1)
+        for n in range(5):
+            local.publish(1, "marker.created", {"n": n})
+        await asyncio.sleep(0)
+        frames = [frame async for frame in subscription.stream(heartbeat=1)]
+        # Only the queued events are flushed, then the stream ends
+        return subscription, frames
+
+    subscription, frames = asyncio.run(slow_reader())
+    assert subscription.overflowed
+    assert len(frames) == 3  # retry hint + 2 queued events
+
+    async def stale_reconnect():
+        subscription = local.subscribe(1, last_event_id="gone-1")
+        frames = subscription.stream(heartbeat=1)
+        first = [await frames.__anext__() for _ in range(2)]
+        await frames.aclose()
+        return first
+
+    assert b"event: reset" in asyncio.run(stale_reconnect())[1]
+
+
+def test_events_interleave_remote_and_local_publishes(monkeypatch):
+    monkeypatch.setattr(settings, "backplane_coalesce_ms", 0)
+    local = EventBroker(replay_size=10, buffered_users=10, queue_size=10)
+    bus = Backplane(RecordingTransport())
+    bus.subscribe("events", lambda message: local.publish(
+        1, message["type"], {}, event_id=message["id"]), ordered=True)
+
+    async def interleaved():
+        live = local.subscribe(1)
+        bus.start()
+        try:
+            # Ids from another worker don't sort after this one's
+            bus.publish("events", {"type": "comment.created", "id": local.next_id()})
+        finally:
+            bus.stop()
+        assert local.backlog(1) == []  # Waits for its own NOTIFY
+        remote = pack("elsewhere", [("events", {"type": "marker.created", "id": "0-1"}, None)])
+        for payload in remote + bus.transport.sent:
+            bus.receive(payload)
+        bus.receive(pack("elsewhere", [("events", {"type": "recitation.status",
+                                                   "id": "0-2"}, None)])[0])
+        await asyncio.sleep(0)
+        received = [live.queue.get_nowait().id for _ in range(live.queue.qsize())]
+        resumed = local.subscribe(1, last_event_id=received[0])
+        return received, [event.id for event in resumed.backlog]
+
+    received, resumed = asyncio.run(interleaved())
+    assert received == ["0-1", f"{local.origin}-1", "0-2"]
+    assert resumed == received[1:]
+
+
+def next_message(websocket, message_type):
+    while True:
+        message = websocket.receive_json()
+        if message["type"] == message_type:
+            return message
+
+
+def test_review_room_broadcasts_batched_edits(setup_database, monkeypatch):
+    monkeypatch.setattr(settings, "review_batch_window_ms", 200)
+    owner_headers = register_and_login()
+    first_headers = register_and_login("scholar")
+    second_headers = register_and_login("scholar")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Asr", "ayah_start": 1, "ayah_end": 3},
+        headers=owner_headers
+    ).json()
+    room = f"/api/v1/markers/ws/{recitation['id']}?ticket="
+
+    def ticket(headers):
+        return client.post("/api/v1/events/ticket", headers=headers).json()["ticket"]
+
+    with client.websocket_connect(room + ticket(first_headers)) as first, \
+            client.websocket_connect(room + ticket(second_headers)) as second:
+        assert next_message(first, "snapshot")["markers"] == []
+        next_message(second, "snapshot")
+
+        first.send_json({"op": "create", "entity": "marker", "ref": "m1",
+                         "data": {"timestamp": 1.0, "label": "madd"}})
+        first.send_json({"op": "create", "entity": "loop_region", "ref": "bad",
+                         "data": {"start_time": 2.0, "end_time": 1.0, "label": "x"}})
+        first.send_json({"op": "create", "entity": "loop_region", "ref": "l1",
+                         "data": {"start_time": 1.0, "end_time": 2.0, "label": "ayah 1"}})
+
+        error = next_message(first, "error")
+        assert (error["ref"], error["status"]) == ("bad", 400)
+        ops = next_message(second, "ops")["ops"]
+        assert [(op["entity"], op["op"], op["ref"]) for op in ops] == [
+            ("marker", "create", "m1"), ("loop_region", "create", "l1")]
+        marker_id = ops[0]["id"]
+
+        # Only the scholar who created an item may change it, over the
+        # socket and over REST alike
+        second.send_json({"op": "delete", "entity": "marker", "id": marker_id})
+        assert next_message(second, "error")["status"] == 403
+        second.send_json({"op": "update", "entity": "marker", "id": marker_id,
+                          "data": {"label": "ikhfa"}})
+        assert next_message(second, "error")["status"] == 403
+        marker_url = f"/api/v1/markers/{marker_id}"
+        for headers in (second_headers, owner_headers):
+            assert client.put(marker_url, json={"label": "ikhfa"},
+                              headers=headers).status_code == 403
+            assert client.delete(marker_url, headers=headers).status_code == 403
+
+        client.delete(f"/api/v1/markers/loops/{ops[1]['id']}", headers=first_headers)
+        rest_op = next_message(second, "ops")["ops"][0]
+        assert (rest_op["entity"], rest_op["op"]) == ("loop_region", "delete")
+
+    markers = client.get(
+        f"/api/v1/markers/recitation/{recitation['id']}", headers=owner_headers).json()
+    assert [m["label"] for m in markers] == ["madd"]
+
+    with client.websocket_connect(room + ticket(owner_headers)) as watcher:
+        assert len(next_message(watcher, "snapshot")["markers"]) == 1
+        watcher.send_json({"op": "delete", "entity": "marker", "id": marker_id})
+        assert next_message(watcher, "error")["status"] == 403
+
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(room + "invalid") as rejected:
+            rejected.receive_json()
+    # Bearer tokens aren't accepted in the URL, and a ticket is good once
+    used = ticket(first_headers)
+    with client.websocket_connect(room + used) as first:
+        next_message(first, "snapshot")
+    for credential in (first_headers["Authorization"].split()[1], used):
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect(room + credential) as rejected:
+                rejected.receive_json()
+
+
+class RecordingTransport(LocalTransport):
+    remote = True
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, payloads):
+        self.sent.extend(payloads)
+
+
+def test_backplane_coalesces_and_fans_out(monkeypatch):
+    monkeypatch.setattr(settings, "backplane_coalesce_ms", 50)
+    sender, receiver = Backplane(RecordingTransport()), Backplane()
+    local, remote, invalidated = [], [], []
+    sender.subscribe("events", local.append)
+    receiver.subscribe("events", remote.append)
+    receiver.on_invalidate("recitation", invalidated.append)
+
+    sender.start()
+    try:
+        for _ in range(3):
+            sender.invalidate("recitation", 7)
+        sender.publish("events", {"n": 1})
+        sender.publish("events", {"blob": "x" * 9000}, fallback={"truncated": True})
+    finally:
+        sender.stop()
+
+    assert len(local) == 2  # Delivered in-process straight away
+    assert len(sender.transport.sent) == 1
+    for payload in sender.transport.sent:
+        sender.receive(payload)  # Own messages are not delivered twice
+        receiver.receive(payload)
+    assert len(local) == 2
+    assert invalidated == [7]
+    assert remote == [{"n": 1}, {"truncated": True}]
+
+    payloads = pack("origin", [("events", {"n": n}, None) for n in range(100)], limit=200)
+    assert len(payloads) > 1 and all(len(p) <= 200 for p in payloads)
+    assert sum(len(json.loads(p)["m"]) for p in payloads) == 100
+
+
+def test_conditional_updates_detect_conflicts(setup_database):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    other_scholar = register_and_login("scholar")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Humazah", "ayah_start": 1, "ayah_end": 9},
+        headers=user_headers
+    ).json()
+    comment = client.post(
+        "/api/v1/comments/",
+        json={"recitation_id": recitation["id"], "timestamp": 2.0, "text_comment": "Madd"},
+        headers=scholar_headers
+    ).json()
+    assert comment["version"] == 1
+    url = f"/api/v1/comments/{comment['id']}"
+
+    resolved = client.put(url, json={"is_resolved": True},
+                          headers={**user_headers, "If-Match": '"1"'})
+    assert resolved.status_code == 200
+    assert resolved.headers["etag"] == '"2"'
+    assert resolved.json()["is_resolved"] is True
+
+    # A second edit based on version 1 loses the race
+    stale = client.put(url, json={"text_comment": "Madd lazim", "version": 1},
+                       headers=scholar_headers)
+    assert stale.status_code == 409
+    assert stale.json()["detail"]["current"]["is_resolved"] is True
+    assert stale.json()["detail"]["current"]["version"] == 2
+
+    assert client.put(url, json={"text_comment": "x"}, headers=other_scholar).status_code == 403
+    assert client.put("/api/v1/comments/999999", json={},
+                      headers=scholar_headers).status_code == 404
+
+    loop = client.post(
+        "/api/v1/markers/loops/",
+        json={"recitation_id": recitation["id"], "start_time": 1.0, "end_time": 4.0,
+              "label": "ayah 1"},
+        headers=scholar_headers
+    ).json()
+    loop_url = f"/api/v1/markers/loops/{loop['id']}"
+    assert client.put(loop_url, json={"start_time": 5.0},
+                      headers=scholar_headers).status_code == 400
+    moved = client.put(loop_url, json={"end_time": 6.0, "version": 1}, headers=scholar_headers)
+    assert (moved.status_code, moved.json()["version"]) == (200, 2)
+
+    feed = client.get("/api/v1/sync/changes", headers=user_headers).json()
+    synced = {(c["entity"], c["id"]): c["data"] for c in feed["changes"]}
+    assert synced[("comment", comment["id"])]["version"] == 2
+    assert synced[("loop_region", loop["id"])]["end_time"] == 6.0
+
+
+def test_annotation_time_window(setup_database):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Baqarah", "ayah_start": 1, "ayah_end": 141},
+        headers=user_headers
+    ).json()
+    for timestamp in (5.0, 12.0, 18.0, 95.0):
+        client.post("/api/v1/markers/", json={
+            "recitation_id": recitation["id"], "timestamp": timestamp, "label": "m"
+        }, headers=scholar_headers)
+    client.post("/api/v1/comments/", json={
+        "recitation_id": recitation["id"], "timestamp": 14.0, "text_comment": "Ghunnah"
+    }, headers=scholar_headers)
+    for start_time, end_time in ((8.0, 25.0), (30.0, 40.0)):
+        client.post("/api/v1/markers/loops/", json={
+            "recitation_id": recitation["id"], "start_time": start_time,
+            "end_time": end_time, "label": "loop"
+        }, headers=scholar_headers)
+
+    url = f"/api/v1/annotations/recitation/{recitation['id']}"
+    window = client.get(url, params={"start": 10, "end": 20}, headers=user_headers).json()
+    assert [m["timestamp"] for m in window["markers"]] == [12.0, 18.0]
+    assert [c["text_comment"] for c in window["comments"]] == ["Ghunnah"]
+    assert [(l["start_time"], l["end_time"]) for l in window["loop_regions"]] == [(8.0, 25.0)]
+    assert window["density"] is None
+
+    overview = client.get(url, params={"start": 0, "end": 100, "buckets": 4,
+                                       "include_items": False},
+                          headers=scholar_headers).json()
+    assert overview["markers"] == []
+    assert [b["markers"] for b in overview["density"]] == [3, 0, 0, 1]
+    assert [b["comments"] for b in overview["density"]] == [1, 0, 0, 0]
+    # Closed intervals: the 8-25s loop also touches the bucket starting at 25s
+    assert [b["loop_regions"] for b in overview["density"]] == [1, 2, 0, 0]
+
+    assert client.get(url, params={"start": 20, "end": 10},
+                      headers=user_headers).status_code == 400
+
+
+def test_surah_references_and_coverage(setup_database):
+    assert quran.surah_number("al-fatiha") == quran.surah_number("Surah Al-Fatihah") == 1
+    assert quran.ayah_index(2, 255) == 262
+    assert quran.ayah_ref(6236) == (114, 6)
+
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    created = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Baqarah", "ayah_start": 250, "ayah_end": 257},
+        headers=user_headers
+    ).json()
+    assert created["surah_number"] == 2
+    client.post("/api/v1/recitations/",
+                json={"surah_name": "Al-Baqarah", "ayah_start": 1, "ayah_end": 5},
+                headers=user_headers)
+
+    for payload in ({"surah_name": "Al-Fatiha", "ayah_start": 1, "ayah_end": 8},
+                    {"surah_name": "Not a surah", "ayah_start": 1, "ayah_end": 1},
+                    {"surah_name": "Al-Fatiha", "surah_number": 2,
+                     "ayah_start": 1, "ayah_end": 1}):
+        response = client.post("/api/v1/recitations/", json=payload, headers=user_headers)
+        assert response.status_code == 422
+
+    url = "/api/v1/recitations/coverage"
+    covering = client.get(url, params={"surah": "2", "ayah_start": 255},
+                          headers=scholar_headers).json()
+    assert [r["id"] for r in covering] == [created["id"]]
+    assert client.get(url, params={"surah": "Al-Baqarah", "ayah_start": 6, "ayah_end": 249},
+                      headers=user_headers).json() == []
+    assert client.get(url, params={"surah": "Al-Fatiha", "ayah_start": 9},
+                      headers=user_headers).status_code == 400
+    # Users only see their own recitations
+    assert client.get(url, params={"surah": 2, "ayah_start": 255},
+                      headers=register_and_login()).json() == []
+
+    # Rows stored before the reference columns existed are backfilled
+    db = TestingSessionLocal()
+    try:
+        db.execute(update(Recitation).where(Recitation.id == created["id"]).values(
+            surah_number=None, ayah_index_start=None, ayah_index_end=None))
+        updated, _ = coverage.backfill_references(db)
+        db.commit()
+        row = db.get(Recitation, created["id"])
+        assert updated >= 1
+        assert (row.surah_number, row.ayah_index_start, row.ayah_index_end) == \
+            (2, quran.ayah_index(2, 250), quran.ayah_index(2, 257))
+    finally:
+        db.close()
+
+
+def test_student_progress_is_maintained(setup_database):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    first, second = (client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Mulk", "ayah_start": start, "ayah_end": end},
+        headers=user_headers
+    ).json() for start, end in ((1, 10), (5, 15)))
+    client.post("/api/v1/recitations/",
+                json={"surah_name": "Al-Mulk", "ayah_start": 20, "ayah_end": 22},
+                headers=user_headers)
+
+    comments = [client.post("/api/v1/comments/", json={
+        "recitation_id": first["id"], "timestamp": float(t), "text_comment": "Qalqalah"
+    }, headers=scholar_headers).json() for t in (1, 2)]
+    markers = [client.post("/api/v1/markers/", json={
+        "recitation_id": second["id"], "timestamp": float(t), "label": "m", "category": category
+    }, headers=scholar_headers).json() for t, category in ((1, "tajweed"), (2, "tajweed"),
+                                                           (3, "rhythm"))]
+    client.put(f"/api/v1/recitations/{first['id']}", json={"status": "reviewed"},
+               headers=scholar_headers)
+    # Resolving twice only counts once
+    for _ in range(2):
+        client.put(f"/api/v1/comments/{comments[0]['id']}", json={"is_resolved": True},
+                   headers=user_headers)
+    client.put(f"/api/v1/markers/{markers[2]['id']}", json={"category": "pronunciation"},
+               headers=scholar_headers)
+
+    expected = {
+        "surah_number": 67, "surah_name": "Al-Mulk", "total_ayahs": 30,
+        "ayahs_covered": 18, "covered_ranges": [[1, 15], [20, 22]],
+        "recitation_count": 3, "reviewed_count": 1, "unresolved_comments": 1,
+        "error_counts": {"tajweed": 2, "pronunciation": 1},
+    }
+    rows = client.get("/api/v1/users/me/progress", headers=user_headers).json()
+    assert [{k: row[k] for k in expected} for row in rows] == [expected]
+    mulk = client.get("/api/v1/users/me/progress/al-mulk", headers=user_headers).json()
+    assert mulk["ayahs_covered"] == 18
+    untouched = client.get("/api/v1/users/me/progress/1", headers=user_headers).json()
+    assert (untouched["surah_name"], untouched["ayahs_covered"]) == ("Al-Fatihah", 0)
+
+    # A full rebuild lands on the same numbers
+    db = TestingSessionLocal()
+    try:
+        progress.rebuild(db)
+        db.commit()
+    finally:
+        db.close()
+    rebuilt = client.get("/api/v1/users/me/progress", headers=user_headers).json()
+    assert [{k: row[k] for k in expected} for row in rebuilt] == [expected]
+
+
+def test_recitation_summary_counters(setup_database, monkeypatch):
+    user_headers = register_and_login()
+    scholar_headers = register_and_login("scholar")
+    admin_headers = register_and_login("admin")
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Qadr", "ayah_start": 1, "ayah_end": 5},
+        headers=user_headers
+    ).json()
+    assert (recitation["comment_count"], recitation["last_feedback_at"]) == (0, None)
+
+    comments = [client.post("/api/v1/comments/", json={
+        "recitation_id": recitation["id"], "timestamp": float(t), "text_comment": "Idgham"
+    }, headers=scholar_headers).json() for t in (1, 2)]
+    markers = [client.post("/api/v1/markers/", json={
+        "recitation_id": recitation["id"], "timestamp": float(t), "label": "m"
+    }, headers=scholar_headers).json() for t in (1, 2)]
+    client.post("/api/v1/markers/loops/", json={
+        "recitation_id": recitation["id"], "start_time": 1.0, "end_time": 2.0, "label": "l"
+    }, headers=scholar_headers)
+    client.delete(f"/api/v1/markers/{markers[0]['id']}", headers=scholar_headers)
+    for _ in range(2):
+        client.put(f"/api/v1/comments/{comments[0]['id']}", json={"is_resolved": True},
+                   headers=user_headers)
+
+    counts = ("comment_count", "unresolved_comment_count", "marker_count", "loop_region_count")
+    listed = client.get("/api/v1/recitations/", headers=user_headers).json()[0]
+    assert tuple(listed[c] for c in counts) == (2, 1, 1, 1)
+    assert listed["last_feedback_at"] is not None
+    assert listed["updated_at"] is None
+    queue = client.get("/api/v1/recitations/pending", params={"include_details": False},
+                       headers=scholar_headers).json()
+    queued = next(r for r in queue if r["id"] == recitation["id"])
+    assert tuple(queued[c] for c in counts) == (2, 1, 1, 1)
+    assert queued["comments"] is None
+
+    db = TestingSessionLocal()
+    try:
+        db.execute(update(Recitation).where(Recitation.id == recitation["id"]).values(
+            comment_count=7))
+        db.commit()
+    finally:
+        db.close()
+    drift = client.get("/api/v1/admin/recitation-counters", headers=admin_headers).json()
+    assert [(d["recitation_id"], d["stored"]["comment_count"], d["actual"]["comment_count"])
+            for d in drift] == [(recitation["id"], 7, 2)]
+    assert client.get("/api/v1/admin/recitation-counters",
+                      headers=scholar_headers).status_code == 403
+    # A comment committed between the recount's SELECT and its UPDATE is
+    # counted once, not overwritten by the stale count
+    recount = counters._recount
+
+    def comment_arrives_then_recount(db, recitation_ids):
+        client.post("/api/v1/comments/", json={
+            "recitation_id": recitation["id"], "timestamp": 3.0, "text_comment": "Late"
+        }, headers=scholar_headers)
+        recount(db, recitation_ids)
+
+    monkeypatch.setattr(counters, "_recount", comment_arrives_then_recount)
+    client.post("/api/v1/admin/recitation-counters/reconcile", headers=admin_headers)
+    monkeypatch.undo()
+    assert client.get("/api/v1/admin/recitation-counters", headers=admin_headers).json() == []
+    listed = client.get("/api/v1/recitations/", headers=user_headers).json()[0]
+    assert tuple(listed[c] for c in counts) == (3, 2, 1, 1)
+
+    # Only the process holding the lease runs an exclusive job; with SQLite
+    # there is just the one
+    assert tasks.exclusive("test-job", lambda: "ran")() == "ran"
+
+
+def test_assignment_scheduler_fair_queueing():
+    scheduler = AssignmentScheduler()
+    scheduler.set_scholar(1, [None])
+    scheduler.set_scholar(2, [None, 7])
+    scheduler.set_scholar(3, [None])
+
+    # Community scholars come first, then the least-loaded global scholar
+    assert scheduler.place(100, 1.0, [7], capacity=2) == 2
+    assert scheduler.place(101, 2.0, [], capacity=2) == 1
+    assert scheduler.place(102, 3.0, [], capacity=2) == 3
+    assert scheduler.place(103, 4.0, [7], capacity=2) == 2
+    # Scholar 2 is full, so the community overflows to the global pool
+    assert scheduler.place(104, 5.0, [7], capacity=2) == 1
+    assert scheduler.place(105, 6.0, [], capacity=2) == 3
+    # Everyone is full: later arrivals wait
+    assert scheduler.place(106, 8.0, [], capacity=2) is None
+    assert scheduler.place(107, 7.0, [7], capacity=2) is None
+    assert scheduler.snapshot()["waiting"] == 2
+
+    # A freed scholar pulls from their community queue before the global one
+    assert scheduler.finished(100) == 2
+    assert scheduler.next_for(2, capacity=2) == 107
+    assert scheduler.next_for(2, capacity=2) is None
+    # 107 left the global queue too, so the global head is now 106
+    assert scheduler.finished(101) == 1
+    assert scheduler.next_for(1, capacity=2) == 106
+    assert scheduler.snapshot() == {"waiting": 0, "loads": [
+        {"scholar_id": 1, "open_assignments": 2},
+        {"scholar_id": 2, "open_assignments": 2},
+        {"scholar_id": 3, "open_assignments": 2},
+    ]}
+
+    # Scholars never get their own recitations
+    assert scheduler.place(108, 9.0, [], capacity=3, student=1) == 2
+    scheduler.enqueue(109, 10.0, [None], student=3)
+    assert scheduler.next_for(3, capacity=3) is None
+    assert scheduler.next_for(1, capacity=3) == 109
+
+
+def test_community_scholar_assignments(setup_database, monkeypatch):
+    # Room for any backlog left by other tests
+    monkeypatch.setattr(settings, "review_max_open_assignments", 1000)
+    owner_headers = register_and_login("scholar")
+    scholar_headers = register_and_login("scholar")
+    student_headers = register_and_login()
+    admin_headers = register_and_login("admin")
+    community = client.post("/api/v1/communities/", json={"name": "Halaqah"},
+                            headers=owner_headers).json()
+    for headers in (scholar_headers, student_headers):
+        client.post(f"/api/v1/communities/{community['id']}/join",
+                    json={"community_id": community["id"]}, headers=headers)
+
+    recitation = client.post(
+        "/api/v1/recitations/",
+        json={"surah_name": "Al-Asr", "ayah_start": 1, "ayah_end": 3},
+        headers=student_headers
+    ).json()
+    # Goes to the community's scholar, not to the less loaded owner
+    assigned = client.get("/api/v1/recitations/assigned", headers=scholar_headers).json()
+    assert recitation["id"] in [r["id"] for r in assigned]
+    owner_assigned = client.get("/api/v1/recitations/assigned", headers=owner_headers).json()
+    assert recitation["id"] not in [r["id"] for r in owner_assigned]
+    assert client.get("/api/v1/recitations/assigned",
+                      headers=student_headers).status_code in (401, 403)
+
+    # Reviewing it closes the assignment
+    client.put(f"/api/v1/recitations/{recitation['id']}", json={"status": "reviewed"},
+               headers=scholar_headers)
+    remaining = client.get("/api/v1/recitations/assigned", headers=scholar_headers).json()
+    assert [r["id"] for r in remaining] == [r["id"] for r in assigned
+                                            if r["id"] != recitation["id"]]
+    overview = client.get("/api/v1/admin/assignments", headers=admin_headers).json()
+    scholar_id = client.get("/api/v1/users/me", headers=scholar_headers).json()["id"]
+    assert overview["waiting"] == 0
+    assert {"scholar_id": scholar_id, "open_assignments": len(remaining)} in overview["loads"]
+
+
+def test_assignment_capacity_is_enforced_in_the_database(setup_database, monkeypatch):
+    monkeypatch.setattr(settings, "review_max_open_assignments", 1)
+    owner_headers = register_and_login("scholar")
+    scholar_headers = register_and_login("scholar")
+    student_headers = register_and_login()
+    community = client.post("/api/v1/communities/", json={"name": "Dars"},
+                            headers=owner_headers).json()
+    for headers in (scholar_headers, student_headers):
+        client.post(f"/api/v1/communities/{community['id']}/join",
+                    json={"community_id": community["id"]}, headers=headers)
+
+    def recite():
+        return client.post("/api/v1/recitations/", json={
+            "surah_name": "Al-Ikhlas", "ayah_start": 1, "ayah_end": 4
+        }, headers=student_headers).json()
+
+    first = recite()
+    # Another worker's scheduler that hasn't heard of the first assignment
+    # still picks the community scholar, but the database has no room
+    assignments.scheduler.finished(first["id"])
+    second = recite()
+    assigned = client.get("/api/v1/recitations/assigned", headers=scholar_headers).json()
+    assert [r["id"] for r in assigned] == [first["id"]]
+    scholar_id = client.get("/api/v1/users/me", headers=scholar_headers).json()["id"]
+    db = TestingSessionLocal()
+    try:
+        assert db.query(ReviewAssignment.scholar_id).filter(
+            ReviewAssignment.recitation_id == second["id"]).scalar() != scholar_id
+    finally:
+        db.close()
+
+
+def test_community_recitation_stats(setup_database, monkeypatch):
+    owner_headers = register_and_login("scholar")
+    student_headers = register_and_login()
+    lapsed_headers = register_and_login()
+    community = client.post("/api/v1/communities/", json={"name": "Maktab"},
+                            headers=owner_headers).json()
+    other = client.post("/api/v1/communities/", json={"name": "Elsewhere"},
+                        headers=owner_headers).json()
+    for headers in (student_headers, lapsed_headers):
+        client.post(f"/api/v1/communities/{community['id']}/join",
+                    json={"community_id": community["id"]}, headers=headers)
+
+    def recite(headers, **extra):
+        return client.post("/api/v1/recitations/", json={
+            "surah_name": "Al-Kawthar", "ayah_start": 1, "ayah_end": 3, **extra
+        }, headers=headers)
+
+    # The lapsed member was last active before the 30-day window
+    monkeypatch.setattr(community_stats, "today", lambda: date.today() - timedelta(days=40))
+    recite(lapsed_headers)
+    monkeypatch.undo()
+    first, second = (recite(student_headers).json() for _ in range(2))
+    assert first["community_id"] == community["id"]
+    assert recite(student_headers, community_id=other["id"]).status_code == 403
+    client.put(f"/api/v1/recitations/{first['id']}", json={"status": "reviewed"},
+               headers=owner_headers)
+
+    stats = client.get(f"/api/v1/communities/{community['id']}/stats",
+                       headers=student_headers).json()
+    expected = {"total_recitations": 3, "pending_reviews": 2, "reviewed_recitations": 1,
+                "active_members": 1}
+    assert {k: stats[k] for k in expected} == expected
+
+    # A rebuild from the recitations agrees (all were created today, so the
+    # lapsed member counts as active again), after assigning one stored
+    # without a community back to the student's only community
+    db = TestingSessionLocal()
+    try:
+        db.execute(update(Recitation).where(Recitation.id == second["id"])
+                   .values(community_id=None))
+        assert community_stats.backfill_communities(db, community["id"]) == 1
+        community_stats.rebuild(db, community["id"])
+        db.commit()
+    finally:
+        db.close()
+    stats = client.get(f"/api/v1/communities/{community['id']}/stats",
+                       headers=student_headers).json()
+    assert {k: stats[k] for k in expected} == {**expected, "active_members": 2}
+
+
+def test_bulk_invitations(setup_database, monkeypatch):
+    monkeypatch.setattr(invitations, "SessionLocal", TestingSessionLocal)
+    owner_headers = register_and_login("scholar")
+    student_headers = register_and_login()
+    outsider_headers = register_and_login()
+    community = client.post("/api/v1/communities/", json={"name": "Class 3B"},
+                            headers=owner_headers).json()
+    email = client.get("/api/v1/users/me", headers=student_headers).json()["email"]
+    emails = [email, email.upper(), *(f"pupil{i}@example.com" for i in range(300))]
+
+    url = f"/api/v1/communities/{community['id']}/invitations"
+    assert client.post(url, json={"emails": emails},
+                       headers=student_headers).status_code == 403
+    issued = client.post(url, json={"emails": emails, "expires_in_days": 3},
+                         headers=owner_headers).json()["invitations"]
+    assert len(issued) == 301 and len({i["token"] for i in issued}) == 301
+    token = issued[0]["token"]
+
+    accept = f"/api/v1/communities/invitations/{token}/accept"
+    assert client.post(accept, headers=outsider_headers).status_code == 403
+    joined = client.post(accept, headers=student_headers).json()
+    assert (joined["community_id"], joined["role"]) == (community["id"], "member")
+    assert client.post(accept, headers=student_headers).status_code == 409
+    assert client.post("/api/v1/communities/invitations/nope/accept",
+                       headers=student_headers).status_code == 404
+    assert client.get(f"/api/v1/communities/{community['id']}/stats",
+                      headers=student_headers).status_code == 200
+
+    # The sweeper removes the used invitation and, once they lapse, the rest
+    db = TestingSessionLocal()
+    try:
+        db.execute(update(CommunityInvitation).where(
+            CommunityInvitation.token == invitations.hash_token(issued[1]["token"])
+        ).values(expires_at=CommunityInvitation.created_at))
+        db.commit()
+    finally:
+        db.close()
+    assert invitations.sweep(batch_size=1) == 2
+    assert client.post(f"/api/v1/communities/invitations/{issued[1]['token']}/accept",
+                       headers=outsider_headers).status_code == 404
+
+    # Only scholars join as scholars
+    scholar_headers = register_and_login("scholar")
+    invitees = [outsider_headers, scholar_headers]
+    issued = client.post(url, json={
+        "emails": [client.get("/api/v1/users/me", headers=headers).json()["email"]
+                   for headers in invitees],
+        "role": "scholar",
+    }, headers=owner_headers).json()["invitations"]
+    roles = [client.post(f"/api/v1/communities/invitations/{invitation['token']}/accept",
+                         headers=headers).json()["role"]
+             for invitation, headers in zip(issued, invitees)]
+    assert roles == ["member", "scholar"]
+
+
+def test_nearby_communities(setup_database):
+    headers = register_and_login("scholar")
+    places = {
+        "Masjid al-Haram": (21.4225, 39.8262),
+        "Jeddah": (21.5433, 39.1728),  # ~69 km away
+        "Taif": (21.2703, 40.4158),  # ~63 km away
+        "Madinah": (24.4672, 39.6111),  # ~339 km away
+        "Unplaced": None,
+    }
+    for name, point in places.items():
+        coordinates = {"latitude": point[0], "longitude": point[1]} if point else {}
+        client.post("/api/v1/communities/", json={"name": name, **coordinates},
+                    headers=headers)
+    assert client.post("/api/v1/communities/", json={"name": "Half", "latitude": 1.0},
+                       headers=headers).status_code == 422
+
+    def nearby(radius_km, **params):
+        response = client.get("/api/v1/communities/nearby", params={
+            "lat": 21.4225, "lng": 39.8262, "radius_km": radius_km, **params
+        }, headers=headers)
+        return [(c["name"], round(c["distance_km"])) for c in response.json()]
+
+    assert nearby(10) == [("Masjid al-Haram", 0)]
+    assert nearby(100) == [("Masjid al-Haram", 0), ("Taif", 63), ("Jeddah", 69)]
+    assert [name for name, _ in nearby(400)][-1] == "Madinah"
+    assert len(nearby(400, limit=2)) == 2
+
+
+def test_metrics_endpoint(setup_database):
+    headers = register_and_login()
+    client.get("/api/v1/recitations/", headers=headers)
+    client.get("/api/v1/recitations/999999", headers=headers)
+    client.get("/no-such-path")
+
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            samples[name] = float(value)
+
+    listing = 'method="GET",route="/api/v1/recitations/"'
+    assert samples[f'http_request_duration_seconds_count{{{listing},status="200"}}'] >= 1
+    assert samples[f'http_request_duration_seconds_bucket{{{listing},status="200",le="+Inf"}}'] \
+        == samples[f'http_request_duration_seconds_count{{{listing},status="200"}}']
+    assert samples[f'http_request_sql_queries_sum{{{listing}}}'] >= 1
+    assert samples[f'http_response_size_bytes_sum{{{listing}}}'] > 0
+    # Ids and unknown paths don't create series of their own
+    assert samples['http_request_duration_seconds_count{method="GET",'
+                   'route="/api/v1/recitations/{recitation_id}",status="404"}'] >= 1
+    assert samples['http_request_duration_seconds_count{method="GET",'
+                   'route="unmatched",status="404"}'] >= 1
+    assert samples['http_requests_in_progress{method="GET"}'] == 1  # this scrape
+    assert samples["token_verifications_total"] >= 1
+
+
+def test_stats_shared_across_workers(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "multiprocess_dir", str(tmp_path))
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    workers = {os.getppid(): "live", exited.pid: "retired"}
+    for kind in ("metrics", "slow_queries"):
+        (tmp_path / kind).mkdir()
+    for pid in workers:
+        (tmp_path / "metrics" / f"{pid}.json").write_text(json.dumps({
+            "http_requests_in_progress": [
+                ["http_requests_in_progress", ["method"], ["PATCH"], 2]],
+            "token_verifications_total": [["token_verifications_total", [], [], 5]],
+        }))
+    (tmp_path / "slow_queries" / f"{exited.pid}.json").write_text(json.dumps({
+        "feed": {"statement": "SELECT ?", "calls": 4, "total_seconds": 2.0,
+                 "max_seconds": 0.9, "last_seen": None, "routes": {"background": 4},
+                 "parameter_shapes": [], "plans": []},
+    }))
+
+    own = verification_stats.snapshot()["verifications"]
+    text = client.get("/metrics").text
+    assert f"token_verifications_total {own + 10}" in text
+    assert 'http_requests_in_progress{method="PATCH"} 2' in text  # live workers only
+    assert not (tmp_path / "metrics" / f"{exited.pid}.json").exists()
+    assert (tmp_path / "metrics" / "archive.json").exists()
+
+    slow = {entry["fingerprint"]: entry for entry in slow_queries.top()}
+    assert slow["feed"]["calls"] == 4 and slow["feed"]["mean_ms"] == 500
+
+
+def test_gunicorn_options(monkeypatch):
+    monkeypatch.setattr(settings, "web_concurrency", None)
+    options = server.build_options()
+    assert options["workers"] == server.default_workers()
+    monkeypatch.setattr(settings, "web_concurrency", 3)
+    options = server.build_options()
+    assert options["workers"] == 3
+    assert options["worker_class"] == "uvicorn.workers.UvicornWorker"
+
+    cfg = server.Server(app, options).cfg
+    assert cfg.workers == 3 and cfg.preload_app
+    assert cfg.max_requests == settings.server_max_requests
+
+    disposed = []
+    monkeypatch.setattr(server.engine, "dispose", lambda **kwargs: disposed.append(kwargs))
+    cfg.post_fork(None, None)
+    assert disposed == [{"close": False}]
+
+
+def test_query_budget_and_repeated_statements(setup_database, monkeypatch, caplog):
+    owner_headers = register_and_login("scholar")
+    headers = register_and_login()
+    for index in range(4):
+        community = client.post("/api/v1/communities/", json={"name": f"Circle {index}"},
+                                headers=owner_headers).json()
+        client.post(f"/api/v1/communities/{community['id']}/join",
+                    json={"community_id": community["id"]}, headers=headers)
+    # Counts are grouped, so more communities don't mean more queries
+    mine = client.get("/api/v1/communities/my-communities", headers=headers).json()
+    assert [c["member_count"] for c in mine] == [2, 2, 2, 2]
+    for index in range(4, 12):
+        client.post("/api/v1/communities/", json={"name": f"Circle {index}"},
+                    headers=owner_headers)
+    listing = client.get("/api/v1/communities/", headers=headers)
+    assert len(listing.json()) >= 12
+    assert all(c["creator"] and c["memberships"][0]["user"] for c in listing.json())
+
+    monkeypatch.setattr(recitation_endpoints.read_recitations, "__query_budget__", 1,
+                        raising=False)
+    with pytest.raises(QueryBudgetExceeded, match="budget is 1"):
+        client.get("/api/v1/recitations/", headers=headers)
+
+    sql = RequestSQL()
+    sql.queries = 12
+    sql.statements = {"SELECT markers.id FROM markers WHERE markers.recitation_id = ?": 11,
+                      "UPDATE recitations SET status=? WHERE recitations.id = ?": 1}
+    problems, statement = violations(None, sql)
+    assert problems == ["ran the same SELECT 11 times (N+1?)"]
+    assert statement.startswith("SELECT markers.id")
+
+    # In production the request goes through and a sample is logged
+    monkeypatch.setattr(settings, "query_budget_mode", "warn")
+    monkeypatch.setattr(settings, "query_budget_warn_sample_rate", 1.0)
+    with caplog.at_level(logging.WARNING, logger="app.core.query_budget"):
+        assert client.get("/api/v1/recitations/", headers=headers).status_code == 200
+    assert "GET /api/v1/recitations/ ran" in caplog.text and "SELECT" in caplog.text
+
+
+def test_request_profiling(setup_database, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "profile_dir", str(tmp_path))
+    headers = register_and_login()
+    admin_headers = register_and_login("admin")
+    assert client.get("/api/v1/recitations/?_profile=1").status_code == 401
+    assert client.get("/api/v1/recitations/", headers={**headers, "X-Profile": "1"}
+                      ).status_code == 403
+
+    response = client.get("/api/v1/recitations/", headers={**admin_headers, "X-Profile": "1"})
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+    assert [p["id"] for p in client.get("/api/v1/admin/profiles",
+                                        headers=admin_headers).json()] == [profile_id]
+    folded = client.get(f"/api/v1/admin/profiles/requests/{profile_id}", headers=admin_headers)
+    assert folded.headers["content-type"].startswith("text/plain")
+    for line in folded.text.splitlines():
+        stack, _, count = line.rpartition(" ")
+        assert stack and int(count) > 0
+    assert client.get("/api/v1/admin/profiles/requests/..%2Fsecrets",
+                      headers=admin_headers).status_code == 404
+
+    # Continuous mode: samples of a busy thread land in the flushed aggregate
+    def spin(stop):
+        while not stop.is_set():
+            pass
+
+    stop = threading.Event()
+    worker = threading.Thread(target=spin, args=(stop,))
+    worker.start()
+    try:
+        profiling.continuous.add(profiling.sample())
+    finally:
+        stop.set()
+        worker.join()
+    name = profiling.flush()
+    assert "test_main:test_request_profiling.<locals>.spin" in \
+        profiling.read("continuous", name)
+
+    monkeypatch.setattr(settings, "profiling_max_files", 0)
+    profiling.prune()
+    assert profiling.stored() == []
+
+
+def test_slow_query_log(setup_database, monkeypatch, caplog):
+    assert slow_queries.normalize(
+        "SELECT * FROM communities WHERE name ILIKE ? AND id IN (?, ?, ?)\n LIMIT 20 OFFSET 0"
+    ) == "SELECT * FROM communities WHERE name ILIKE ? AND id IN (...) LIMIT ? OFFSET ?"
+    assert slow_queries.normalize("INSERT INTO t (a, b) VALUES (%(a_m0)s, 'x'), (%(a_m1)s, 'y')"
+                                  ) == "INSERT INTO t (a, b) VALUES (?, ?), ..."
+    assert slow_queries.normalize("SELECT col::text FROM t2 WHERE x = $1") == \
+        "SELECT col::text FROM t2 WHERE x = ?"
+    assert slow_queries.parameter_shape(("%quran%", "%quran%", 20, 0)) == "(str*2, int*2)"
+    assert slow_queries.parameter_shape([{"a": 1}, {"a": 2}], executemany=True) == "{a: int} x2"
+
+    headers = register_and_login()
+    admin_headers = register_and_login("admin")
+    slow_queries.reset()
+    monkeypatch.setattr(settings, "slow_query_ms", 0)
+    with caplog.at_level(logging.WARNING, logger="app.core.slow_queries"):
+        for search in ("tajweed", "hifz"):
+            client.get(f"/api/v1/communities/?search={search}", headers=headers)
+    assert "Slow query" in caplog.text and "tajweed" not in caplog.text
+    monkeypatch.setattr(settings, "slow_query_ms", 200)
+
+    offenders = client.get("/api/v1/admin/slow-queries?order=calls&limit=500",
+                           headers=admin_headers).json()
+    search = next(q for q in offenders if "lower(communities.name) LIKE lower(?)" in q["statement"])
+    assert search["calls"] == 2
+    assert search["routes"] == {"GET /api/v1/communities/": 2}
+    assert search["parameter_shapes"] == ["(str*3, int*2)"]
+    assert search["plans"] == []  # EXPLAIN is only captured on Postgres
+
+
+def test_statements_timed_once_including_failures(monkeypatch):
+    seen = []
+    monkeypatch.setattr(sql_timing, "_observers", [seen.append])
+    with engine.connect() as connection:
+        connection.exec_driver_sql("SELECT 1")
+        with pytest.raises(Exception, match="no_such_table"):
+            connection.exec_driver_sql("SELECT * FROM no_such_table")
+        assert not connection.info.get("sql_timing_starts")
+    assert [(timed.statement, timed.error is None) for timed in seen] == [
+        ("SELECT 1", True), ("SELECT * FROM no_such_table", False)]
+
+
+def test_request_tracing(setup_database, monkeypatch, tmp_path):
+    path = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(settings, "tracing_exporter", "jsonl")
+    monkeypatch.setattr(settings, "tracing_jsonl_path", str(path))
+    monkeypatch.setattr(settings, "tracing_sample_rate", 0.0)
+    headers = register_and_login()
+    tracing.flush()
+
+    trace_id, parent_id = "4bf92f3577b34da6a3ce929d0e0e4736", "00f067aa0ba902b7"
+    # A sampled flag from an untrusted peer falls back to the local rate
+    client.get("/api/v1/recitations/", headers={
+        **headers, "traceparent": f"00-{'2' * 32}-{parent_id}-01"})
+    monkeypatch.setattr(settings, "tracing_trusted_proxies", ["testclient"])
+    response = client.get("/api/v1/recitations/", headers={
+        **headers, "Accept-Encoding": "gzip", "traceparent": f"00-{trace_id}-{parent_id}-01"})
+    assert response.status_code == 200
+    # Not sampled upstream, and the local sample rate is 0
+    client.get("/api/v1/recitations/", headers={
+        **headers, "traceparent": f"00-{'1' * 32}-{parent_id}-00"})
+    tracing.flush()
+
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert {span["trace_id"] for span in spans} == {trace_id}
+    by_name = {}
+    for span in spans:
+        by_name.setdefault(span["name"], []).append(span)
+    root, = by_name["GET /api/v1/recitations/"]
+    assert root["parent_id"] == parent_id
+    assert root["attributes"]["http.status_code"] == 200
+    for name in ("auth.verify_token", "auth.user_lookup", "endpoint",
+                 "response.serialize", "response.encode"):
+        assert by_name[name][0]["parent_id"] == root["span_id"], name
+    lookup, = by_name["auth.user_lookup"]
+    assert any(query["parent_id"] == lookup["span_id"] for query in by_name["db.query"])
+    assert all(span["start_ns"] <= span["end_ns"] for span in spans)
+
+    payload = tracing.otlp_payload([tracing.Span(tracing.Trace(trace_id), "job",
+                                                 attributes={"rows": 3})])
+    otlp_span = payload["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+    assert otlp_span["traceId"] == trace_id and "parentSpanId" not in otlp_span
+    assert otlp_span["attributes"] == [{"key": "rows", "value": {"intValue": "3"}}]